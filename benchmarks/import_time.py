@@ -0,0 +1,41 @@
+"""
+How long does it take to import sneks?
+
+Each statement is run in a fresh interpreter several times; we report the best wall time, with
+the time to just start Python subtracted off.
+
+    python benchmarks/import_time.py
+"""
+from __future__ import annotations
+
+import subprocess
+import sys
+import time
+
+STATEMENTS = [
+    "import sneks",
+    "import sneks.constants",
+    "import sneks.parse_poetry, sneks.parse_pdm",
+    "from sneks import get_client",
+]
+
+
+def best_of(statement: str, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(repeat: int = 5) -> None:
+    baseline = best_of("pass", repeat)
+    print(f"{'python startup':<45} {baseline * 1000:8.1f} ms")
+    for statement in STATEMENTS:
+        t = best_of(statement, repeat) - baseline
+        print(f"{statement:<45} {t * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,62 @@
+"""
+How big is the plugin when it's sent to the cluster, and how long does it take to (un)pickle?
+
+Uses the lockfiles from the test environments. "Cold" loads run the module source (the first
+time a process sees the plugin); "warm" loads reuse it.
+
+    python benchmarks/plugin_serialization.py
+"""
+from __future__ import annotations
+
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+from distributed.protocol.pickle import dumps, loads
+
+from sneks.plugin import DepManagerBase, PdmDepManager, PoetryDepManager
+
+TESTS = Path(__file__).parent.parent / "tests"
+ENVS: list[tuple[type[DepManagerBase], Path]] = [
+    (PoetryDepManager, TESTS / "env-for-parsing-poetry"),
+    (PdmDepManager, TESTS / "env-for-parsing-pdm"),
+]
+
+
+def best_of(f: Callable[[], object], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(repeat: int = 50) -> None:
+    print(
+        f"{'plugin':<20} {'bytes':>8} {'dumps':>10} {'cold loads':>12} {'warm loads':>12}"
+    )
+    for plugin_type, root in ENVS:
+        plugin = plugin_type(
+            (root / "pyproject.toml").read_bytes(),
+            (root / plugin_type.LOCKFILE_NAME).read_bytes(),
+        )
+        pickled = dumps(plugin)
+        module = type(loads(pickled)).__module__
+
+        def cold_loads() -> None:
+            sys.modules.pop(module, None)
+            loads(pickled)
+
+        dumps_t = best_of(lambda: dumps(plugin), repeat)
+        cold_t = best_of(cold_loads, repeat)
+        warm_t = best_of(lambda: loads(pickled), repeat)
+        print(
+            f"{plugin_type.__name__:<20} {len(pickled):>8} {dumps_t * 1e6:>8.0f}us "
+            f"{cold_t * 1e6:>10.0f}us {warm_t * 1e6:>10.0f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
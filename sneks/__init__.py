@@ -1,3 +1,36 @@
-from .get_client import can_import, get_client
+from __future__ import annotations
 
-__all__ = ["get_client", "can_import"]
+import sys
+import types
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .get_client import async_get_client, can_import, get_client
+
+__all__ = ["get_client", "async_get_client", "can_import"]
+
+
+def __getattr__(name: str) -> Any:
+    # `get_client` pulls in coiled, distributed, rich, etc., which take seconds to import.
+    # Defer that until it's actually used, so `import sneks.constants` and friends are cheap.
+    if name in __all__:
+        import importlib
+
+        module = importlib.import_module(".get_client", __name__)
+        for export in __all__:
+            globals()[export] = getattr(module, export)
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name: str, value: Any) -> None:
+        # HACK: importing the `sneks.get_client` submodule makes the import system set
+        # `sneks.get_client` to the module, shadowing the function of the same name.
+        # Don't let it; `__getattr__` will fill in the function.
+        if name == "get_client" and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
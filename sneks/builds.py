@@ -0,0 +1,126 @@
+"""
+Predict, from the lockfile alone, which packages workers will have to build from source.
+
+Poetry and PDM record every file each locked version can be installed from. If none of a
+package's wheels fit the cluster's platform, the installer falls back to the sdist and compiles
+it, on every worker, every time one starts. `sneks.compat.get_backend` checks this for each of
+the cluster's CPU architectures before any instance launches.
+"""
+from __future__ import annotations
+
+import functools
+import sys
+from typing import Any, Iterable, Mapping, NamedTuple
+
+from packaging.tags import Tag, compatible_tags, cpython_tags
+from packaging.utils import InvalidWheelFilename, parse_wheel_filename
+
+from sneks.lockfile import Lockfile
+from sneks.platforms import marker_environment, platform_tags
+
+BUILD_SECONDS_ESTIMATE = 120
+"""
+Rough guess at how long building one sdist takes on a worker, in seconds.
+
+Real builds range from a few seconds (pure Python) to tens of minutes (big C++ extensions).
+"""
+
+
+class SourceBuild(NamedTuple):
+    name: str
+    version: str
+    sdist: str | None
+    "Filename of the sdist that would be built. None if there isn't one either, so the install will fail."
+
+
+class BuildReport(NamedTuple):
+    "What installing the lockfile on one CPU architecture will involve"
+
+    arch: str
+    wheels: int
+    "Number of packages with a wheel for the platform"
+    builds: list[SourceBuild]
+    "Packages without a wheel for the platform"
+    unknown: list[str]
+    "Packages we can't tell about: from Git or a path, or with no files in the lockfile"
+
+    @property
+    def estimated_seconds(self) -> float:
+        "Very roughly, how much source builds will add to every worker's install"
+        return len(self.builds) * BUILD_SECONDS_ESTIMATE
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "arch": self.arch,
+            "wheels": self.wheels,
+            "builds": [list(b) for b in self.builds],
+            "unknown": self.unknown,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> BuildReport:
+        return cls(
+            data["arch"],
+            data["wheels"],
+            [SourceBuild(*b) for b in data["builds"]],
+            data["unknown"],
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def supported_tags(arch: str) -> frozenset[Tag]:
+    "Wheel tags the cluster can install on ``arch``, with the client's Python version"
+    version = sys.version_info[:2]
+    # Older glibc baselines than `platform_tags` offers `pip download` are fine to install too
+    platforms = platform_tags(arch) + [
+        f"manylinux_2_{minor}_{arch}" for minor in range(16, 4, -1)
+    ]
+    return frozenset(
+        [
+            *cpython_tags(version, platforms=platforms),
+            *compatible_tags(version, f"cp{version[0]}{version[1]}", platforms),
+        ]
+    )
+
+
+def _has_wheel(filenames: Iterable[str], tags: frozenset[Tag]) -> bool:
+    for filename in filenames:
+        if not filename.endswith(".whl"):
+            continue
+        try:
+            _, _, _, wheel_tags = parse_wheel_filename(filename)
+        except InvalidWheelFilename:
+            continue
+        if not tags.isdisjoint(wheel_tags):
+            return True
+    return False
+
+
+def _is_sdist(filename: str) -> bool:
+    return filename.endswith((".tar.gz", ".zip", ".tar.bz2", ".tgz"))
+
+
+def predict_builds(
+    lockfile: Lockfile, requirements: Mapping[str, str | None], arch: str
+) -> BuildReport:
+    """
+    Which locked packages will be built from source on ``arch``.
+
+    ``requirements`` are the project's direct dependencies (as from
+    `sneks.lockfile.project_dependencies`); everything they need on ``arch`` is checked.
+    """
+    tags = supported_tags(arch)
+    wheels = 0
+    builds: list[SourceBuild] = []
+    unknown: list[str] = []
+    installed = lockfile.installed(requirements, marker_environment(arch))
+    for pkg in sorted(installed, key=lambda p: p.key):
+        filenames = [f for f, _ in pkg.files]
+        if pkg.source is not None or not filenames:
+            unknown.append(pkg.name)
+        elif _has_wheel(filenames, tags):
+            wheels += 1
+        else:
+            sdist = next((f for f in filenames if _is_sdist(f)), None)
+            builds.append(SourceBuild(pkg.name, pkg.version, sdist))
+    return BuildReport(arch, wheels, builds, unknown)
@@ -0,0 +1,143 @@
+"""
+Small on-disk caches, so repeated `get_client` calls from short-lived processes can skip work.
+
+Everything lives under `cache_dir`. Writes are atomic (write to a temp file, then rename),
+so concurrent processes can share a cache; the worst case is a lost update, which just means
+a cache miss next time.
+"""
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any
+
+from sneks.constants import SENV_CACHE_TTL
+
+
+def cache_dir() -> Path:
+    "Directory for sneks' local caches. Respects ``$SNEKS_CACHE_DIR``, then ``$XDG_CACHE_HOME``."
+    if path := os.environ.get("SNEKS_CACHE_DIR"):
+        return Path(path)
+    if xdg := os.environ.get("XDG_CACHE_HOME"):
+        return Path(xdg) / "sneks"
+    return Path.home() / ".cache" / "sneks"
+
+
+def _read_json(path: Path) -> dict[str, Any]:
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _write_json(path: Path, data: dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+# Software environments
+#######################
+
+
+def _senv_cache_path() -> Path:
+    return cache_dir() / "senvs.json"
+
+
+def _senv_key(account: str | None, name: str, image: str) -> str:
+    return json.dumps([account, name, image])
+
+
+def senv_is_cached(
+    account: str | None, name: str, image: str, ttl: float = SENV_CACHE_TTL
+) -> bool:
+    "Whether we created senv ``name`` pointing to ``image`` in ``account`` within the last ``ttl`` seconds"
+    created = _read_json(_senv_cache_path()).get(_senv_key(account, name, image))
+    return created is not None and time.time() - created < ttl
+
+
+def mark_senv_created(account: str | None, name: str, image: str) -> None:
+    path = _senv_cache_path()
+    senvs = _read_json(path)
+    senvs[_senv_key(account, name, image)] = time.time()
+    _write_json(path, senvs)
+
+
+def invalidate_senv(account: str | None, name: str, image: str) -> None:
+    "Forget that a senv exists, so the next `get_client` re-creates it"
+    path = _senv_cache_path()
+    senvs = _read_json(path)
+    if senvs.pop(_senv_key(account, name, image), None) is not None:
+        _write_json(path, senvs)
+
+
+def clear_senv_cache() -> None:
+    "Forget about all senvs, so the next `get_client` re-creates its senv"
+    _senv_cache_path().unlink(missing_ok=True)
+
+
+# Parsed projects
+#################
+
+# Bump when what `sneks.compat.get_backend` stores changes, to ignore old entries.
+PARSE_CACHE_VERSION = 5
+# Keep this many parsed projects (the most recently used)
+PARSE_CACHE_ENTRIES = 32
+
+
+def _parse_cache_dir() -> Path:
+    return cache_dir() / "parsed"
+
+
+def parse_cache_key(*parts: bytes | str) -> str:
+    "Digest of everything a parse depends on, like the pyproject's contents and sneks' settings"
+    h = hashlib.sha256(str(PARSE_CACHE_VERSION).encode())
+    for part in parts:
+        data = part.encode() if isinstance(part, str) else part
+        # Length-prefix each part, so ``("ab", "c")`` and ``("a", "bc")`` differ
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _mtime(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        # Another process pruned it
+        return 0.0
+
+
+def read_parsed(key: str) -> dict[str, Any] | None:
+    "The entry stored under ``key`` by `write_parsed`, if any"
+    path = _parse_cache_dir() / f"{key}.json"
+    entry = _read_json(path)
+    if not entry:
+        return None
+    # Mark it recently used, so pruning keeps it
+    with contextlib.suppress(OSError):
+        os.utime(path)
+    return entry
+
+
+def write_parsed(key: str, entry: dict[str, Any]) -> None:
+    "Store a JSON-able ``entry`` under ``key``, dropping the least recently used beyond `PARSE_CACHE_ENTRIES`"
+    directory = _parse_cache_dir()
+    _write_json(directory / f"{key}.json", entry)
+    entries = sorted(directory.glob("*.json"), key=_mtime, reverse=True)
+    for stale in entries[PARSE_CACHE_ENTRIES:]:
+        stale.unlink(missing_ok=True)
+
+
+def clear_parse_cache() -> None:
+    "Forget all parsed projects, so the next `get_client` re-parses the lockfile"
+    shutil.rmtree(_parse_cache_dir(), ignore_errors=True)
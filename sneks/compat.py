@@ -1,14 +1,34 @@
 from __future__ import annotations
 
+import base64
+import contextlib
+import hashlib
+import json
+import sys
 from pathlib import Path
-from typing import AbstractSet, Any, Callable
+from typing import AbstractSet, Any, Callable, Sequence
 
+import dask.config
 import tomli
 
+from sneks.builds import BuildReport, predict_builds
+from sneks.cache import parse_cache_key, read_parsed, write_parsed
 from sneks.constants import OPTIONAL_PACKAGES, REQUIRED_PACKAGES
-from sneks.parse_pdm import current_versions_pdm
-from sneks.parse_poetry import current_versions_poetry
-from sneks.plugin import DepManagerBase, PdmDepManager, PoetryDepManager
+from sneks.lockfile import Lockfile, as_lockfile, project_dependencies
+from sneks.parse_pdm import (
+    current_versions_pdm,
+    locked_hashes_pdm,
+    locked_versions_pdm,
+    records_groups_pdm,
+)
+from sneks.parse_poetry import (
+    current_versions_poetry,
+    locked_hashes_poetry,
+    locked_versions_poetry,
+)
+from sneks.platforms import marker_environment
+from sneks.plugin import DepManagerBase, PdmDepManager, PipDepManager, PoetryDepManager
+from sneks.timing import StartupTimings
 
 
 def find_pyproject() -> Path:
@@ -22,41 +42,224 @@ def sniff_tool_type(pyproject: dict[str, Any]) -> str:
     return backend.split(".", maxsplit=1)[0]
 
 
-def get_backend() -> tuple[DepManagerBase, dict[str, str]]:
-    "Get the `DepManagerBase` plugin instance, and extra environment variables"
+def requirements_txt(
+    locked: dict[str, dict[str, str]], hashes: dict[str, list[str]]
+) -> bytes:
+    """
+    A pip requirements file installing exactly the packages in ``locked`` (as from `get_backend`).
+
+    ``locked`` is by CPU architecture. Packages locked the same on every architecture are pinned
+    plainly; the rest get a ``platform_machine`` marker for each architecture that installs them.
+
+    Hashes are included only if every package has some, since pip checks all or nothing.
+    Packages from Git can't be hashed, so any Git dependency means no hash checking.
+    """
+    names = sorted({name for versions in locked.values() for name in versions})
+    use_hashes = all(hashes.get(name) for name in names)
+    lines = []
+    for name in names:
+        pins = {
+            arch: versions[name]
+            for arch, versions in sorted(locked.items())
+            if name in versions
+        }
+        everywhere = len(pins) == len(locked) and len(set(pins.values())) == 1
+        for arch, version in pins.items():
+            if version.startswith("git+"):
+                line = f"{name} @ {version}"
+            else:
+                line = f"{name}=={version}"
+            if not everywhere:
+                line += f' ; platform_machine == "{arch}"'
+            if use_hashes:
+                line += "".join(f" --hash={h}" for h in hashes[name])
+            lines.append(line)
+            if everywhere:
+                break
+    return "\n".join(lines).encode() + b"\n"
+
+
+def get_backend(
+    timings: StartupTimings | None = None,
+    archs: Sequence[str] | None = None,
+) -> tuple[DepManagerBase, dict[str, str], list[BuildReport]]:
+    """
+    Get the `DepManagerBase` plugin instance, extra environment variables, and build predictions
+
+    ``PIP_PACKAGES`` (installed when the container boots) is planned for the cluster's CPU
+    architectures ``archs`` (as from `sneks.platforms.cluster_archs`) and this Python version,
+    leaving out dependencies whose environment markers don't apply there. If not given,
+    markers are ignored and every conditional dependency is included.
+
+    For each of ``archs``, also predicts which packages have no wheel for the platform, so
+    every worker will build them from source (see `sneks.builds`). The plugin's ``locked``
+    packages are listed for each of ``archs`` too, or for x86_64 if not given.
+
+    The result is cached on disk (see `sneks.cache.read_parsed`), keyed by the contents of
+    the pyproject and lockfile, so unchanged projects skip parsing TOML and compressing files.
+    """
+    if timings is None:
+        timings = StartupTimings()
+
     pyproject_path = find_pyproject()
-    with open(pyproject_path, "rb") as f:
-        pyproject = f.read()
+    with timings.phase("read pyproject"):
+        with open(pyproject_path, "rb") as f:
+            pyproject = f.read()
+    installer = dask.config.get("sneks.installer", "tool")
+    if installer not in ("tool", "pip"):
+        raise ValueError(
+            f"Unknown sneks.installer {installer!r}; must be 'tool' or 'pip'"
+        )
+    key = parse_cache_key(
+        pyproject,
+        installer,
+        json.dumps([sorted(REQUIRED_PACKAGES), sorted(OPTIONAL_PACKAGES)]),
+        json.dumps(None if archs is None else sorted(archs)),
+        sys.version,
+    )
 
-    # TODO handle bad TOML
-    pyproject_data = tomli.loads(pyproject.decode())
+    with timings.phase("read parse cache"):
+        entry = read_parsed(key)
+    if entry is not None:
+        with timings.phase("read lockfile"):
+            try:
+                lockfile = (pyproject_path.parent / entry["lockfile"]).read_bytes()
+            except FileNotFoundError:
+                lockfile = b""
+        if hashlib.sha256(lockfile).hexdigest() == entry["lockfile_sha256"]:
+            with timings.phase("build plugin"):
+                plugin = _PLUGIN_TYPES[entry["plugin"]].from_payload(
+                    {
+                        name: base64.b64decode(data)
+                        for name, data in entry["payload"].items()
+                    },
+                    entry["digest"],
+                    entry["locked"],
+                )
+            builds = [BuildReport.from_json(b) for b in entry["builds"]]
+            return plugin, entry["environ"], builds
+
+    environments = [marker_environment(a) for a in sorted(archs or [])]
+    plugin, environ, builds, lockfile_name, lockfile = _parse_backend(
+        pyproject_path, pyproject, installer, environments, timings
+    )
+    assert plugin._payload is not None
+    entry = {
+        "lockfile": lockfile_name,
+        "lockfile_sha256": hashlib.sha256(lockfile).hexdigest(),
+        "plugin": type(plugin).__name__,
+        "digest": plugin.digest,
+        "locked": plugin.locked,
+        "environ": environ,
+        "builds": [b.to_json() for b in builds],
+        "payload": {
+            name: base64.b64encode(data).decode()
+            for name, data in plugin._payload.items()
+        },
+    }
+    with timings.phase("write parse cache"), contextlib.suppress(OSError):
+        # A read-only cache dir just means parsing again next time
+        write_parsed(key, entry)
+    return plugin, environ, builds
+
+
+_PLUGIN_TYPES: dict[str, type[DepManagerBase]] = {
+    t.__name__: t for t in (PoetryDepManager, PdmDepManager, PipDepManager)
+}
+
+
+def _parse_backend(
+    pyproject_path: Path,
+    pyproject: bytes,
+    installer: str,
+    environments: list[dict[str, str]],
+    timings: StartupTimings,
+) -> tuple[DepManagerBase, dict[str, str], list[BuildReport], str, bytes]:
+    "Parse the project. Returns what `get_backend` does, then the lockfile's name and contents."
+    with timings.phase("parse pyproject"):
+        # TODO handle bad TOML
+        pyproject_data = tomli.loads(pyproject.decode())
     tool = sniff_tool_type(pyproject_data)
+    # Without known architectures, Coiled's default (see `sneks.platforms.cluster_archs`)
+    lock_environments = environments or [marker_environment("x86_64")]
 
     plugin_type: type[DepManagerBase]
     current_versions_from_lockfile: Callable[
-        [AbstractSet[str], AbstractSet[str], dict[str, Any], dict[str, Any]],
+        [
+            AbstractSet[str],
+            AbstractSet[str],
+            Lockfile,
+            dict[str, Any],
+            list[dict[str, str]],
+        ],
         tuple[list[str], list[str]],
     ]
+    locked_versions: Callable[
+        [Lockfile, dict[str, str] | None, dict[str, str | None] | None], dict[str, str]
+    ]
+    locked_hashes: Callable[[Lockfile], dict[str, list[str]]]
     if tool == "poetry":
         plugin_type = PoetryDepManager
         current_versions_from_lockfile = current_versions_poetry
+        locked_versions = locked_versions_poetry
+        locked_hashes = locked_hashes_poetry
     elif tool == "pdm":
         plugin_type = PdmDepManager
         current_versions_from_lockfile = current_versions_pdm
+        locked_versions = locked_versions_pdm
+        locked_hashes = locked_hashes_pdm
     else:
         raise ValueError(f"Unsupported build tool {tool}")
 
-    lockfile_path = pyproject_path.parent / plugin_type.LOCKFILE_NAME
-    with open(lockfile_path, "rb") as f:
-        lockfile = f.read()
-    # TODO handle bad TOML
-    lockfile_data = tomli.loads(lockfile.decode())
+    lockfile_name = plugin_type.LOCKFILE_NAME
+    with timings.phase("read lockfile"):
+        with open(pyproject_path.parent / lockfile_name, "rb") as f:
+            lockfile = f.read()
+    with timings.phase("parse lockfile"):
+        # TODO handle bad TOML
+        lockfile_raw = tomli.loads(lockfile.decode())
+        if (
+            installer == "pip"
+            and tool == "pdm"
+            and not records_groups_pdm(lockfile_raw)
+        ):
+            # pip would install whatever we list, with no way to tell dev dependencies apart
+            raise ValueError(
+                "sneks.installer 'pip' needs a pdm.lock that records each package's groups. "
+                "Re-lock with `pdm lock --strategy inherit_metadata` (PDM 2.12+), "
+                "or use sneks.installer 'tool'."
+            )
+        lockfile_data = as_lockfile(lockfile_raw, tool)
 
-    required_versions, overrides = current_versions_from_lockfile(
-        REQUIRED_PACKAGES, OPTIONAL_PACKAGES, lockfile_data, pyproject_data
-    )
+        required_versions, overrides = current_versions_from_lockfile(
+            REQUIRED_PACKAGES,
+            OPTIONAL_PACKAGES,
+            lockfile_data,
+            pyproject_data,
+            environments,
+        )
+        roots = project_dependencies(pyproject_data, tool)
+        # What the tool installs on each kind of machine: one version of each package, for
+        # the cluster's Python version, and only where its markers apply
+        locked = {
+            env["platform_machine"]: locked_versions(lockfile_data, env, roots)
+            for env in lock_environments
+        }
     environ = {
         "PIP_PACKAGES": " ".join(required_versions),
         "PIP_OVERRIDES": " ".join(overrides),
     }
-    return plugin_type(pyproject, lockfile), environ
+    with timings.phase("predict builds"):
+        builds = [
+            predict_builds(lockfile_data, roots, env["platform_machine"])
+            for env in environments
+        ]
+    payload = lockfile
+    if installer == "pip":
+        # Install the resolved lockfile with pip alone; no Poetry or PDM on the workers
+        with timings.phase("build plan"):
+            payload = requirements_txt(locked, locked_hashes(lockfile_data))
+        plugin_type = PipDepManager
+    with timings.phase("build plugin"):
+        plugin = plugin_type(pyproject, payload, locked)
+    return plugin, environ, builds, lockfile_name, lockfile
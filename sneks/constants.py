@@ -5,40 +5,17 @@ DOCKER_IMAGE_PATTERN = (
     f"{DOCKER_USERNAME}/{PROJECT_NAME}:{{major}}.{{minor}}.{{micro}}{SUFFIX}"
 )
 SENV_NAME_PATTERN = f"{PROJECT_NAME}-{{major}}-{{minor}}-{{micro}}{SUFFIX}"
+# How long to trust that a senv we created still exists, in seconds.
+# Override with the ``sneks.senv-cache-ttl`` dask config key.
+SENV_CACHE_TTL = 24 * 60 * 60
 
 REQUIRED_PACKAGES = frozenset(
     ["dask", "distributed", "bokeh", "cloudpickle", "msgpack"]
 )
-# Most transitive dependencies of the required packages, so we don't have to re-install
-# them with different versions according to the lockfile.
-# Also include things we may want on the scheduler (`dask-pyspy`).
-OPTIONAL_PACKAGES = frozenset(
-    [
-        "MarkupSafe",
-        "click",
-        "dask-pyspy",
-        "fsspec",
-        "heapdict",
-        "jinja2",
-        "locket",
-        "lz4",
-        "numpy",
-        "packaging",
-        "pandas",
-        "partd",
-        "psutil",
-        "pyarrow",
-        "pyparsing",
-        "pyyaml",
-        "s3fs",
-        "sortedcontainers",
-        "tblib",
-        "toolz",
-        "tornado",
-        "urllib3",
-        "zict",
-    ]
-)
+# Also installed at boot if the lockfile has them: things we may want on the scheduler.
+# The dependencies of these and of `REQUIRED_PACKAGES` are found from the lockfile
+# (see `sneks.lockfile.Lockfile.closure`), so they're installed at boot too, at the locked versions.
+OPTIONAL_PACKAGES = frozenset(["dask-pyspy"])
 
 if __name__ == "__main__":
     # Print constants as environment variables.
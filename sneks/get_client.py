@@ -1,23 +1,50 @@
 from __future__ import annotations
 
 import contextlib
+import re
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable
 
 import coiled
 import dask.config
 import rich
+from coiled.exceptions import NotFound
 from coiled.utils import parse_wait_for_workers
 from distributed.client import Client
-from distributed.nanny import Nanny
+from distributed.compatibility import to_thread  # type: ignore
 from distributed.worker import get_client as get_default_client
+from rich.text import Text
 
+from sneks.builds import BuildReport
+from sneks.cache import invalidate_senv, mark_senv_created, senv_is_cached
 from sneks.compat import get_backend
-from sneks.constants import DOCKER_IMAGE_PATTERN, SENV_NAME_PATTERN
+from sneks.constants import DOCKER_IMAGE_PATTERN, SENV_CACHE_TTL, SENV_NAME_PATTERN
+from sneks.platforms import cluster_arch, cluster_archs
+from sneks.plugin import (
+    INSTALL_EVENT_TOPIC,
+    INSTALL_OUTPUT_TOPIC,
+    DepManagerBase,
+    DepManagerWatcher,
+)
+from sneks.timing import StartupTimings
+from sneks.wheelhouse import Wheelhouse, build_wheelhouse, upload_wheelhouse
 from sneks.wraps_args import wraps_args
 
+if TYPE_CHECKING:
+    from distributed.scheduler import Scheduler
 
-def _senv(account: str | None) -> str:
+
+def _senv_spec() -> tuple[str, str]:
+    "Name of the senv and the Docker image it wraps, for the current Python version"
+    vi = sys.version_info
+    senv = SENV_NAME_PATTERN.format(major=vi.major, minor=vi.minor, micro=vi.micro)
+    image = DOCKER_IMAGE_PATTERN.format(major=vi.major, minor=vi.minor, micro=vi.micro)
+    return senv, image
+
+
+def _senv(account: str | None) -> tuple[str, bool]:
     """
     Make a Coiled container-only senv wrapping the Docker image.
 
@@ -25,12 +52,17 @@ def _senv(account: str | None) -> str:
     container-only. Sadly, this means every sneks user has to create a separate sneks
     senv in their own account, pointing to the same image.
 
-    Just re-creating the image every time is probably faster than checking if it exists.
+    We remember locally which senvs we've created (for ``sneks.senv-cache-ttl`` seconds),
+    and skip the API call entirely if we've made this one recently. Returns the senv's name,
+    and whether it came from that cache. If the senv has been deleted in the meantime, cluster
+    creation will fail; see `_cluster`.
 
     When ``Cluster`` gets an ``image=`` kwarg, we can do away with this silliness.
     """
-    vi = sys.version_info
-    senv = SENV_NAME_PATTERN.format(major=vi.major, minor=vi.minor, micro=vi.micro)
+    senv, image = _senv_spec()
+    ttl = dask.config.get("sneks.senv-cache-ttl", SENV_CACHE_TTL)
+    if senv_is_cached(account, senv, image, ttl=ttl):
+        return senv, True
 
     with dask.config.set(
         {"coiled.account": account}
@@ -39,12 +71,331 @@ def _senv(account: str | None) -> str:
     ) if account is not None else contextlib.nullcontext():
         coiled.create_software_environment(
             name=senv,
-            container=DOCKER_IMAGE_PATTERN.format(
-                major=vi.major, minor=vi.minor, micro=vi.micro
-            ),
+            container=image,
             account=account,
         )
-    return senv
+    mark_senv_created(account, senv, image)
+    return senv, False
+
+
+# How Coiled words "that software environment doesn't exist"
+_MISSING = re.compile(
+    r"not found|does not exist|doesn't exist|unable to find|no such", re.I
+)
+
+
+def _stale_senv(
+    account: str | None, software: str, cached: bool, error: Exception
+) -> bool:
+    """
+    Cluster creation failed with ``error``. Returns whether to re-create the senv and try again.
+
+    Maybe our cached senv no longer exists (it was deleted, or the Coiled user changed), so
+    forget it either way. Only retry if that's what the error says, though: for anything else
+    (quota, auth, a bad argument, a half-started cluster), a second cluster wouldn't help.
+    """
+    invalidate_senv(account, *_senv_spec())
+    message = str(error)
+    missing = (software in message or "software environment" in message.lower()) and (
+        isinstance(error, NotFound) or _MISSING.search(message) is not None
+    )
+    if not (cached and missing):
+        return False
+    rich.print(
+        "[yellow]The cached software environment no longer exists; "
+        "re-creating it and trying again[/]"
+    )
+    return True
+
+
+def _cluster(senv: tuple[str, bool], **kwargs) -> coiled.Cluster:
+    "Create the cluster, retrying once with a fresh senv if the cached one turns out to be gone"
+    account = kwargs.get("account")
+    software, cached = senv
+    try:
+        return coiled.Cluster(software=software, **kwargs)
+    except Exception as e:
+        if not _stale_senv(account, software, cached, e):
+            raise
+    software, _ = _senv(account)
+    return coiled.Cluster(software=software, **kwargs)
+
+
+async def _async_cluster(senv: tuple[str, bool], **kwargs) -> coiled.Cluster:
+    "Async version of `_cluster`"
+    account = kwargs.get("account")
+    software, cached = senv
+    try:
+        return await coiled.Cluster(software=software, **kwargs)
+    except Exception as e:
+        if not _stale_senv(account, software, cached, e):
+            raise
+    software, _ = await to_thread(_senv, account)
+    return await coiled.Cluster(software=software, **kwargs)
+
+
+def _prepare(
+    account: str | None,
+    timings: StartupTimings,
+    archs: list[str],
+    arch: str | None = None,
+) -> tuple[DepManagerBase, dict[str, str], tuple[str, bool], Wheelhouse | None]:
+    """
+    Parse the lockfile and build the plugin while the senv is being created.
+
+    These don't depend on each other, and the senv call is a network round-trip,
+    so there's no reason to do them in sequence.
+
+    The boot-time install is planned for the workers' CPU architectures ``archs``.
+    If ``arch`` is given, also build a wheelhouse for it (see `sneks.wheelhouse`).
+    """
+
+    def senv() -> tuple[str, bool]:
+        with timings.phase("senv"):
+            return _senv(account)
+
+    with ThreadPoolExecutor(2, thread_name_prefix="sneks-prepare") as pool:
+        backend = pool.submit(get_backend, timings, archs)
+        software = pool.submit(senv)
+        plugin, environ, builds = backend.result()
+        _report_source_builds(builds)
+        wheelhouse = None
+        if arch is not None:
+            assert plugin.locked is not None
+            with timings.phase("wheelhouse"):
+                wheelhouse = build_wheelhouse(plugin.locked[arch], arch)
+            _report_wheelhouse(wheelhouse, arch)
+        return plugin, environ, software.result(), wheelhouse
+
+
+def _wheelhouse_arch(cluster_kwargs: dict) -> str | None:
+    "CPU architecture to build a wheelhouse for, or None if the wheelhouse is disabled"
+    if not dask.config.get("sneks.wheelhouse", False):
+        return None
+    return cluster_arch(cluster_kwargs)
+
+
+def _report_wheelhouse(wheelhouse: Wheelhouse, arch: str) -> None:
+    size = sum(f.stat().st_size for f in wheelhouse.files.values())
+    rich.print(
+        f"[bold white]Wheelhouse for {arch}: {len(wheelhouse.files)} wheel(s), "
+        f"{size / 2**20:.1f} MiB[/]"
+    )  # TODO improve
+    if wheelhouse.missing:
+        rich.print(
+            "[yellow]No wheels for these packages; workers will install them from the index: "
+            f"{', '.join(wheelhouse.missing)}[/]"
+        )
+
+
+def _report_source_builds(builds: list[BuildReport]) -> None:
+    for report in builds:
+        if not report.builds:
+            continue
+        names = ", ".join(f"{b.name}=={b.version}" for b in report.builds)
+        rich.print(
+            f"[yellow]No {report.arch} wheels for {len(report.builds)} package(s); every worker "
+            f"will build them from source, adding roughly {report.estimated_seconds / 60:.0f} "
+            f"minute(s) to its startup: {names}[/]"
+        )
+        if uninstallable := [b.name for b in report.builds if b.sdist is None]:
+            rich.print(
+                f"[bold red]No sdist either, so installing these on {report.arch} will fail: "
+                f"{', '.join(uninstallable)}[/]"
+            )
+
+
+def _rolling_restart() -> float | None:
+    "Fraction of workers allowed to restart at once, from the ``sneks.rolling-restart`` config"
+    fraction = dask.config.get("sneks.rolling-restart", None)
+    if fraction is None:
+        return None
+    fraction = float(fraction)
+    if not 0 < fraction <= 1:
+        raise ValueError(
+            f"sneks.rolling-restart must be a fraction in (0, 1], not {fraction}"
+        )
+    return fraction
+
+
+def _preserve_data(rolling_restart: float | None) -> bool:
+    "Whether to move workers' data off before restarting them, from the ``sneks.preserve-data`` config"
+    if not dask.config.get("sneks.preserve-data", False):
+        return False
+    if rolling_restart is None or rolling_restart >= 1:
+        # If every worker restarts at once, there's nowhere to move the data to
+        raise ValueError(
+            "sneks.preserve-data needs sneks.rolling-restart set to a fraction below 1, "
+            f"so some workers stay up to take the data; it's {rolling_restart}"
+        )
+    return True
+
+
+def _max_concurrent_installs() -> int | None:
+    "How many workers may install at once, from the ``sneks.max-concurrent-installs`` config"
+    count = dask.config.get("sneks.max-concurrent-installs", None)
+    if count is None:
+        return None
+    count = int(count)
+    if count < 1:
+        raise ValueError(
+            f"sneks.max-concurrent-installs must be a positive integer, not {count}"
+        )
+    return count
+
+
+def _use_wheelhouse(plugin: DepManagerBase, wheelhouse: Wheelhouse) -> None:
+    "Have the plugin install from the wheelhouse, once it's uploaded"
+    plugin.wheelhouse = list(wheelhouse.files)
+    plugin.wheelhouse_complete = not wheelhouse.missing
+
+
+def _report_install_failure(e: subprocess.CalledProcessError) -> None:
+    rich.print("[bold red]Dependency installation failed[/]")  # TODO improve
+    rich.print("[stdout]", e.stdout.decode())
+    rich.print("[stderr]", e.stderr.decode())
+
+
+def _install_output_printer(token: str) -> Callable[[tuple[float, Any]], None]:
+    """
+    Make a handler for `INSTALL_OUTPUT_TOPIC` events, printing the installer's output as it runs.
+
+    Every nanny runs the same install, so we only show the first one to send output.
+    """
+    source: str | None = None
+
+    def handler(event: tuple[float, Any]) -> None:
+        nonlocal source
+        _, msg = event
+        if msg["token"] != token:
+            return
+        if source is None:
+            source = msg["nanny"]
+            rich.print(f"[dim]Installer output from {source}:[/]")
+        if msg["nanny"] == source:
+            for _, line in msg["lines"]:
+                rich.print(Text(line, style="dim"))
+
+    return handler
+
+
+def _get_installed_digest(watcher_name: str):
+    "Make a function to run on the scheduler, returning the digest of the environment installed on the cluster"
+
+    # NOTE: defined in a closure so it's pickled by value; sneks isn't installed on the scheduler
+    def get_installed_digest(dask_scheduler: Scheduler) -> str | None:
+        watcher = dask_scheduler.plugins.get(watcher_name)
+        return getattr(watcher, "digest", None)
+
+    return get_installed_digest
+
+
+def _set_installed_digest(watcher_name: str):
+    "Make a function to run on the scheduler, recording the digest of the environment now on the cluster"
+
+    def set_installed_digest(dask_scheduler: Scheduler, digest: str) -> None:
+        dask_scheduler.plugins[watcher_name].digest = digest  # type: ignore[attr-defined]
+
+    return set_installed_digest
+
+
+def _finish(client: Client, timings: StartupTimings) -> None:
+    timings.finish()
+    # HACK: stash the timings on the client, since that's all we return
+    client.startup_timings = timings  # type: ignore[attr-defined]
+    rich.print(f"[bold white]Cluster ready in {timings.total:.1f}s[/]")  # TODO improve
+
+
+def _configure(plugin: DepManagerBase) -> None:
+    "Set the plugin's options from the ``sneks.*`` dask config"
+    plugin.rolling_restart = _rolling_restart()
+    plugin.preserve_data = _preserve_data(plugin.rolling_restart)
+    plugin.packed_env = dask.config.get("sneks.packed-env", False)
+    plugin.max_concurrent_installs = _max_concurrent_installs()
+
+
+async def _install(
+    client: Client,
+    cluster: coiled.Cluster,
+    plugin: DepManagerBase,
+    wheelhouse: Wheelhouse | None,
+    timings: StartupTimings,
+    n_workers: int | None,
+    wait_for_workers: int | float | bool | None,
+) -> None:
+    """
+    Install the environment on a new cluster, scale it, and wait for workers.
+
+    Runs on the client's event loop, where every client and cluster method returns an
+    awaitable, asynchronous or not. `get_client` runs it with `Client.sync`.
+    """
+    # Fast path for reconnecting: if the cluster already has this exact environment,
+    # don't re-upload the lockfile and make every nanny re-run the install to find that out.
+    with timings.phase("check installed"):
+        installed = await client.run_on_scheduler(
+            _get_installed_digest(DepManagerWatcher.name)
+        )
+    streaming_output = False
+    try:
+        if installed == plugin.digest:
+            rich.print("[bold white]Dependencies on cluster already up to date[/]")
+        else:
+            rich.print(
+                "[bold white]Uploading lockfile and installing dependencies on running workers[/]"
+            )  # TODO improve
+            with timings.phase("register plugin"):
+                # Register the watcher first, so any nanny that misses the plugin broadcast
+                # gets it pushed once its worker connects. It also stores the lockfile, which
+                # nannies fetch by digest, so it isn't copied into every instance of the plugin.
+                await client.register_scheduler_plugin(
+                    DepManagerWatcher(plugin.name), idempotent=True
+                )
+                await plugin.upload(client.scheduler)
+                if wheelhouse is not None:
+                    with timings.phase("upload wheelhouse"):
+                        await upload_wheelhouse(client, wheelhouse)
+                    _use_wheelhouse(plugin, wheelhouse)
+                client.subscribe_topic(
+                    INSTALL_OUTPUT_TOPIC, _install_output_printer(plugin.token)
+                )
+                streaming_output = True
+                try:
+                    await client.register_worker_plugin(plugin)
+                except subprocess.CalledProcessError as e:
+                    _report_install_failure(e)
+                    raise
+                await client.run_on_scheduler(
+                    _set_installed_digest(DepManagerWatcher.name), plugin.digest
+                )
+
+        if n_workers:
+            # Scale to requested size, if one was given. This is different from coiled behavior,
+            # but ensures a cluster will look the way you're asking for it---more declarative style.
+            rich.print(
+                f"[bold white]Scaled to {n_workers} worker(s)[/]"
+            )  # TODO improve
+            await cluster.scale(n_workers)
+        else:
+            n_workers = cluster._start_n_workers
+
+        target = parse_wait_for_workers(n_workers, wait_for_workers)
+        rich.print(f"[bold white]Waiting for {target} worker(s)[/]")  # TODO improve
+        with timings.phase("wait for workers"):
+            await client.wait_for_workers(target)
+    finally:
+        # Even if installing or waiting failed, or was interrupted
+        if streaming_output:
+            client.unsubscribe_topic(INSTALL_OUTPUT_TOPIC)
+
+    timings.add_worker_events(
+        await client.get_events(INSTALL_EVENT_TOPIC), plugin.token
+    )
+    _finish(client, timings)
+
+    # HACK: make the client "own" the cluster. When the client closes, the cluster
+    # object will close too. Whether the actual Coiled cluster shuts down depends on the
+    # `shutdown_on_close` argument.
+    client._start_arg = None
 
 
 @wraps_args(coiled.Cluster)
@@ -58,80 +409,86 @@ def get_client(**kwargs) -> Client:
     and ``poetry.lock`` or ``pdm.lock`` file. All non-dev, non-optional dependencies listed in
     the lockfile will be installed on the cluster when you connect to it, then the workers
     will restart if necessary.
+
+    With ``asynchronous=True``, this returns an awaitable instead (see `async_get_client`).
     """
-    # TODO deal with async
+    if kwargs.get("asynchronous"):
+        return async_get_client(**kwargs)  # type: ignore[return-value]
 
+    timings = StartupTimings()
     wait_for_workers = kwargs.pop("wait_for_workers", None)
     environ: dict[str, str] = kwargs.pop("environ", {})
 
-    plugin, new_env = get_backend()
+    plugin, new_env, senv, wheelhouse = _prepare(
+        kwargs.get("account"),
+        timings,
+        cluster_archs(kwargs),
+        _wheelhouse_arch(kwargs),
+    )
     environ.update(new_env)
+    _configure(plugin)
 
-    cluster = coiled.Cluster(
-        software=_senv(kwargs.get("account")),
-        environ=environ,
-        **kwargs,
-        wait_for_workers=False,
+    with timings.phase("cluster"):
+        cluster = _cluster(
+            senv,
+            environ=environ,
+            **kwargs,
+            wait_for_workers=False,
+        )
+        client = Client(cluster)
+    client.sync(
+        _install,
+        client,
+        cluster,
+        plugin,
+        wheelhouse,
+        timings,
+        kwargs.get("n_workers"),
+        wait_for_workers,
     )
-    client = Client(cluster)
-    rich.print(
-        "[bold white]Uploading lockfile and installing dependencies on running workers[/]"
-    )  # TODO improve
-    try:
-        client.register_worker_plugin(plugin)
-    except subprocess.CalledProcessError as e:
-        rich.print("[bold red]Dependency installation failed[/]")  # TODO improve
-        rich.print("[stdout]", e.stdout.decode())
-        rich.print("[stderr]", e.stderr.decode())
-        raise
-
-    if n_workers := kwargs.get("n_workers"):
-        # Scale to requested size, if one was given. This is different from coiled behavior,
-        # but ensures a cluster will look the way you're asking for it---more declarative style.
-        rich.print(f"[bold white]Scaled to {n_workers} worker(s)[/]")  # TODO improve
-        cluster.scale(n_workers)
-    else:
-        n_workers = cluster._start_n_workers
-
-    target = parse_wait_for_workers(n_workers, wait_for_workers)
-    rich.print(f"[bold white]Waiting for {target} worker(s)[/]")  # TODO improve
-    client.wait_for_workers(target)
-
-    # Hack around https://github.com/dask/distributed/issues/7035. Workers that joined while
-    # the plugin was getting registered may have missed it.
-    # We have to run this after we're sure all workers are connected.
-    # If we just do it after the plugin is registered, it's not guaranteed that a _Worker_
-    # subprocess that was starting up prior to `register_worker_plugin` has actually
-    # started and connected to the scheduler yet.
-
-    # don't want to serialize the whole plugin into the closure
-    plugin_name = plugin.name
-
-    async def restart_if_no_dep_manager(dask_worker: Nanny) -> None:
-        if plugin_name not in dask_worker.plugins:
-            print(f"{plugin_name!r} missing; fetching from scheduler...")
-
-            msg = await dask_worker.scheduler.register_nanny()
-
-            plugins = msg["nanny-plugins"]  # type: ignore
-            if plugin_name not in plugins:
-                raise RuntimeError(f"{plugin_name!r} not in {plugins}!")
-
-            for name, plugin in plugins.items():
-                print(f"Manually adding missing plugin {name!r}")
-                await dask_worker.plugin_add(plugin=plugin, name=name)
-        else:
-            print(f"{plugin_name!r} already registered")
+    return client
 
-    # Sadly we have to block on this for consistency's sake.
-    # We don't want to return control to the user until we're sure there
-    # aren't any workers without the plugin.
-    client.run(restart_if_no_dep_manager, nanny=True)
 
-    # HACK: make the client "own" the cluster. When the client closes, the cluster
-    # object will close too. Whether the actual Coiled cluster shuts down depends on the
-    # `shutdown_on_close` argument.
-    client._start_arg = None
+@wraps_args(coiled.Cluster)
+async def async_get_client(**kwargs) -> Client:
+    """
+    Async version of `get_client`, for use within a running event loop.
+
+    Returns an asynchronous `Client`. Lockfile parsing and senv creation happen in a
+    background thread, so they don't block the event loop.
+    """
+    timings = StartupTimings()
+    kwargs["asynchronous"] = True
+    wait_for_workers = kwargs.pop("wait_for_workers", None)
+    environ: dict[str, str] = kwargs.pop("environ", {})
+
+    plugin, new_env, senv, wheelhouse = await to_thread(
+        _prepare,
+        kwargs.get("account"),
+        timings,
+        cluster_archs(kwargs),
+        _wheelhouse_arch(kwargs),
+    )
+    environ.update(new_env)
+    _configure(plugin)
+
+    with timings.phase("cluster"):
+        cluster = await _async_cluster(
+            senv,
+            environ=environ,
+            **kwargs,
+            wait_for_workers=False,
+        )
+        client = await Client(cluster, asynchronous=True)
+    await _install(
+        client,
+        cluster,
+        plugin,
+        wheelhouse,
+        timings,
+        kwargs.get("n_workers"),
+        wait_for_workers,
+    )
     return client
 
 
@@ -0,0 +1,567 @@
+"""
+One model of a Poetry or PDM lockfile, so the parsers don't each walk the raw TOML.
+
+A `Lockfile` holds a `LockedPackage` per ``[[package]]`` entry, an index by normalized name
+(so ``MarkupSafe`` finds ``markupsafe``), and each package's dependencies as adjacency lists of
+positions in `Lockfile.packages`. Build one with `Lockfile.from_poetry` or `Lockfile.from_pdm`
+and pass it around instead of the parsed TOML.
+
+A package may be locked at several versions, each for different Python versions (Poetry does
+this when, say, numpy dropped Python 3.8). Given a marker environment, `Lockfile.select` picks
+the one to install there.
+"""
+from __future__ import annotations
+
+import functools
+import re
+from collections import deque
+from typing import Any, Iterable, Iterator, Mapping
+
+from packaging.markers import InvalidMarker, Marker, UndefinedEnvironmentName
+from packaging.version import InvalidVersion, Version
+
+from sneks.names import normalize_name
+
+# The name at the start of a PEP 508 requirement, like ``MarkupSafe>=2.0; python_version < "3.9"``
+_REQUIREMENT_NAME = re.compile(r"\s*([A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)")
+
+
+class LockedPackage:
+    "One package in a lockfile"
+
+    __slots__ = (
+        "name",
+        "key",
+        "version",
+        "source",
+        "url",
+        "revision",
+        "subdirectory",
+        "dev",
+        "optional",
+        "files",
+        "marker",
+    )
+
+    name: str
+    "As written in the lockfile"
+    key: str
+    "Normalized name"
+    version: str
+    source: str | None
+    "Where it comes from, if not a package index: ``git``, ``directory``, ``file``, ``url``, ..."
+    url: str | None
+    revision: str | None
+    "Resolved Git commit"
+    subdirectory: str | None
+    dev: bool
+    "Only a dev dependency (Poetry, and PDM lockfiles that record each package's groups)"
+    optional: bool
+    "Only installed for an extra (Poetry only)"
+    files: tuple[tuple[str, str], ...]
+    "``(filename, hash)`` of each file it may be installed from. The hash may be empty."
+    marker: str | None
+    "Environment marker for where it can be installed at all, including its supported Python versions"
+
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        source: str | None = None,
+        url: str | None = None,
+        revision: str | None = None,
+        subdirectory: str | None = None,
+        dev: bool = False,
+        optional: bool = False,
+        files: tuple[tuple[str, str], ...] = (),
+        marker: str | None = None,
+    ) -> None:
+        self.name = name
+        self.key = normalize_name(name)
+        self.version = version
+        self.source = source
+        self.url = url
+        self.revision = revision
+        self.subdirectory = subdirectory
+        self.dev = dev
+        self.optional = optional
+        self.files = files
+        self.marker = marker
+
+    @property
+    def installed_version(self) -> str:
+        """
+        The version in the form `sneks.plugin.installed_distributions` reports it: the version
+        number for packages from an index, ``git+<url>@<commit>`` for packages from Git.
+        """
+        if self.source == "git":
+            return f"git+{self.url}@{self.revision}"
+        return self.version
+
+    @property
+    def pip_arg(self) -> str:
+        "Argument to ``pip install`` for exactly this package"
+        if self.source == "git":
+            return self.installed_version
+        return f"{self.name}=={self.version}"
+
+    def pip_args(self, machines: Iterable[str] | None = None) -> list[str]:
+        """
+        Arguments to ``pip install`` for this package, only on the CPU architectures ``machines``.
+
+        Markers have no spaces, so they survive word splitting in ``fake-entrypoint.sh``.
+        Packages from Git can't take a marker without spaces, so they're installed everywhere.
+        """
+        if machines is None or self.source == "git":
+            return [self.pip_arg]
+        return [f"{self.pip_arg};platform_machine=='{m}'" for m in machines]
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.name} {self.installed_version}>"
+
+
+class Lockfile:
+    "Every package in a lockfile, indexed by normalized name, with dependency edges"
+
+    __slots__ = ("packages", "index", "versions", "requires", "markers")
+
+    packages: list[LockedPackage]
+    "In lockfile order"
+    index: dict[str, int]
+    "Position in `packages` by normalized name. If a name is locked at several versions, the highest."
+    versions: dict[str, list[int]]
+    "Positions of every version of each package, by normalized name, highest version first"
+    requires: list[tuple[int, ...]]
+    """
+    Positions of each package's dependencies, parallel to `packages`. Dependencies locked at
+    several versions point at the `index` entry; see `select`.
+    """
+    markers: dict[tuple[int, int], str]
+    "Environment markers on conditional dependency edges, by ``(dependent, dependency)``"
+
+    def __init__(self) -> None:
+        self.packages = []
+        self.index = {}
+        self.versions = {}
+        self.requires = []
+        self.markers = {}
+
+    @classmethod
+    def from_poetry(cls, lockfile: dict[str, Any]) -> Lockfile:
+        "From a parsed ``poetry.lock``"
+        # Lockfile v1 lists files under `metadata.files`; v2 lists them on each package
+        metadata_files = lockfile.get("metadata", {}).get("files", {})
+        self = cls()
+        edges: list[dict[str, str | None]] = []
+        for pkg in lockfile["package"]:
+            source = pkg.get("source") or {}
+            stype = source.get("type")
+            i = self._add(
+                LockedPackage(
+                    pkg["name"],
+                    pkg["version"],
+                    source=stype,
+                    url=source.get("url"),
+                    revision=(
+                        source.get("resolved_reference") or source.get("reference")
+                    )
+                    if stype == "git"
+                    else None,
+                    subdirectory=source.get("subdirectory"),
+                    dev=pkg.get("category", "") == "dev",
+                    optional=pkg.get("optional", False),
+                    files=_files(
+                        pkg.get("files") or metadata_files.get(pkg["name"], [])
+                    ),
+                    marker=_poetry_python_marker(pkg.get("python-versions", "*")),
+                ),
+                edges,
+            )
+            deps = edges[i]
+            for dep, spec in pkg.get("dependencies", {}).items():
+                _merge_marker(deps, normalize_name(dep), _poetry_marker(spec))
+        self._link(edges)
+        return self
+
+    @classmethod
+    def from_pdm(cls, lockfile: dict[str, Any]) -> Lockfile:
+        "From a parsed ``pdm.lock``"
+        # Older lockfiles list files under `metadata.files`, keyed by "name version"
+        metadata_files = lockfile.get("metadata", {}).get("files", {})
+        self = cls()
+        edges: list[dict[str, str | None]] = []
+        for pkg in lockfile["package"]:
+            if "git" in pkg:
+                source, url = "git", pkg["git"]
+            elif "path" in pkg:
+                source, url = "directory", pkg["path"]
+            elif "url" in pkg:
+                source, url = "url", pkg["url"]
+            else:
+                source = url = None
+            i = self._add(
+                LockedPackage(
+                    pkg["name"],
+                    pkg.get("version", ""),
+                    source=source,
+                    url=url,
+                    revision=pkg.get("revision"),
+                    subdirectory=pkg.get("subdirectory"),
+                    dev="groups" in pkg and "default" not in pkg["groups"],
+                    marker=_and_markers(
+                        pkg.get("marker"),
+                        _requires_python_marker(pkg.get("requires_python", "")),
+                    ),
+                    files=_files(
+                        pkg.get("files")
+                        or metadata_files.get(
+                            f"{pkg['name']} {pkg.get('version', '')}", []
+                        )
+                    ),
+                ),
+                edges,
+            )
+            deps = edges[i]
+            for requirement in pkg.get("dependencies", []):
+                requirement, _, marker = requirement.partition(";")
+                if match := _REQUIREMENT_NAME.match(requirement):
+                    _merge_marker(
+                        deps, normalize_name(match[1]), marker.strip() or None
+                    )
+        self._link(edges)
+        return self
+
+    def _add(self, package: LockedPackage, edges: list[dict[str, str | None]]) -> int:
+        """
+        Append ``package``, returning its position.
+
+        Entries for the same package and version (PDM writes one per set of extras) are merged.
+        """
+        versions = self.versions.setdefault(package.key, [])
+        for i in versions:
+            existing = self.packages[i]
+            if existing.version == package.version:
+                if not package.optional:
+                    existing.optional = False
+                if not package.dev:
+                    existing.dev = False
+                return i
+        i = len(self.packages)
+        versions.append(i)
+        self.packages.append(package)
+        edges.append({})
+        return i
+
+    def _link(self, edges: list[dict[str, str | None]]) -> None:
+        "Turn dependencies by name into positions, dropping any that aren't locked, or self-edges"
+        for key, versions in self.versions.items():
+            versions.sort(
+                key=lambda i: _version_key(self.packages[i].version), reverse=True
+            )
+            self.index[key] = versions[0]
+        index = self.index
+        for i, deps in enumerate(edges):
+            requires = []
+            for key, marker in deps.items():
+                j = index.get(key)
+                if j is None or key == self.packages[i].key:
+                    continue
+                requires.append(j)
+                if marker:
+                    self.markers[i, j] = marker
+            self.requires.append(tuple(requires))
+
+    def __len__(self) -> int:
+        return len(self.packages)
+
+    def __iter__(self) -> Iterator[LockedPackage]:
+        return iter(self.packages)
+
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and normalize_name(name) in self.index
+
+    def __getitem__(self, name: str) -> LockedPackage:
+        return self.packages[self.index[normalize_name(name)]]
+
+    def get(
+        self, name: str, environment: Mapping[str, str] | None = None
+    ) -> LockedPackage | None:
+        "The package called ``name``. With an ``environment``, the version installed there, if any."
+        i = self.index.get(normalize_name(name))
+        if i is not None and environment is not None:
+            i = self.select(i, environment)
+        return None if i is None else self.packages[i]
+
+    def select(self, i: int, environment: Mapping[str, str]) -> int | None:
+        """
+        Position of the version of ``packages[i]`` to install in ``environment``.
+
+        That's the highest version whose marker (including its supported Python versions)
+        applies there, or None if none does.
+        """
+        for j in self.versions[self.packages[i].key]:
+            if applies(self.packages[j].marker, environment):
+                return j
+        return None
+
+    def dependencies(self, name: str) -> list[LockedPackage]:
+        "Direct dependencies of ``name`` that are in the lockfile"
+        return [
+            self.packages[j] for j in self.requires[self.index[normalize_name(name)]]
+        ]
+
+    def closure(
+        self, names: Iterable[str], environment: Mapping[str, str] | None = None
+    ) -> list[LockedPackage]:
+        """
+        ``names`` and everything they depend on, transitively, in breadth-first order.
+
+        Names that aren't locked are ignored. With an ``environment`` of marker variables
+        (like `sneks.platforms.marker_environment`), dependencies whose markers don't match it
+        are left out, and packages locked at several versions are included at the one that
+        `select` picks. Otherwise, conditional dependencies are all included, at their highest
+        locked version.
+        """
+        seen = bytearray(len(self.packages))
+        queue: deque[int] = deque()
+        for name in names:
+            i: int | None = self.index.get(normalize_name(name))
+            if i is not None and environment is not None:
+                i = self.select(i, environment)
+            if i is not None and not seen[i]:
+                seen[i] = 1
+                queue.append(i)
+        order = []
+        while queue:
+            i = queue.popleft()
+            order.append(self.packages[i])
+            for j in self.requires[i]:
+                if environment is not None:
+                    if not applies(self.markers.get((i, j)), environment):
+                        continue
+                    selected = self.select(j, environment)
+                    if selected is None:
+                        continue
+                    j = selected
+                if seen[j]:
+                    continue
+                seen[j] = 1
+                queue.append(j)
+        return order
+
+    def targets(
+        self, names: Iterable[str], environments: Iterable[Mapping[str, str]]
+    ) -> dict[LockedPackage, tuple[str, ...] | None]:
+        """
+        The `closure` of ``names`` on each of ``environments``.
+
+        Packages needed on every environment map to None; the rest to the ``platform_machine``
+        of the environments that need them. With no environments, the plain `closure`.
+        """
+        names = list(names)
+        environments = list(environments)
+        if not environments:
+            return dict.fromkeys(self.closure(names))
+        needed: dict[LockedPackage, list[str]] = {}
+        for env in environments:
+            for pkg in self.closure(names, env):
+                needed.setdefault(pkg, []).append(env["platform_machine"])
+        return {
+            pkg: None if len(machines) == len(environments) else tuple(machines)
+            for pkg, machines in needed.items()
+        }
+
+    def installed(
+        self, requirements: Mapping[str, str | None], environment: Mapping[str, str]
+    ) -> list[LockedPackage]:
+        """
+        Everything installing ``requirements`` puts in ``environment``, as `closure` orders it.
+
+        ``requirements`` are the project's direct dependencies by name, with their markers (as
+        from `project_dependencies`). The lockfile doesn't record them, and guessing them as the
+        packages nothing depends on misses any that something else also depends on.
+        """
+        return self.closure(
+            [
+                name
+                for name, marker in requirements.items()
+                if applies(marker, environment)
+            ],
+            environment,
+        )
+
+
+def as_lockfile(lockfile: dict[str, Any] | Lockfile, tool: str) -> Lockfile:
+    "``lockfile`` as a `Lockfile`, parsing it as ``tool`` (``poetry`` or ``pdm``) if it's raw TOML"
+    if isinstance(lockfile, Lockfile):
+        return lockfile
+    if tool == "poetry":
+        return Lockfile.from_poetry(lockfile)
+    if tool == "pdm":
+        return Lockfile.from_pdm(lockfile)
+    raise ValueError(f"Unsupported build tool {tool}")
+
+
+def _version_key(version: str) -> tuple[int, Version | str]:
+    "Sorts versions, putting ones that aren't valid PEP 440 below the rest"
+    try:
+        return 1, Version(version)
+    except InvalidVersion:
+        return 0, version
+
+
+def project_dependencies(pyproject: dict[str, Any], tool: str) -> dict[str, str | None]:
+    """
+    The project's non-dev, non-optional dependencies in a parsed ``pyproject.toml``.
+
+    Normalized names, mapped to the environment marker on the dependency, if any.
+    """
+    deps: dict[str, str | None] = {}
+    if tool == "poetry":
+        specs = pyproject.get("tool", {}).get("poetry", {}).get("dependencies", {})
+        for name, spec in specs.items():
+            if name == "python":
+                continue
+            alternatives = spec if isinstance(spec, list) else [spec]
+            if all(isinstance(s, dict) and s.get("optional") for s in alternatives):
+                # Only installed for one of the project's extras
+                continue
+            _merge_marker(deps, normalize_name(name), _poetry_marker(spec))
+    elif tool == "pdm":
+        for requirement in pyproject.get("project", {}).get("dependencies", []):
+            requirement, _, marker = requirement.partition(";")
+            if match := _REQUIREMENT_NAME.match(requirement):
+                _merge_marker(deps, normalize_name(match[1]), marker.strip() or None)
+    else:
+        raise ValueError(f"Unsupported build tool {tool}")
+    return deps
+
+
+def _files(files: list[dict[str, str]]) -> tuple[tuple[str, str], ...]:
+    return tuple(
+        (f.get("file") or f.get("url", "").rsplit("/", 1)[-1], f.get("hash", ""))
+        for f in files
+    )
+
+
+# An ``extra == "name"`` clause in a marker
+_EXTRA_CLAUSE = re.compile(r"""\bextra\s*==\s*["']([^"']+)["']""")
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_marker(marker: str) -> tuple[Marker | None, tuple[str, ...]]:
+    "The parsed marker, and the extras it mentions"
+    try:
+        parsed = Marker(marker)
+    except InvalidMarker:
+        return None, ()
+    return parsed, tuple(dict.fromkeys(_EXTRA_CLAUSE.findall(marker)))
+
+
+def applies(marker: str | None, environment: Mapping[str, str]) -> bool:
+    """
+    Whether ``marker`` is true in ``environment``. Missing or unparseable markers always apply.
+
+    Markers on a dependency only needed for some extras, like ``extra == "array"``, are true if
+    the rest of the marker is for any of those extras. The lockfile only has that dependency
+    because something asked for the extra; which one, it doesn't say.
+    """
+    if not marker:
+        return True
+    parsed, extras = _parse_marker(marker)
+    if parsed is None:
+        return True
+    try:
+        if not extras:
+            return parsed.evaluate(dict(environment))
+        return any(parsed.evaluate({**environment, "extra": e}) for e in extras)
+    except UndefinedEnvironmentName:
+        return True
+
+
+# A clause of a Poetry Python constraint we can turn into a marker, like ``>=3.8`` or ``==3.7.*``
+_POETRY_PYTHON_CLAUSE = re.compile(r"^(<=|>=|<|>|==|!=)?\s*(\d+(?:\.\d+)*(?:\.\*)?)$")
+
+
+def _poetry_python_marker(constraint: str) -> str | None:
+    """
+    A marker for a Poetry ``python`` constraint on a dependency, like ``>=3.7,<3.11 || >=3.12``.
+
+    Returns None (applies everywhere) for ``*``, or syntax we don't translate, like ``^3.8``.
+    """
+    alternatives = []
+    for alternative in constraint.split("||"):
+        clauses = []
+        for clause in alternative.split(","):
+            clause = clause.strip()
+            if clause == "*":
+                continue
+            match = _POETRY_PYTHON_CLAUSE.match(clause)
+            if match is None:
+                return None
+            op, version = match[1] or "==", match[2]
+            if version.endswith(".*") and op not in ("==", "!="):
+                return None
+            if op in ("==", "!=") and version.count(".") < 2 and "*" not in version:
+                # To Poetry, Python ``==3.8`` means any 3.8.x
+                version += ".*"
+            clauses.append(f'python_full_version {op} "{version}"')
+        if not clauses:
+            return None
+        alternatives.append(" and ".join(clauses))
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return " or ".join(f"({a})" for a in alternatives)
+
+
+# A clause of a PEP 440 specifier set, like ``>=3.7`` or ``!=3.0.*``
+_SPECIFIER_CLAUSE = re.compile(r"^(~=|===|==|!=|<=|>=|<|>)\s*(\S+)$")
+
+
+def _requires_python_marker(specifier: str) -> str | None:
+    "A marker for a ``requires_python`` specifier set, like ``>=2.7,!=3.0.*``. None if empty or invalid."
+    clauses = []
+    for clause in specifier.split(","):
+        clause = clause.strip()
+        if not clause:
+            continue
+        match = _SPECIFIER_CLAUSE.match(clause)
+        if match is None:
+            return None
+        clauses.append(f'python_full_version {match[1]} "{match[2]}"')
+    return " and ".join(clauses) or None
+
+
+def _and_markers(a: str | None, b: str | None) -> str | None:
+    if a and b:
+        return f"({a}) and ({b})"
+    return a or b
+
+
+def _poetry_spec_marker(spec: dict[str, Any]) -> str | None:
+    return _and_markers(
+        spec.get("markers"), _poetry_python_marker(spec.get("python", "*"))
+    )
+
+
+def _poetry_marker(spec: str | dict[str, Any] | list[dict[str, Any]]) -> str | None:
+    "Marker on a Poetry dependency, which may be a version, a table, or a list of tables"
+    if isinstance(spec, str):
+        return None
+    if isinstance(spec, dict):
+        return _poetry_spec_marker(spec)
+    markers = [_poetry_spec_marker(s) for s in spec]
+    if not all(markers):
+        # One of the alternatives applies everywhere
+        return None
+    return " or ".join(f"({m})" for m in markers)
+
+
+def _merge_marker(deps: dict[str, str | None], key: str, marker: str | None) -> None:
+    "Record a dependency edge; the same dependency listed twice applies if either marker does"
+    if key not in deps:
+        deps[key] = marker
+    elif deps[key] and marker and deps[key] != marker:
+        deps[key] = f"({deps[key]}) or ({marker})"
+    else:
+        deps[key] = deps[key] and marker
@@ -0,0 +1,177 @@
+"""
+How installation went across the cluster, from the reports nannies send to the scheduler.
+
+Each nanny logs one `sneks.plugin.INSTALL_EVENT_TOPIC` event per plugin registration
+(see `DepManagerBase.setup`), with:
+
+- ``durations``: seconds spent in each phase of the install, and ``total``
+- ``skipped``: whether the environment was already up to date (or another nanny on the same
+  machine installed it)
+- ``changes``: distributions ``added``, ``removed`` and ``updated``
+- ``restarted``: whether the worker restarted
+- ``tool`` and ``tool_version``: what did the installing
+- byte counts, where they apply: ``index_downloaded`` (new in the tool's cache, so from the
+  package index), ``cache_fetched``, ``wheelhouse_fetched`` and ``packed_env_fetched`` (from the
+  scheduler)
+
+`get_install_metrics` collects those into an `InstallMetrics`.
+"""
+from __future__ import annotations
+
+import math
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Awaitable, Iterable
+
+from sneks.plugin import INSTALL_EVENT_TOPIC
+
+if TYPE_CHECKING:
+    from distributed.client import Client
+    from rich.table import Table
+
+BYTE_FIELDS = (
+    "index_downloaded",
+    "cache_fetched",
+    "wheelhouse_fetched",
+    "packed_env_fetched",
+)
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values: Iterable[float], q: float) -> float:
+    "The ``q``th percentile of ``values`` (0-100), by nearest rank"
+    ordered = sorted(values)
+    if not ordered:
+        raise ValueError("percentile of no values")
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class InstallMetrics:
+    "Install reports from every nanny, for one plugin registration"
+
+    reports: dict[str, dict[str, Any]]
+    "The latest report from each nanny, by nanny address"
+
+    def __init__(self, reports: dict[str, dict[str, Any]]) -> None:
+        self.reports = reports
+
+    @classmethod
+    def from_events(
+        cls, events: Iterable[tuple[float, dict[str, Any]]], token: str | None = None
+    ) -> InstallMetrics:
+        """
+        Collect reports for the plugin registration ``token`` from scheduler events.
+
+        By default, uses the most recent registration.
+        """
+        events = list(events)
+        if token is None and events:
+            token = max(events, key=lambda e: e[0])[1].get("token")
+        return cls(
+            {
+                msg["nanny"]: msg
+                for _, msg in sorted(events, key=lambda e: e[0])
+                if msg.get("token") == token
+            }
+        )
+
+    def durations(self, phase: str = "total") -> dict[str, float]:
+        "Seconds each nanny spent in ``phase``, by nanny address, for nannies that ran it"
+        return {
+            nanny: r["durations"][phase]
+            for nanny, r in self.reports.items()
+            if phase in r["durations"]
+        }
+
+    def percentiles(self, phase: str = "total") -> dict[str, float]:
+        "Min, max, and `PERCENTILES` of time spent in ``phase`` across nannies"
+        values = list(self.durations(phase).values())
+        if not values:
+            return {}
+        result = {"min": min(values)}
+        result.update({f"p{q}": percentile(values, q) for q in PERCENTILES})
+        result["max"] = max(values)
+        return result
+
+    def slowest(self, n: int = 5, phase: str = "total") -> list[tuple[str, float]]:
+        "The ``n`` nannies that spent longest in ``phase``, slowest first"
+        return sorted(self.durations(phase).items(), key=lambda x: -x[1])[:n]
+
+    @property
+    def phases(self) -> list[str]:
+        "Every phase any nanny reported, in the order they ran"
+        phases: dict[str, None] = {}
+        for r in self.reports.values():
+            phases.update(dict.fromkeys(r["durations"]))
+        return list(phases)
+
+    def summary(self) -> dict[str, Any]:
+        "Aggregate numbers for the whole cluster"
+        reports = list(self.reports.values())
+        changes: dict[str, set[str]] = {
+            "added": set(),
+            "removed": set(),
+            "updated": set(),
+        }
+        for r in reports:
+            for kind, names in changes.items():
+                names.update(r.get("changes", {}).get(kind, {}))
+        return {
+            "workers": len(reports),
+            "installed": sum(not r["skipped"] for r in reports),
+            "restarted": sum(bool(r["restarted"]) for r in reports),
+            "tools": dict(
+                Counter(
+                    f"{r.get('tool', '?')} {r.get('tool_version', '?')}"
+                    for r in reports
+                )
+            ),
+            "bytes": {f: sum(r.get(f, 0) for r in reports) for f in BYTE_FIELDS},
+            "changes": {kind: sorted(names) for kind, names in changes.items()},
+            "durations": {phase: self.percentiles(phase) for phase in self.phases},
+        }
+
+    def __repr__(self) -> str:
+        total = self.percentiles()
+        median = f" median={total['p50']:.2f}s" if total else ""
+        return f"<{type(self).__name__} workers={len(self.reports)}{median}>"
+
+    def __rich__(self) -> Table:
+        from rich.table import Table
+
+        summary = self.summary()
+        table = Table(
+            title=(
+                f"sneks installs: {summary['workers']} worker(s), "
+                f"{summary['installed']} installed, {summary['restarted']} restarted"
+            )
+        )
+        table.add_column("phase")
+        columns = ["min", *(f"p{q}" for q in PERCENTILES), "max"]
+        for column in columns:
+            table.add_column(column, justify="right")
+        for phase, stats in summary["durations"].items():
+            table.add_row(phase, *(f"{stats[c]:.2f}" for c in columns))
+        for field, total in summary["bytes"].items():
+            if total:
+                table.add_row(f"{field} (MiB, all workers)", f"{total / 2**20:.1f}")
+        return table
+
+
+def get_install_metrics(
+    client: Client, token: str | None = None
+) -> InstallMetrics | Awaitable[InstallMetrics]:
+    """
+    Fetch install reports from the scheduler and summarize them.
+
+    ``token`` picks a plugin registration (``plugin.token``); by default, the most recent.
+    With an asynchronous client, returns an awaitable.
+    """
+    if client.asynchronous:
+
+        async def get() -> InstallMetrics:
+            events = await client.get_events(INSTALL_EVENT_TOPIC)
+            return InstallMetrics.from_events(events, token)
+
+        return get()
+    return InstallMetrics.from_events(client.get_events(INSTALL_EVENT_TOPIC), token)
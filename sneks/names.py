@@ -0,0 +1,10 @@
+from __future__ import annotations
+
+import re
+
+_NORMALIZE = re.compile(r"[-_.]+")
+
+
+def normalize_name(name: str) -> str:
+    "Normalize a distribution name per PEP 503, so ``MarkupSafe`` and ``markupsafe`` compare equal"
+    return _NORMALIZE.sub("-", name).lower()
@@ -1,18 +1,27 @@
 from __future__ import annotations
 
-from typing import AbstractSet, Any
+from typing import AbstractSet, Any, Iterable, Mapping
+
+from sneks.lockfile import Lockfile, as_lockfile
+from sneks.names import normalize_name
 
 
 def current_versions_pdm(
     required: AbstractSet[str],
     optional: AbstractSet[str],
-    lockfile: dict[str, Any],
+    lockfile: dict[str, Any] | Lockfile,
     pyproject: dict[str, Any],
+    environments: Iterable[Mapping[str, str]] = (),
 ) -> tuple[list[str], list[str]]:
     """
     Determine what versions of required and optional packages are installed by parsing the lockfile
 
-    Returns arguments to ``pip install`` to install those packages.
+    Returns arguments to ``pip install`` to install those packages, and all their dependencies
+    (transitively) that the lockfile installs.
+
+    If given ``environments`` (as from `sneks.platforms.marker_environment`), dependencies are
+    only included where their markers apply, with a ``platform_machine`` marker if that's only
+    some of the environments.
 
     Also validates that all dependencies in the lockfile will be installable on the cluster (no path deps, for example).
     """
@@ -22,54 +31,111 @@ def current_versions_pdm(
     except KeyError:
         overrides = {}
 
-    missing = set(required)
+    locked = as_lockfile(lockfile, "pdm")
+    override_keys = {normalize_name(o) for o in overrides}
+    required_keys = {normalize_name(r): r for r in required}
+    # Everything the required and optional packages need, so it's all installed at boot
+    targets = locked.targets([*required, *optional], environments)
+    missing = dict(required_keys)
     pip_args: list[str] = []
     pip_overrides: list[str] = []
-    for pkg in lockfile["package"]:
-        name = pkg["name"]
-
-        try:
-            missing.remove(name)
-        except KeyError:
-            is_required = False
-        else:
-            is_required = True
-
-        is_optional = (not is_required) and name in optional
+    for pkg in locked:
+        name = pkg.name
+        is_required = pkg.key in required_keys
+        missing.pop(pkg.key, None)
+        # Of a package locked at several versions, only the one for the target is installed
+        is_target = pkg in targets
 
         # TODO unlike Poetry, PDM doesn't annotate the lockfile with dependencies' categories.
         # So we can't verify that required packages aren't dev or optional deps.
 
         # Validate that we'll be able to install it, and ge the pip install arg if necessary.
 
-        # But only for required packages, so as to not be too strict.
-        if not (is_required or is_optional):
+        # But only for packages we install, so as to not be too strict.
+        if not is_target:
             continue
 
-        if "path" in pkg and is_required:
+        if pkg.source == "directory" and is_required:
             raise NotImplementedError(
                 f"Required package {name!r} is installed as a path dependency. "
                 "Uploading of local code is not supported yet. Please install from "
                 "a Git URL, or use a version on PyPi."
             )
 
-        if git_url := pkg.get("git"):
-            # TODO what do other sources besides Git look like?
-            pip_arg = f"git+{git_url}@{pkg['revision']}"
-        else:
-            pip_arg = f"{name}=={pkg['version']}"
-
-        (pip_overrides if name in overrides else pip_args).append(pip_arg)
+        # TODO what do other sources besides Git look like?
+        (pip_overrides if pkg.key in override_keys else pip_args).extend(
+            [pkg.pip_arg] if is_required else pkg.pip_args(targets[pkg])
+        )
 
     if missing:
-        missing = sorted(missing)
+        names = sorted(missing.values())
         raise ValueError(
-            f"Required packages {missing} are not dependencies of your environment. "
+            f"Required packages {names} are not dependencies of your environment. "
             "These packages must be installed to create a dask cluster. "
-            f"Run `pdm add {' '.join(missing)}` to install them."
+            f"Run `pdm add {' '.join(names)}` to install them."
         )
 
     assert not any(
         " " in o for o in overrides
     ), f"Overrides will fail; `sh` does not support arrays containing spaces: {overrides}"
     return pip_args, pip_overrides
+
+
+def locked_versions_pdm(
+    lockfile: dict[str, Any] | Lockfile,
+    environment: Mapping[str, str] | None = None,
+    requirements: Mapping[str, str | None] | None = None,
+) -> dict[str, str]:
+    """
+    Every package PDM will install on the cluster, by normalized name.
+
+    Versions are in the form `sneks.plugin.installed_distributions` reports them: the version
+    number for packages from an index, ``git+<url>@<commit>`` for packages from Git.
+
+    Packages locked at several versions are given at the one for ``environment`` (as from
+    `sneks.platforms.marker_environment`), and left out if none applies there. Without an
+    environment, at the highest version.
+
+    Given the project's direct dependencies ``requirements`` (as from
+    `sneks.lockfile.project_dependencies`) and an ``environment``, only what installing them
+    there pulls in: not packages only needed on other platforms, or by dev dependencies.
+    The plugin compares that to what's installed to skip installing (see
+    `sneks.plugin.DepManagerBase`), so it mustn't list anything ``pdm sync --prod`` leaves out.
+
+    Without ``requirements``, this includes dev dependencies too, unless the lockfile records
+    each package's groups (see `records_groups_pdm`).
+    """
+    locked = as_lockfile(lockfile, "pdm")
+    if requirements is not None and environment is not None:
+        return {
+            pkg.key: pkg.installed_version
+            for pkg in locked.installed(requirements, environment)
+        }
+    versions = {}
+    for key in locked.index:
+        pkg = locked.get(key, environment)
+        if pkg is not None and not pkg.dev:
+            versions[key] = pkg.installed_version
+    return versions
+
+
+def records_groups_pdm(lockfile: dict[str, Any]) -> bool:
+    """
+    Whether a parsed ``pdm.lock`` says which dependency groups each package is for.
+
+    PDM only writes that with the ``inherit_metadata`` lock strategy (the default since 2.12).
+    Otherwise there's no telling dev dependencies apart from the rest.
+    """
+    return all("groups" in pkg for pkg in lockfile.get("package", []))
+
+
+def locked_hashes_pdm(lockfile: dict[str, Any] | Lockfile) -> dict[str, list[str]]:
+    """
+    Hashes of the files each package in the lockfile may be installed from, by normalized name.
+
+    For packages locked at several versions, the files of all of them.
+    """
+    hashes: dict[str, list[str]] = {}
+    for pkg in as_lockfile(lockfile, "pdm"):
+        hashes.setdefault(pkg.key, []).extend(h for _, h in pkg.files if h)
+    return hashes
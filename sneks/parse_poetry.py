@@ -1,36 +1,44 @@
 from __future__ import annotations
 
-from typing import AbstractSet, Any
+from typing import AbstractSet, Any, Iterable, Mapping
+
+from sneks.lockfile import Lockfile, as_lockfile
+from sneks.names import normalize_name
 
 
 def current_versions_poetry(
     required: AbstractSet[str],
     optional: AbstractSet[str],
-    lockfile: dict[str, Any],
+    lockfile: dict[str, Any] | Lockfile,
     pyproject: dict[str, Any],
+    environments: Iterable[Mapping[str, str]] = (),
 ) -> tuple[list[str], list[str]]:
     """
     Determine what versions of required and optional packages are installed by parsing the lockfile
 
-    Returns arguments to ``pip install`` to install those packages.
+    Returns arguments to ``pip install`` to install those packages, and all their dependencies
+    (transitively) that the lockfile installs.
+
+    If given ``environments`` (as from `sneks.platforms.marker_environment`), dependencies are
+    only included where their markers apply, with a ``platform_machine`` marker if that's only
+    some of the environments.
 
     Also validates that all dependencies in the lockfile will be installable on the cluster (no path deps, for example).
     """
-    missing = set(required)
+    locked = as_lockfile(lockfile, "poetry")
+    required_keys = {normalize_name(r): r for r in required}
+    # Everything the required and optional packages need, so it's all installed at boot
+    targets = locked.targets([*required, *optional], environments)
+    missing = dict(required_keys)
     pip_args: list[str] = []
-    for pkg in lockfile["package"]:
-        name = pkg["name"]
-
-        try:
-            missing.remove(name)
-        except KeyError:
-            is_required = False
-        else:
-            is_required = True
-
-        is_optional = (not is_required) and name in optional
+    for pkg in locked:
+        name = pkg.name
+        is_required = pkg.key in required_keys
+        missing.pop(pkg.key, None)
+        # Of a package locked at several versions, only the one for the target is installed
+        is_target = pkg in targets
 
-        if pkg.get("category", "") == "dev":
+        if pkg.dev:
             if is_required:
                 raise ValueError(
                     f"Required package {name} is only a dev dependency. "
@@ -41,7 +49,7 @@ def current_versions_poetry(
                 )
             continue
 
-        if pkg.get("optional", False):
+        if pkg.optional:
             if is_required:
                 raise NotImplementedError(
                     f"Required package {name} is only an optional dependency. "
@@ -54,37 +62,79 @@ def current_versions_poetry(
         # Reached here - package will be installed on cluster.
         # Validate that we'll be able to install it, and get the pip install arg if necessary.
 
-        if source := pkg.get("source"):
-            if (stype := source["type"]) != "git":
-                if stype == "directory":
+        if pkg.source is not None:
+            if pkg.source != "git":
+                if pkg.source == "directory":
                     raise NotImplementedError(
                         f"Package {name!r} is installed as a path dependency. "
                         "Uploading of local code is not supported yet. Please install from "
                         "a Git URL, or use a version on PyPi."
                     )
                 raise NotImplementedError(
-                    f"Unsupported package source type {source['type']!r} for {name}. "
-                    f"Please open an issue.\n{source=}"
+                    f"Unsupported package source type {pkg.source!r} for {name}. "
+                    f"Please open an issue.\nsource={pkg.url!r}"
                 )
-            if "subdirectory" in source:
+            if pkg.subdirectory is not None:
                 raise NotImplementedError(
                     "Subdirectory syntax of git repos not supported yet; "
                     "please open an issue."
                 )
-            # From git
-            if is_required or is_optional:
-                pip_args.append(f"git+{source['url']}@{source['resolved_reference']}")
-        else:
-            # From PyPi
-            if is_required or is_optional:
-                pip_args.append(f"{name}=={pkg['version']}")
+        if is_target:
+            pip_args.extend(
+                [pkg.pip_arg] if is_required else pkg.pip_args(targets[pkg])
+            )
 
     if missing:
-        missing = sorted(missing)
+        names = sorted(missing.values())
         raise ValueError(
-            f"Required packages {missing} are not dependencies of your environment. "
+            f"Required packages {names} are not dependencies of your environment. "
             "These packages must be installed to create a dask cluster. "
-            f"Run `poetry add {' '.join(missing)}` to install them."
+            f"Run `poetry add {' '.join(names)}` to install them."
         )
 
     return pip_args, []
+
+
+def locked_versions_poetry(
+    lockfile: dict[str, Any] | Lockfile,
+    environment: Mapping[str, str] | None = None,
+    requirements: Mapping[str, str | None] | None = None,
+) -> dict[str, str]:
+    """
+    Every package Poetry will install on the cluster, by normalized name.
+
+    Versions are in the form `sneks.plugin.installed_distributions` reports them: the version
+    number for packages from an index, ``git+<url>@<commit>`` for packages from Git.
+
+    Packages locked at several versions are given at the one for ``environment`` (as from
+    `sneks.platforms.marker_environment`), and left out if none applies there. Without an
+    environment, at the highest version.
+
+    Given the project's direct dependencies ``requirements`` (as from
+    `sneks.lockfile.project_dependencies`) and an ``environment``, only what installing them
+    there pulls in: not packages only needed on other platforms, or by dev dependencies.
+    """
+    locked = as_lockfile(lockfile, "poetry")
+    if requirements is not None and environment is not None:
+        return {
+            pkg.key: pkg.installed_version
+            for pkg in locked.installed(requirements, environment)
+        }
+    versions = {}
+    for key in locked.index:
+        pkg = locked.get(key, environment)
+        if pkg is not None and not (pkg.dev or pkg.optional):
+            versions[key] = pkg.installed_version
+    return versions
+
+
+def locked_hashes_poetry(lockfile: dict[str, Any] | Lockfile) -> dict[str, list[str]]:
+    """
+    Hashes of the files each package in the lockfile may be installed from, by normalized name.
+
+    For packages locked at several versions, the files of all of them.
+    """
+    hashes: dict[str, list[str]] = {}
+    for pkg in as_lockfile(lockfile, "poetry"):
+        hashes.setdefault(pkg.key, []).extend(h for _, h in pkg.files if h)
+    return hashes
@@ -0,0 +1,96 @@
+"""
+Figure out what platform a cluster will run on, so we can get wheels for it on the client.
+
+The sneks images are built for both x86_64 and aarch64 (see the README), so which one a
+cluster uses depends only on the instance types it's given, for the scheduler and the workers.
+"""
+from __future__ import annotations
+
+import re
+import sys
+from typing import Any, Iterable
+
+# AWS Graviton: a family, a generation number, then ``g`` (``m6g``, ``c7gn``, ``t4g``, ``r6gd``)
+_AWS_ARM = re.compile(r"^[a-z]+\d+g[a-z]*\.", re.IGNORECASE)
+# GCP Tau T2A
+_GCP_ARM = re.compile(r"^t2a-", re.IGNORECASE)
+
+# glibc in the sneks images. They're built on ``python:<version>`` (see
+# ``senv/make-docker-images.py``), which is Debian bookworm. Bump this if the base image changes.
+IMAGE_GLIBC = (2, 36)
+# Every ``manylinux_2_*`` tag a wheel built for that glibc or older could have, newest first,
+# down to manylinux2014 (glibc 2.17), which `platform_tags` adds under its legacy name too.
+_MANYLINUX_MINORS = range(IMAGE_GLIBC[1], 16, -1)
+
+
+def instance_arch(vm_type: str) -> str:
+    "CPU architecture of an AWS or GCP instance type: ``aarch64`` or ``x86_64``"
+    if _AWS_ARM.match(vm_type) or _GCP_ARM.match(vm_type):
+        return "aarch64"
+    return "x86_64"
+
+
+def _vm_archs(cluster_kwargs: dict[str, Any], kwarg: str) -> set[str]:
+    "CPU architectures of the VM types in ``cluster_kwargs[kwarg]``; x86_64 if there are none"
+    vm_types: Iterable[str] = cluster_kwargs.get(kwarg) or []
+    if isinstance(vm_types, str):
+        vm_types = [vm_types]
+    return {instance_arch(t) for t in vm_types} or {"x86_64"}
+
+
+def cluster_archs(cluster_kwargs: dict[str, Any]) -> list[str]:
+    """
+    Every CPU architecture the scheduler or workers may have, given the arguments to `coiled.Cluster`.
+
+    Without explicit VM types, Coiled picks x86_64 instances.
+    """
+    return sorted(
+        _vm_archs(cluster_kwargs, "worker_vm_types")
+        | _vm_archs(cluster_kwargs, "scheduler_vm_types")
+    )
+
+
+def cluster_arch(cluster_kwargs: dict[str, Any]) -> str:
+    "The one CPU architecture the workers will have. Raises if the VM types mix architectures."
+    archs = _vm_archs(cluster_kwargs, "worker_vm_types")
+    if len(archs) > 1:
+        vm_types = cluster_kwargs.get("worker_vm_types")
+        raise ValueError(
+            f"Worker VM types {vm_types} mix CPU architectures; "
+            "a wheelhouse can only target one"
+        )
+    return archs.pop()
+
+
+def platform_tags(arch: str) -> list[str]:
+    "Wheel platform tags for Linux on ``arch``, for ``pip download --platform``"
+    tags = [f"manylinux_2_{minor}_{arch}" for minor in _MANYLINUX_MINORS]
+    tags.append(f"manylinux2014_{arch}")
+    if arch == "x86_64":
+        tags += ["manylinux2010_x86_64", "manylinux1_x86_64"]
+    return tags
+
+
+def python_tag() -> str:
+    "The cluster runs the same Python version as the client (see `sneks.get_client._senv_spec`)"
+    return f"{sys.version_info.major}{sys.version_info.minor}"
+
+
+def marker_environment(arch: str) -> dict[str, str]:
+    "PEP 508 environment marker variables on a cluster machine with CPU architecture ``arch``"
+    # The cluster runs the same Python version as the client (see `python_tag`)
+    v = sys.version_info
+    full = f"{v.major}.{v.minor}.{v.micro}"
+    return {
+        "implementation_name": "cpython",
+        "implementation_version": full,
+        "os_name": "posix",
+        "platform_machine": arch,
+        "platform_python_implementation": "CPython",
+        "platform_release": "",
+        "platform_system": "Linux",
+        "platform_version": "",
+        "python_full_version": full,
+        "python_version": f"{v.major}.{v.minor}",
+        "sys_platform": "linux",
+    }
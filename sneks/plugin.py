@@ -1,40 +1,234 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import functools
 import gzip
+import hashlib
 import importlib
+import importlib.metadata
+import io
+import json
 import logging
 import os
+import platform
+import re
 import shutil
 import sys
+import tarfile
+import tempfile
+import time
+import uuid
+import zlib
 from abc import ABC, abstractmethod
-from pathlib import Path
+from collections import deque
+from pathlib import Path, PurePosixPath
 from subprocess import CalledProcessError
-from typing import TYPE_CHECKING, ClassVar
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    ClassVar,
+    Coroutine,
+    NamedTuple,
+)
 
-import cloudpickle
+import psutil
 from distributed.compatibility import to_thread  # type: ignore
-from distributed.diagnostics.plugin import NannyPlugin
+from distributed.diagnostics.plugin import NannyPlugin, SchedulerPlugin
 
 if TYPE_CHECKING:
     from distributed.nanny import Nanny
+    from distributed.scheduler import Scheduler
 
 logger = logging.Logger(__name__)
 
+INSTALL_EVENT_TOPIC = "sneks-install"
+"Scheduler event topic each nanny reports its installation to"
+INSTALL_MARKER_NAME = "sneks-installed.json"
+"File in the environment recording what was last installed into it"
+INSTALL_LOCK_NAME = ".sneks-install.lock"
+"Lockfile in the environment, so only one nanny per machine installs into it at once"
+TOOL_CACHE_NAMESPACE = "tool-cache"
+"`ArtifactStore` namespace for files from Poetry/PDM's download caches, by path relative to home"
+ENVIRONMENT_NAMESPACE = "environments"
+"`ArtifactStore` namespace for gzipped pyproject and lockfiles, by environment digest and filename"
+WHEELHOUSE_NAMESPACE = "wheelhouse"
+"`ArtifactStore` namespace for wheels built on the client (see `sneks.wheelhouse`)"
+ARTIFACT_CHUNK_SIZE = 16 * 2**20
+"Max bytes per message when transferring artifacts to and from the scheduler"
+INSTALL_OUTPUT_TOPIC = "sneks-install-output"
+"Scheduler event topic nannies stream installer output to, in batches of lines"
+OUTPUT_TAIL_LINES = 200
+"Lines of each output stream to keep for the `CalledProcessError` if a command fails"
+OUTPUT_FLUSH_INTERVAL = 0.5
+"Max seconds installer output is buffered before it's sent to the scheduler"
+PACKED_ENV_NAMESPACE = "packed-env"
+"`ArtifactStore` namespace for environments packed by one nanny for the others (see `pack_environment`)"
+PACKED_ENV_TIMEOUT = 30 * 60
+"Seconds to wait for another nanny to pack the environment before installing it ourselves"
+INSTALL_LIMITER = "install"
+"`SlotLimiter` for installs, so the package index doesn't get every worker at once"
+INSTALL_SLOT_TIMEOUT = 30 * 60
+"Seconds after which an install slot is released anyway, in case the nanny died"
+RESTART_LIMITER = "restart"
+"`SlotLimiter` for rolling restarts. A nanny's slot is released when its worker rejoins."
+RESTART_SLOT_TIMEOUT = 300
+"Seconds after which a restart slot is released anyway, in case the worker never comes back"
+CACHE_SEEDED_PREFIX = ".sneks-seeded/"
+"Paths in `TOOL_CACHE_NAMESPACE` marking that the first nanny to install an environment has shared its downloads"
+CACHE_SEED_TIMEOUT = 10 * 60
+"Seconds to wait for the first nanny to share its downloads before downloading from the index ourselves"
 
-class DepManagerBase(NannyPlugin, ABC):
+
+# Run on the cluster to unpickle a `PickleByValue` object, with the names below as globals.
+# Only uses the standard library, since that's all we can count on being there.
+_BOOTSTRAP = """
+def _restore():
+    import sys, types, zlib
+    module = sys.modules.get(MODULE)
+    if module is None:
+        module = types.ModuleType(MODULE)
+        module._COMPRESSED_SOURCE = SOURCE
+        sys.modules[MODULE] = module
+        try:
+            exec(compile(zlib.decompress(SOURCE), MODULE, "exec"), module.__dict__)
+        except BaseException:
+            del sys.modules[MODULE]
+            raise
+    cls = getattr(module, CLASS)
+    obj = cls.__new__(cls)
+    obj.__dict__.update(STATE)
+    return obj
+"""
+_BOOTSTRAP_EXPR = "exec(BOOTSTRAP, globals()) or _restore()"
+
+
+@functools.lru_cache(maxsize=None)
+def _module_source(module_name: str) -> tuple[str, bytes]:
+    "Synthetic module name and compressed source for a module, to send to the cluster"
+    module = sys.modules[module_name]
+    if (compressed := getattr(module, "_COMPRESSED_SOURCE", None)) is None:
+        # Deterministic: the same source always compresses to the same bytes
+        compressed = zlib.compress(Path(module.__file__).read_bytes(), 9)
+        # Name by content, so different versions of this file can coexist in one process
+        name = f"_sneks_plugin_{hashlib.sha256(compressed).hexdigest()[:16]}"
+    else:
+        # Already running from a synthetic module
+        name = module_name
+    return name, compressed
+
+
+class PickleByValue:
+    """
+    Mixin making plugins unpickleable on the cluster without ``sneks`` installed there.
+
+    The pickle holds this module's source (compressed) and the object's ``__dict__``. On
+    unpickling, a small bootstrap runs the source as a new module (once per process) and
+    rebuilds the object from its class there. Since this is plain `pickle` (through
+    ``__reduce__``), it doesn't rely on `distributed.protocol.pickle.dumps` falling back to
+    ``cloudpickle``, and pickling the same object twice gives the same bytes.
+
+    Everything the module needs on the cluster must be importable there, or be in this file.
+    """
+
+    _local_only: ClassVar[frozenset[str]] = frozenset()
+    "Attributes that stay on the client, and aren't pickled"
+
+    def __reduce__(self) -> tuple[Callable, tuple]:
+        module, source = _module_source(type(self).__module__)
+        state = {k: v for k, v in self.__dict__.items() if k not in self._local_only}
+        namespace = {
+            "BOOTSTRAP": _BOOTSTRAP,
+            "MODULE": module,
+            "SOURCE": source,
+            "CLASS": type(self).__qualname__,
+            "STATE": state,
+        }
+        return eval, (_BOOTSTRAP_EXPR, namespace)
+
+
+class DepManagerBase(PickleByValue, NannyPlugin, ABC):
     name: str = "DepManager"
     # ^ There should only ever be one instance of this plugin on a cluster at once.
     # So we always use the same name.
-    _compressed_lockfile: bytes
     restart: ClassVar[bool] = False
+    _local_only = frozenset(["_payload"])
+    _payload: dict[str, bytes] | None = None
+    "Gzipped pyproject and lockfile by filename. Only on the client; nannies fetch them by digest."
 
     LOCKFILE_NAME: ClassVar[str]
     TOOL_NAME: ClassVar[str]
+    CACHE_DIRS: ClassVar[tuple[str, ...]] = ()
+    "Directories under the home directory where the tool caches downloads, in a host-independent layout"
+    _output: OutputForwarder | None = None
+
+    def __init__(
+        self,
+        pyproject: bytes,
+        lockfile: bytes,
+        locked: dict[str, dict[str, str]] | None = None,
+    ) -> None:
+        """
+        ``locked`` is every package the lockfile will install on each CPU architecture (as
+        `platform.machine` names it), by normalized name, in the form `installed_distributions`
+        uses. If given, and the environment already has all of them, we skip running the tool.
+        """
+        self._init(
+            {
+                "pyproject.toml": gzip.compress(pyproject),
+                self.LOCKFILE_NAME: gzip.compress(lockfile),
+            },
+            environment_digest(self.TOOL_NAME, pyproject, lockfile),
+            locked,
+        )
+
+    @classmethod
+    def from_payload(
+        cls,
+        payload: dict[str, bytes],
+        digest: str,
+        locked: dict[str, dict[str, str]] | None = None,
+    ) -> DepManagerBase:
+        """
+        Make a plugin from an already-gzipped pyproject and lockfile, and their `environment_digest`.
+
+        Skips compressing and hashing them again, for `sneks.compat.get_backend`'s parse cache.
+        """
+        self = cls.__new__(cls)
+        self._init(payload, digest, locked)
+        return self
 
-    def __init__(self, pyproject: bytes, lockfile: bytes) -> None:
-        self._compressed_pyproject = gzip.compress(pyproject)
-        self._compressed_lockfile = gzip.compress(lockfile)
+    def _init(
+        self,
+        payload: dict[str, bytes],
+        digest: str,
+        locked: dict[str, dict[str, str]] | None,
+    ) -> None:
+        self.locked = locked
+        self._payload = payload
+        # Identifies the environment this plugin installs
+        self.digest = digest
+        # Identifies this registration in install events
+        self.token = uuid.uuid4().hex
+        # Wheels to install from the scheduler's `ArtifactStore` instead of the package index,
+        # by path in `WHEELHOUSE_NAMESPACE`. Set by the client; see `sneks.wheelhouse`.
+        self.wheelhouse: list[str] | None = None
+        # Whether the wheelhouse covers every locked package, so the tool needn't run at all
+        self.wheelhouse_complete = False
+        # If set, at most this fraction of workers restart at once (see `DepManagerWatcher`).
+        # Set by the client from the ``sneks.rolling-restart`` config.
+        self.rolling_restart: float | None = None
+        # Move the worker's data to other workers before restarting it.
+        # Set by the client from the ``sneks.preserve-data`` config.
+        self.preserve_data = False
+        # One nanny installs and packs the environment; the rest unpack it.
+        # Set by the client from the ``sneks.packed-env`` config.
+        self.packed_env = False
+        # If set, at most this many nannies install at once, across the cluster.
+        # Set by the client from the ``sneks.max-concurrent-installs`` config.
+        self.max_concurrent_installs: int | None = None
 
     def get_tool_path(self) -> Path:
         "Get path to the installation tool"
@@ -52,27 +246,522 @@ class DepManagerBase(NannyPlugin, ABC):
         return
 
     @abstractmethod
-    async def install(self, *, tool_path: Path, workdir: Path) -> bool:
-        "Do installation, return whether to restart"
+    async def install(self, *, tool_path: Path, workdir: Path) -> None:
+        "Do installation"
         raise NotImplementedError
 
-    async def setup(self, nanny: Nanny) -> None:
+    def get_tool_version(self, tool_path: Path) -> str:
+        "Version of the installation tool, found without paying to start it up"
+        # Poetry and PDM live in their own venvs (see `senv/Dockerfile`); read their metadata there.
+        name = self.TOOL_NAME.lower()
+        venv = tool_path.resolve().parent.parent
+        for dist_info in venv.glob(f"lib/python*/site-packages/{name}-*.dist-info"):
+            # `poetry-1.2.3.dist-info` -> `1.2.3`
+            return dist_info.name.split("-", 1)[1].rsplit(".", 1)[0]
+        return "unknown"
+
+    def install_digest(self, tool_path: Path) -> str:
+        "Digest of everything that determines what an install would do"
+        h = hashlib.sha256(self.digest.encode())
+        h.update(self.get_tool_version(tool_path).encode())
+        h.update(sys.version.encode())
+        return h.hexdigest()
+
+    async def upload(self, scheduler: Any) -> None:
+        """
+        Store the pyproject and lockfile on the scheduler, given an rpc to it, so nannies can fetch them.
+
+        Call from the client, after registering `DepManagerWatcher` and before registering this plugin.
+        """
+        assert self._payload is not None, "Can only upload from the client"
+        manifest = await scheduler.sneks_artifacts(namespace=ENVIRONMENT_NAMESPACE)
+        if manifest is None:
+            raise RuntimeError("DepManagerWatcher is not registered on the scheduler")
+        for filename, data in self._payload.items():
+            path = f"{self.digest}/{filename}"
+            if path not in manifest:
+                await upload_artifact(scheduler, ENVIRONMENT_NAMESPACE, path, data)
+
+    async def fetch_payload(self, nanny: Nanny) -> dict[str, bytes]:
+        "Get the gzipped pyproject and lockfile by filename, from the scheduler or the local cache"
+        cache = Path(sys.prefix) / ".sneks-environments" / self.digest
+        filenames = ["pyproject.toml", self.LOCKFILE_NAME]
+        if missing := [f for f in filenames if not (cache / f).exists()]:
+            manifest = await nanny.scheduler.sneks_artifacts(
+                namespace=ENVIRONMENT_NAMESPACE
+            )
+            for filename in missing:
+                path = f"{self.digest}/{filename}"
+                if not manifest or path not in manifest:
+                    raise RuntimeError(
+                        f"{filename} for environment {self.digest} is not on the scheduler. "
+                        "Call `DepManagerBase.upload` before registering the plugin."
+                    )
+                await fetch_artifact(
+                    nanny.scheduler,
+                    ENVIRONMENT_NAMESPACE,
+                    path,
+                    manifest[path],
+                    cache / filename,
+                )
+        return {f: (cache / f).read_bytes() for f in filenames}
+
+    def cache_files(self) -> dict[str, Path]:
+        "Files in the tool's download caches, by path relative to the home directory"
+        home = Path.home()
+        files: dict[str, Path] = {}
+        for cache_dir in self.CACHE_DIRS:
+            for path in (home / cache_dir).rglob("*"):
+                if path.suffix not in (".lock", ".part") and path.is_file():
+                    files[path.relative_to(home).as_posix()] = path
+        return files
+
+    async def pull_cache(
+        self, nanny: Nanny, report: dict[str, Any]
+    ) -> dict[str, int] | None:
+        """
+        Download everything other nannies have put in the scheduler's copy of the tool cache.
+
+        Returns the scheduler's manifest, or None if the scheduler doesn't have an `ArtifactStore`.
+        """
+        manifest = await nanny.scheduler.sneks_artifacts(namespace=TOOL_CACHE_NAMESPACE)
+        if manifest is None:
+            # No handler; `DepManagerWatcher` isn't registered
+            return None
+
+        home = Path.home()
+        missing = {
+            path: size
+            for path, size in manifest.items()
+            if path.startswith(tuple(self.CACHE_DIRS)) and not (home / path).exists()
+        }
+        limit = asyncio.Semaphore(8)
+
+        async def fetch(path: str, size: int) -> None:
+            async with limit:
+                try:
+                    await fetch_artifact(
+                        nanny.scheduler, TOOL_CACHE_NAMESPACE, path, size, home / path
+                    )
+                except OSError as e:
+                    # The tool will just download it itself
+                    print(f"Failed to fetch {path} from the scheduler: {e}")
+                    missing.pop(path)
+
+        await asyncio.gather(
+            *(fetch(path, size) for path, size in list(missing.items()))
+        )
+        report["cache_fetched"] = sum(missing.values())
+        print(
+            f"Fetched {len(missing)} cached artifact(s) "
+            f"({report['cache_fetched'] / 2**20:.1f} MiB) from the scheduler"
+        )
+        return manifest
+
+    def cache_seed_key(self, tool_path: Path) -> str:
+        "Identifies who downloads this environment from the index first; see `wait_for_cache`"
+        h = hashlib.sha256(self.install_digest(tool_path).encode())
+        h.update(platform.machine().encode())
+        return h.hexdigest()
+
+    async def wait_for_cache(self, nanny: Nanny, key: str) -> bool:
+        """
+        Wait for the first nanny to install this environment to share its downloads, or be that nanny.
+
+        Otherwise, on a fresh cluster every nanny would find the scheduler's cache empty, and
+        download everything from the package index at once. Returns whether we're the first,
+        and so must `push_cache` with ``seeded=key`` once we've installed.
+        """
+        marker = f"{CACHE_SEEDED_PREFIX}{key}"
+        deadline = time.monotonic() + CACHE_SEED_TIMEOUT
+        while True:
+            manifest = await nanny.scheduler.sneks_artifacts(
+                namespace=TOOL_CACHE_NAMESPACE
+            )
+            if manifest is None or marker in manifest:
+                return False
+            leader = await nanny.scheduler.sneks_claim(key=key, holder=nanny.address)
+            if leader == nanny.address:
+                print("Downloading packages from the index to share with other workers")
+                return True
+            if time.monotonic() > deadline:
+                print(f"Gave up waiting for {leader} to share its downloads")
+                return False
+            await asyncio.sleep(1)
+
+    async def push_cache(self, nanny: Nanny, seeded: str | None = None) -> None:
+        """
+        Upload anything in our tool cache that the scheduler doesn't have yet.
+
+        With ``seeded`` (a `cache_seed_key`), then mark the cache as complete for nannies
+        waiting in `wait_for_cache`, or if uploading fails, let one of them take over.
+        """
+        try:
+            # Other nannies may have uploaded the same files while we were installing
+            manifest = await nanny.scheduler.sneks_artifacts(
+                namespace=TOOL_CACHE_NAMESPACE
+            )
+            new = {
+                path: file
+                for path, file in self.cache_files().items()
+                if path not in (manifest or {})
+            }
+            for path, file in new.items():
+                await upload_artifact(nanny.scheduler, TOOL_CACHE_NAMESPACE, path, file)
+            if new:
+                print(f"Uploaded {len(new)} new cached artifact(s) to the scheduler")
+            if seeded is not None:
+                await upload_artifact(
+                    nanny.scheduler,
+                    TOOL_CACHE_NAMESPACE,
+                    f"{CACHE_SEEDED_PREFIX}{seeded}",
+                    b"",
+                )
+        except OSError as e:
+            print(f"Failed to upload the tool cache to the scheduler: {e}")
+            if seeded is not None:
+                await nanny.scheduler.sneks_unclaim(key=seeded, holder=nanny.address)
+
+    async def install_wheelhouse(self, nanny: Nanny, report: dict[str, Any]) -> None:
+        "Fetch the client's wheels from the scheduler and install them without touching an index"
+        assert self.wheelhouse is not None
+        manifest = await nanny.scheduler.sneks_artifacts(namespace=WHEELHOUSE_NAMESPACE)
+        if manifest is None:
+            raise RuntimeError("DepManagerWatcher is not registered on the scheduler")
+        # Shared by every nanny on the machine, and across restarts
+        root = Path(sys.prefix) / ".sneks-wheelhouse"
+        wheels = [root / path for path in self.wheelhouse]
+        fetch = [
+            (path, wheel)
+            for path, wheel in zip(self.wheelhouse, wheels)
+            if not wheel.exists()
+        ]
+        for path, wheel in fetch:
+            await fetch_artifact(
+                nanny.scheduler, WHEELHOUSE_NAMESPACE, path, manifest[path], wheel
+            )
+        report["wheelhouse_fetched"] = sum(manifest[path] for path, _ in fetch)
+
+        await self.run(
+            sys.executable,
+            "-m",
+            "pip",
+            "install",
+            "--no-index",
+            "--no-deps",
+            "--disable-pip-version-check",
+            *map(str, wheels),
+        )
+
+    def locked_here(self) -> dict[str, str] | None:
+        "The packages `locked` for this machine's CPU architecture, if known"
+        return self.locked.get(platform.machine()) if self.locked else None
+
+    async def install_environment(
+        self,
+        nanny: Nanny,
+        tool_path: Path,
+        lap: Callable[[str], None],
+        report: dict[str, Any],
+        previous: dict[str, Any] | None = None,
+    ) -> EnvironmentDiff:
+        """
+        Install the locked environment, returning what changed.
+
+        ``previous`` is the install marker from the last install into this environment, if any
+        (see `read_install_marker`). Packages it locked that this lockfile doesn't are removed,
+        so they still need the tool to run, even if every locked package is already there.
+        """
+        before = installed_distributions()
+        locked = self.locked_here()
+        if locked is not None and not diff_environments(before, locked).needs_install:
+            if previous is None:
+                leftovers = False
+            elif "locked" in previous:
+                leftovers = any(
+                    k in before and k not in locked for k in previous["locked"]
+                )
+            else:
+                # Installed without a record of what it locked; it may have left anything
+                leftovers = True
+            if not leftovers:
+                print("All locked packages already installed; skipping installation")
+                return EnvironmentDiff({}, {}, {})
+
+        if self.packed_env:
+            return await self.install_packed(nanny, tool_path, lap, report, before)
+        return await self.install_locally(nanny, tool_path, lap, report, before)
+
+    async def install_packed(
+        self,
+        nanny: Nanny,
+        tool_path: Path,
+        lap: Callable[[str], None],
+        report: dict[str, Any],
+        before: dict[str, str],
+    ) -> EnvironmentDiff:
+        """
+        Unpack the environment another nanny installed and packed, or be the one to install and pack it.
+
+        Archives are keyed by what's installed before and what's being installed, so they're only
+        unpacked onto environments identical to the one they were built on.
+        """
+        key = packed_env_key(self.install_digest(tool_path), before)
+        path = f"{key}.tar.gz"
+        archive = Path(nanny.local_directory) / path
+        deadline = time.monotonic() + PACKED_ENV_TIMEOUT
+        while True:
+            manifest = await nanny.scheduler.sneks_artifacts(
+                namespace=PACKED_ENV_NAMESPACE
+            )
+            if manifest is None:
+                # No `DepManagerWatcher` to coordinate through
+                return await self.install_locally(nanny, tool_path, lap, report, before)
+            if path in manifest:
+                await fetch_artifact(
+                    nanny.scheduler,
+                    PACKED_ENV_NAMESPACE,
+                    path,
+                    manifest[path],
+                    archive,
+                )
+                lap("fetch_packed")
+                await to_thread(unpack_environment, archive)
+                archive.unlink()
+                lap("unpack")
+                report["packed_env_fetched"] = manifest[path]
+                changes = diff_environments(before, installed_distributions())
+                print(f"Environment changes: {changes}")
+                return changes
+
+            leader = await nanny.scheduler.sneks_claim(key=key, holder=nanny.address)
+            if leader == nanny.address:
+                print("Installing the environment to pack for other workers")
+                try:
+                    changes = await self.install_locally(
+                        nanny, tool_path, lap, report, before
+                    )
+                    await to_thread(pack_environment, changes, archive)
+                    lap("pack")
+                    await upload_artifact(
+                        nanny.scheduler, PACKED_ENV_NAMESPACE, path, archive
+                    )
+                    archive.unlink()
+                    lap("upload_packed")
+                except BaseException:
+                    # Let someone else have a go
+                    await nanny.scheduler.sneks_unclaim(key=key, holder=nanny.address)
+                    raise
+                return changes
+
+            if time.monotonic() > deadline:
+                print(f"Gave up waiting for {leader} to pack the environment")
+                return await self.install_locally(nanny, tool_path, lap, report, before)
+            await asyncio.sleep(1)
+
+    @contextlib.asynccontextmanager
+    async def install_slot(
+        self, nanny: Nanny, lap: Callable[[str], None]
+    ) -> AsyncIterator[None]:
+        "Wait for the scheduler to let us install, if the number of concurrent installs is limited"
+        if self.max_concurrent_installs is None:
+            yield
+            return
+        print("Waiting for an install slot")
+        await nanny.scheduler.sneks_acquire(
+            limiter=INSTALL_LIMITER,
+            holder=nanny.address,
+            count=self.max_concurrent_installs,
+            timeout=INSTALL_SLOT_TIMEOUT,
+        )
+        lap("install_wait")
+        try:
+            yield
+        finally:
+            await nanny.scheduler.sneks_release(
+                limiter=INSTALL_LIMITER, holder=nanny.address
+            )
+
+    async def install_locally(
+        self,
+        nanny: Nanny,
+        tool_path: Path,
+        lap: Callable[[str], None],
+        report: dict[str, Any],
+        before: dict[str, str],
+    ) -> EnvironmentDiff:
+        "Install the locked environment on this machine, returning what changed"
+        async with self.install_slot(nanny, lap):
+            return await self._install_locally(nanny, tool_path, lap, report, before)
+
+    async def _install_locally(
+        self,
+        nanny: Nanny,
+        tool_path: Path,
+        lap: Callable[[str], None],
+        report: dict[str, Any],
+        before: dict[str, str],
+    ) -> EnvironmentDiff:
+        if self.wheelhouse is not None:
+            await self.install_wheelhouse(nanny, report)
+            lap("wheelhouse")
+            if self.wheelhouse_complete:
+                changes = diff_environments(before, installed_distributions())
+                print(f"Environment changes: {changes}")
+                return changes
+
+        seed_key = self.cache_seed_key(tool_path)
+        seeding = await self.wait_for_cache(nanny, seed_key)
+        lap("cache_wait")
+        try:
+            return await self.install_with_tool(
+                nanny, tool_path, lap, report, before, seed_key if seeding else None
+            )
+        except BaseException:
+            if seeding:
+                # Let one of the nannies waiting for us download it instead
+                await nanny.scheduler.sneks_unclaim(key=seed_key, holder=nanny.address)
+            raise
+
+    async def install_with_tool(
+        self,
+        nanny: Nanny,
+        tool_path: Path,
+        lap: Callable[[str], None],
+        report: dict[str, Any],
+        before: dict[str, str],
+        seeded: str | None,
+    ) -> EnvironmentDiff:
+        "Run the tool, sharing its download cache through the scheduler. ``seeded`` is for `push_cache`."
+        # Get whatever other workers have already downloaded from the scheduler, so the
+        # tool finds it in its cache instead of downloading it from the package index.
+        manifest = await self.pull_cache(nanny, report)
+        cached = set(self.cache_files())
+        lap("pull_cache")
+
         workdir = Path(nanny.local_directory)
         pyproject_path = workdir / "pyproject.toml"
         lockfile_path = workdir / self.LOCKFILE_NAME
+        payload = await self.fetch_payload(nanny)
         await asyncio.gather(
-            write_compressed_file(self._compressed_pyproject, pyproject_path),
-            write_compressed_file(self._compressed_lockfile, lockfile_path),
+            write_compressed_file(payload["pyproject.toml"], pyproject_path),
+            write_compressed_file(payload[self.LOCKFILE_NAME], lockfile_path),
         )
+        lap("write")
+
+        await self.setup_tool(tool_path=tool_path, workdir=workdir)
+        lap("setup_tool")
+
+        await self.install(tool_path=tool_path, workdir=workdir)
+        changes = diff_environments(before, installed_distributions())
+        lap("install")
+        print(f"Environment changes: {changes}")
+        # Whatever's new in the tool's cache came from the package index
+        report["index_downloaded"] = sum(
+            file.stat().st_size
+            for path, file in self.cache_files().items()
+            if path not in cached
+        )
+
+        if manifest is not None:
+            # Share what we downloaded in the background; no need to hold up the restart.
+            # (Restarting only kills the worker process, not us.)
+            _background(self.push_cache(nanny, seeded))
+        return changes
+
+    async def setup(self, nanny: Nanny) -> None:
+        if getattr(nanny, "_sneks_token", None) == self.token:
+            # `DepManagerWatcher` may push us to a nanny that already got us another way
+            print(f"{self.name!r} already set up on this nanny")
+            return
 
-        # TODO skip installation and don't restart if there's already a lockfile and it's up to date.
+        durations: dict[str, float] = {}
+        start = last = time.perf_counter()
+
+        def lap(phase: str) -> None:
+            nonlocal last
+            now = time.perf_counter()
+            durations[phase] = now - last
+            last = now
 
         tool_path = self.get_tool_path().absolute()
         print(f"{self.TOOL_NAME} available at {tool_path}")
 
-        await self.setup_tool(tool_path=tool_path, workdir=workdir)
+        # The marker lives in the venv, since that's what the install actually changes,
+        # and it's shared by every nanny on the machine.
+        # (The nanny's local directory is new every time the nanny starts.)
+        marker_path = Path(sys.prefix) / INSTALL_MARKER_NAME
+        install_digest = self.install_digest(tool_path)
+        marker = read_install_marker(marker_path)
+        lap("check")
+
+        installed_here = False
+        changes = EnvironmentDiff({}, {}, {})
+        report: dict[str, Any] = {}
+        self._output = OutputForwarder(nanny, self.token)
+        if marker is not None and marker["digest"] == install_digest:
+            print("Environment already matches lockfile; skipping installation")
+        else:
+            # Nannies on the same machine share one environment. Only one of them should
+            # install into it; the rest wait, then find the install already done.
+            async with host_lock(Path(sys.prefix) / INSTALL_LOCK_NAME):
+                lap("wait")
+                marker = read_install_marker(marker_path)
+                if marker is not None and marker["digest"] == install_digest:
+                    print("Another nanny on this machine installed the environment")
+                else:
+                    changes = await self.install_environment(
+                        nanny, tool_path, lap, report, marker
+                    )
+                    marker = {
+                        "digest": install_digest,
+                        "installed_at": time.time(),
+                        "restart": changes.needs_restart,
+                    }
+                    if (locked := self.locked_here()) is not None:
+                        marker["locked"] = sorted(locked)
+                    write_install_marker(marker_path, marker)
+                    installed_here = True
+
+        # Brand-new packages can just be imported by the running worker. Only restart if
+        # something it may already have imported changed since it started.
+        restart = marker["restart"] and worker_started_before(
+            nanny, marker["installed_at"]
+        )
+        durations["total"] = last - start
+
+        if restart and self.rolling_restart is not None:
+            # Take turns restarting, so the cluster keeps most of its capacity.
+            # The slot is released once our new worker connects to the scheduler.
+            print("Waiting for a restart slot")
+            await nanny.scheduler.sneks_acquire(
+                limiter=RESTART_LIMITER,
+                holder=nanny.address,
+                fraction=self.rolling_restart,
+                timeout=RESTART_SLOT_TIMEOUT,
+            )
+            lap("restart_wait")
 
-        restart = await self.install(tool_path=tool_path, workdir=workdir)
+        if restart and self.preserve_data:
+            await self.retire_data(nanny)
+            lap("retire")
+
+        # HACK: remember on the nanny itself that we've been set up
+        nanny._sneks_token = self.token  # type: ignore[attr-defined]
+        nanny.log_event(
+            INSTALL_EVENT_TOPIC,
+            {
+                "token": self.token,
+                "nanny": nanny.address,
+                "durations": durations,
+                "skipped": not installed_here,
+                "changes": changes._asdict(),
+                "restarted": restart,
+                "tool": self.TOOL_NAME,
+                "tool_version": self.get_tool_version(tool_path),
+                **report,
+            },
+        )
         if not restart:
             print("No dependencies to install or update")
             return
@@ -83,38 +772,35 @@ class DepManagerBase(NannyPlugin, ABC):
         # not very trustworthy.
         await nanny.kill(timeout=30)
 
-    def __getstate__(self) -> dict:
+    async def retire_data(self, nanny: Nanny) -> None:
         """
-        Make this object unpickleable to dask without its package being installed on workers, via a horrible hack.
+        Have the scheduler copy the worker's in-memory data to other workers, so it survives the restart.
 
-        This avoids needing `sneks` to actually be installed on the cluster, just on the client side.
+        The worker stops getting new tasks, but stays connected until we kill it.
         """
-        # HACK, awful horrible hack.
-        # The implementation of `distributed.protocol.pickle.dumps` currently tries to plain `pickle.dumps`
-        # the object. If that raises an error, then it tries `cloudpickle.dumps`.
-        # We game this code structure by raising an error every other time we're pickled, forcing the
-        # `cloudpickle.dumps` codepath and then succeeding on that one.
-        if getattr(self, "_the_first_pickle_is_the_deepest", True):
-            self._the_first_pickle_is_the_deepest = False
-            raise RuntimeError("cloudpickle time!")
-        else:
-            del self._the_first_pickle_is_the_deepest
-
-            # Very awkward, but the only way to tell cloudpickle to pickle something by value
-            # is by passing it the module whose members you want pickled by value.
-            module = importlib.import_module(self.__module__)
-            cloudpickle.register_pickle_by_value(module)
-
-            return self.__dict__
+        worker = nanny.worker_address
+        print(f"Moving data from {worker} to other workers before restarting")
+        retired = await nanny.scheduler.retire_workers(
+            workers=[worker], close_workers=False, remove=False
+        )
+        if worker not in retired:
+            # No room on other workers, or the only worker. Restart anyway.
+            print(f"Could not move all data off {worker}; some keys will be lost")
 
-    @staticmethod
     async def run(
+        self,
         program: str | Path,
         *args: str,
         tee: bool = True,
         cwd: Path | None = None,
         env: dict[str, str] | None = None,
     ) -> tuple[bytes, bytes]:
+        """
+        Run a command, streaming its output to our stdout/stderr (if ``tee``) and the client.
+
+        Only the last `OUTPUT_TAIL_LINES` lines of each stream are kept: they're returned, and
+        attached to the `CalledProcessError` if the command fails.
+        """
         call = f"{program} {' '.join(args)}"
         print(f"Executing {call}")
         proc = await asyncio.create_subprocess_exec(
@@ -124,22 +810,594 @@ class DepManagerBase(NannyPlugin, ABC):
             stderr=asyncio.subprocess.PIPE,
             cwd=cwd,
             env=env,
+            limit=2**20,
         )
+        assert proc.stdout is not None and proc.stderr is not None
 
-        stdout, stderr = await proc.communicate()
-        returncode = proc.returncode
-        assert returncode is not None
+        async def pump(
+            reader: asyncio.StreamReader, stream: str, tail: deque[bytes]
+        ) -> None:
+            out = getattr(sys, stream)
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Line longer than `limit`; it's been discarded
+                    line = b"[line too long]\n"
+                if not line:
+                    return
+                tail.append(line)
+                text = line.decode(errors="replace")
+                if tee:
+                    out.write(text)
+                if self._output is not None:
+                    self._output.add(stream, text.rstrip("\n"))
 
-        print(f"{call} exited with {returncode}")
-        if tee:
-            if stdout:
-                sys.stdout.write(stdout.decode())
-            if stderr:
-                sys.stderr.write(stderr.decode())
+        stdout: deque[bytes] = deque(maxlen=OUTPUT_TAIL_LINES)
+        stderr: deque[bytes] = deque(maxlen=OUTPUT_TAIL_LINES)
+        try:
+            await asyncio.gather(
+                pump(proc.stdout, "stdout", stdout),
+                pump(proc.stderr, "stderr", stderr),
+            )
+            returncode = await proc.wait()
+        finally:
+            if self._output is not None:
+                self._output.flush()
+            if proc.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    proc.kill()
 
+        print(f"{call} exited with {returncode}")
         if returncode != 0:
-            raise CalledProcessError(returncode, call, stdout, stderr)
-        return stdout, stderr
+            raise CalledProcessError(
+                returncode, call, b"".join(stdout), b"".join(stderr)
+            )
+        return b"".join(stdout), b"".join(stderr)
+
+
+class OutputForwarder:
+    """
+    Send installer output to the scheduler as `INSTALL_OUTPUT_TOPIC` events, so the client can show it.
+
+    Lines are batched, so a chatty installer doesn't send one message per line. A line is sent
+    within `OUTPUT_FLUSH_INTERVAL` even if the installer goes quiet after it.
+    """
+
+    def __init__(self, nanny: Nanny, token: str) -> None:
+        self.nanny = nanny
+        self.token = token
+        self.lines: list[tuple[str, str]] = []
+        self._timer: asyncio.TimerHandle | None = None
+
+    def add(self, stream: str, line: str) -> None:
+        "Buffer a line. Must be called on the event loop."
+        self.lines.append((stream, line))
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                OUTPUT_FLUSH_INTERVAL, self.flush
+            )
+
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.lines:
+            self.nanny.log_event(
+                INSTALL_OUTPUT_TOPIC,
+                {"token": self.token, "nanny": self.nanny.address, "lines": self.lines},
+            )
+            self.lines = []
+
+
+class DepManagerWatcher(PickleByValue, SchedulerPlugin):
+    """
+    Push the `DepManagerBase` nanny plugin to each nanny as its worker joins the scheduler.
+
+    Works around https://github.com/dask/distributed/issues/7035: a nanny that was starting
+    up while the plugin was being registered can miss it, and just gets the plugins that
+    existed when it first contacted the scheduler. Rather than checking every nanny after
+    the fact, we hand the current plugin to each new nanny as soon as it shows up. This also
+    covers workers added later by scaling up or replacement.
+
+    Nannies that already have the plugin are fine with getting it again; see `DepManagerBase.setup`.
+    """
+
+    name: str = "DepManagerWatcher"
+
+    digest: str | None = None
+    "`DepManagerBase.digest` of the last plugin successfully registered on every nanny. Set by `get_client`."
+
+    def __init__(self, plugin_name: str = DepManagerBase.name) -> None:
+        self.plugin_name = plugin_name
+
+    async def start(self, scheduler: Scheduler) -> None:
+        self.scheduler = scheduler
+        self._pushed: dict[str, bytes] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+        self.store = ArtifactStore(Path(tempfile.mkdtemp(prefix="sneks-artifacts-")))
+        self.limiters: dict[str, SlotLimiter] = {}
+        scheduler.handlers.update(
+            {
+                "sneks_artifacts": self.store.manifest,
+                "sneks_artifact_get": self.store.get,
+                "sneks_artifact_put": self.store.put,
+                "sneks_acquire": self.acquire,
+                "sneks_release": self.release,
+                "sneks_claim": self.claim,
+                "sneks_unclaim": self.unclaim,
+            }
+        )
+        self.claims: dict[str, str] = {}
+
+        for worker in scheduler.workers:
+            self.add_worker(scheduler, worker)
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        shutil.rmtree(self.store.root, ignore_errors=True)
+
+    def add_worker(self, scheduler: Scheduler, worker: str) -> None:
+        ws = scheduler.workers.get(worker)
+        if ws is None or not ws.nanny:
+            return
+        if restarts := self.limiters.get(RESTART_LIMITER):
+            # The nanny's worker is back after its restart (or it's a new worker, which
+            # adds capacity)
+            restarts.release(ws.nanny)
+            self._resize(restarts)
+        # Don't block the worker's registration on the nanny's installation
+        task = asyncio.create_task(self.push(ws.nanny))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _resize(self, limiter: SlotLimiter) -> None:
+        if limiter.fraction is None:
+            return
+        nannies = {ws.nanny for ws in self.scheduler.workers.values()}
+        nannies.update(limiter.holders)
+        limiter.capacity = max(1, int(limiter.fraction * len(nannies)))
+        limiter.wake()
+
+    async def acquire(
+        self,
+        limiter: str,
+        holder: str,
+        timeout: float,
+        count: int | None = None,
+        fraction: float | None = None,
+    ) -> None:
+        """
+        Wait for one of ``count`` slots in ``limiter``, or one slot per ``fraction`` of the workers.
+
+        Slots are granted in the order they're asked for. The latest ``count`` or ``fraction``
+        applies to everyone.
+        """
+        lim = self.limiters.setdefault(limiter, SlotLimiter())
+        if count is not None:
+            lim.capacity, lim.fraction = count, None
+        elif fraction is not None:
+            lim.fraction = fraction
+            self._resize(lim)
+        await lim.acquire(holder, timeout)
+
+    def release(self, limiter: str, holder: str) -> None:
+        if lim := self.limiters.get(limiter):
+            lim.release(holder)
+
+    def claim(self, key: str, holder: str) -> str:
+        "Make ``holder`` responsible for ``key``, unless someone already is. Returns who is."
+        return self.claims.setdefault(key, holder)
+
+    def unclaim(self, key: str, holder: str) -> None:
+        if self.claims.get(key) == holder:
+            del self.claims[key]
+
+    async def push(self, nanny: str) -> None:
+        plugin = self.scheduler.nanny_plugins.get(self.plugin_name)
+        if plugin is None:
+            # Not registered yet; when it is, the scheduler broadcasts it to every nanny
+            return
+        if self._pushed.get(nanny) is plugin:
+            # Already given this nanny the current plugin. Its worker is probably
+            # rejoining after the plugin restarted it.
+            return
+        self._pushed[nanny] = plugin
+
+        print(f"Pushing {self.plugin_name!r} to nanny {nanny}")
+        try:
+            response = await self.scheduler.rpc(nanny).plugin_add(
+                plugin=plugin, name=self.plugin_name
+            )
+        except OSError:
+            # Nanny went away
+            del self._pushed[nanny]
+            return
+        if response.get("status") != "OK":
+            del self._pushed[nanny]
+            print(f"Adding {self.plugin_name!r} to {nanny} failed: {response}")
+
+
+class ArtifactStore:
+    """
+    Files on the scheduler's disk, shared between nannies (and the client).
+
+    Files are grouped into namespaces, and identified by a relative path within them.
+    Exposed as scheduler RPC handlers by `DepManagerWatcher`; use `fetch_artifact` and
+    `upload_artifact` to transfer whole files.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.sizes: dict[str, dict[str, int]] = {}
+
+    def _path(self, namespace: str, path: str) -> Path:
+        parts = PurePosixPath(namespace, path).parts
+        if not parts or parts[0] == "/" or ".." in parts:
+            raise ValueError(f"Invalid artifact path {namespace!r}/{path!r}")
+        return self.root.joinpath(*parts)
+
+    def manifest(self, namespace: str) -> dict[str, int]:
+        "Size of each file in ``namespace``, by path"
+        return dict(self.sizes.get(namespace, {}))
+
+    async def get(
+        self, namespace: str, path: str, offset: int = 0, length: int = -1
+    ) -> bytes:
+        def _read() -> bytes:
+            with open(self._path(namespace, path), "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+
+        return await to_thread(_read)
+
+    async def put(
+        self,
+        namespace: str,
+        path: str,
+        data: bytes,
+        upload_id: str,
+        offset: int = 0,
+        final: bool = True,
+    ) -> None:
+        "Write a chunk of a file. Once the ``final`` chunk is written, the file appears in the manifest."
+        dest = self._path(namespace, path)
+        # Each upload writes its own temp file, so concurrent uploads of the same file don't collide
+        tmp = dest.with_name(f"{dest.name}.{upload_id}.part")
+
+        def _write() -> None:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                f.write(data)
+            if final:
+                os.replace(tmp, dest)
+
+        await to_thread(_write)
+        if final:
+            self.sizes.setdefault(namespace, {})[path] = offset + len(data)
+
+
+class SlotLimiter:
+    """
+    First-come-first-served limit on how many holders (nannies) can do something at once.
+
+    A holder keeps its slot until it's released, or for at most the ``timeout`` it acquired
+    it with, in case it never comes back to release it.
+    """
+
+    def __init__(self, capacity: int = 1) -> None:
+        self.capacity = capacity
+        self.fraction: float | None = None
+        "If set, `DepManagerWatcher` keeps ``capacity`` at this fraction of the workers"
+        self.holders: dict[str, asyncio.TimerHandle] = {}
+        self.waiters: deque[tuple[str, asyncio.Future[None], float]] = deque()
+
+    async def acquire(self, holder: str, timeout: float) -> None:
+        if holder in self.holders:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append((holder, fut, timeout))
+        self.wake()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # The holder disconnected. If it already got a slot, give it back.
+            if fut.done() and not fut.cancelled():
+                self.release(holder)
+            raise
+
+    def release(self, holder: str) -> None:
+        if handle := self.holders.pop(holder, None):
+            handle.cancel()
+            self.wake()
+
+    def wake(self) -> None:
+        "Hand out free slots to waiters, in order"
+        while self.waiters and len(self.holders) < self.capacity:
+            holder, fut, timeout = self.waiters.popleft()
+            if fut.done():
+                # Gave up waiting
+                continue
+            self.holders[holder] = asyncio.get_running_loop().call_later(
+                timeout, self.release, holder
+            )
+            fut.set_result(None)
+
+
+async def fetch_artifact(
+    scheduler: Any, namespace: str, path: str, size: int, dest: Path
+) -> None:
+    "Download a file from the scheduler's `ArtifactStore` to ``dest``, given an rpc to the scheduler"
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f"{dest.name}.{uuid.uuid4().hex}.part")
+    try:
+        with open(tmp, "wb") as f:
+            offset = 0
+            while offset < size:
+                chunk = await scheduler.sneks_artifact_get(
+                    namespace=namespace,
+                    path=path,
+                    offset=offset,
+                    length=ARTIFACT_CHUNK_SIZE,
+                )
+                if not chunk:
+                    raise OSError(f"{path!r} on scheduler is shorter than {size} bytes")
+                f.write(chunk)
+                offset += len(chunk)
+        os.replace(tmp, dest)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+async def upload_artifact(
+    scheduler: Any, namespace: str, path: str, src: Path | bytes
+) -> int:
+    "Upload ``src`` (a file, or its contents) to the scheduler's `ArtifactStore`, given an rpc to it. Returns its size."
+    upload_id = uuid.uuid4().hex
+    offset = 0
+    with io.BytesIO(src) if isinstance(src, bytes) else open(src, "rb") as f:
+        while True:
+            chunk = f.read(ARTIFACT_CHUNK_SIZE)
+            final = len(chunk) < ARTIFACT_CHUNK_SIZE
+            await scheduler.sneks_artifact_put(
+                namespace=namespace,
+                path=path,
+                data=chunk,
+                upload_id=upload_id,
+                offset=offset,
+                final=final,
+            )
+            offset += len(chunk)
+            if final:
+                return offset
+
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _background(coro: Coroutine[Any, Any, None]) -> None:
+    "Run a coroutine in the background, holding a reference so it isn't garbage-collected"
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def environment_digest(tool: str, pyproject: bytes, lockfile: bytes) -> str:
+    "Content digest identifying the environment a project's pyproject and lockfile describe"
+    h = hashlib.sha256()
+    for part in (tool.encode(), pyproject, lockfile):
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+class EnvironmentDiff(NamedTuple):
+    "Difference between two sets of installed distributions"
+
+    added: dict[str, str]
+    "Newly installed, name -> version"
+    removed: dict[str, str]
+    "Uninstalled, name -> old version"
+    updated: dict[str, tuple[str, str]]
+    "Changed version, name -> (old version, new version)"
+
+    @property
+    def needs_restart(self) -> bool:
+        "Whether anything that was already installed changed"
+        return bool(self.removed or self.updated)
+
+    @property
+    def needs_install(self) -> bool:
+        "Whether anything needs installing or changing (extra packages are fine)"
+        return bool(self.added or self.updated)
+
+    def __str__(self) -> str:
+        parts = [f"+{name}=={version}" for name, version in self.added.items()]
+        parts += [f"-{name}=={version}" for name, version in self.removed.items()]
+        parts += [f"{name} {old} -> {new}" for name, (old, new) in self.updated.items()]
+        return ", ".join(parts) or "none"
+
+
+def diff_environments(before: dict[str, str], after: dict[str, str]) -> EnvironmentDiff:
+    return EnvironmentDiff(
+        added={k: v for k, v in after.items() if k not in before},
+        removed={k: v for k, v in before.items() if k not in after},
+        updated={
+            k: (v, after[k]) for k, v in before.items() if k in after and after[k] != v
+        },
+    )
+
+
+def _normalize_name(name: str) -> str:
+    # Same as `sneks.names.normalize_name`; this module can't import from sneks.
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _distribution_version(dist: importlib.metadata.Distribution) -> str:
+    "Version, or ``<vcs>+<url>@<commit>`` for distributions installed from version control"
+    try:
+        direct_url = json.loads(dist.read_text("direct_url.json") or "null")
+    except ValueError:
+        direct_url = None
+    if isinstance(direct_url, dict) and (vcs := direct_url.get("vcs_info")):
+        return f"{vcs['vcs']}+{direct_url['url']}@{vcs['commit_id']}"
+    return dist.version
+
+
+def installed_distributions() -> dict[str, str]:
+    "Every distribution installed in this environment, by normalized name"
+    importlib.invalidate_caches()
+    dists: dict[str, str] = {}
+    for dist in importlib.metadata.distributions():
+        name = dist.metadata["Name"]
+        if not name:
+            # Broken metadata; pip ignores these too
+            continue
+        # Earlier on `sys.path` wins, like imports
+        dists.setdefault(_normalize_name(name), _distribution_version(dist))
+    return dists
+
+
+PACKED_ENV_INFO = ".sneks-packed.json"
+"Member of a packed environment archive listing the distributions to remove before unpacking"
+
+
+def packed_env_key(install_digest: str, before: dict[str, str]) -> str:
+    "Identifies a packed environment: what it installs, onto what, on which platform"
+    h = hashlib.sha256(install_digest.encode())
+    h.update(platform.machine().encode())
+    h.update(json.dumps(sorted(before.items())).encode())
+    return h.hexdigest()
+
+
+def _distribution_files(names: set[str]) -> list[Path]:
+    "Installed files of the named distributions, per their RECORDs"
+    files: list[Path] = []
+    seen: set[str] = set()
+    for dist in importlib.metadata.distributions():
+        name = _normalize_name(dist.metadata["Name"] or "")
+        if name not in names or name in seen:
+            continue
+        seen.add(name)
+        files += [Path(os.path.normpath(dist.locate_file(f))) for f in dist.files or []]
+    return files
+
+
+def pack_environment(changes: EnvironmentDiff, archive: Path) -> None:
+    """
+    Pack the files of the distributions ``changes`` installed into ``archive``, for `unpack_environment`.
+
+    The archive also lists the distributions to remove first: the ones that were removed or
+    replaced by a different version.
+    """
+    prefix = Path(sys.prefix)
+    remove = sorted({*changes.removed, *changes.updated})
+    info = json.dumps({"remove": remove}).encode()
+    with tarfile.open(archive, "w:gz") as tar:
+        member = tarfile.TarInfo(PACKED_ENV_INFO)
+        member.size = len(info)
+        tar.addfile(member, io.BytesIO(info))
+        for path in _distribution_files({*changes.added, *changes.updated}):
+            if path.exists() and prefix in path.parents:
+                tar.add(path, arcname=str(path.relative_to(prefix)), recursive=False)
+
+
+def remove_distributions(names: set[str]) -> None:
+    "Delete the installed files of the named distributions, like ``pip uninstall`` would"
+    files = _distribution_files(names)
+    for path in files:
+        path.unlink(missing_ok=True)
+    # Clean up emptied directories, deepest first. An empty ``.dist-info`` would look like a
+    # distribution without metadata.
+    for directory in sorted({p.parent for p in files}, key=lambda p: -len(p.parts)):
+        with contextlib.suppress(OSError):
+            directory.rmdir()
+
+
+def unpack_environment(archive: Path) -> None:
+    "Apply an environment packed by `pack_environment` to this one"
+    prefix = Path(sys.prefix)
+    with tarfile.open(archive, "r:gz") as tar:
+        info_file = tar.extractfile(PACKED_ENV_INFO)
+        assert info_file is not None
+        remove_distributions(set(json.load(info_file)["remove"]))
+        members = [
+            m
+            for m in tar.getmembers()
+            if m.name != PACKED_ENV_INFO
+            and not m.name.startswith("/")
+            and ".." not in Path(m.name).parts
+        ]
+        # Python 3.12 wants to know how much we trust the archive. It came from our own cluster.
+        kwargs = {"filter": "fully_trusted"} if hasattr(tarfile, "data_filter") else {}
+        tar.extractall(prefix, members=members, **kwargs)
+    importlib.invalidate_caches()
+
+
+def read_install_marker(path: Path) -> dict[str, Any] | None:
+    """
+    Read what was last installed into an environment.
+
+    ``digest`` is the `DepManagerBase.install_digest`, ``installed_at`` the time it was installed,
+    and ``restart`` whether workers that were running at that time need to restart. If known,
+    ``locked`` lists the names of the packages that install locked.
+    """
+    try:
+        with open(path) as f:
+            marker = json.load(f)
+        marker["digest"], marker["installed_at"], marker["restart"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return marker
+
+
+def write_install_marker(path: Path, marker: dict[str, Any]) -> None:
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(marker, f)
+    os.replace(tmp, path)
+
+
+@contextlib.asynccontextmanager
+async def host_lock(path: Path, poll_interval: float = 0.5) -> AsyncIterator[None]:
+    "Exclusive lock across every process on this machine, held while in the ``async with`` block"
+    # Only nannies take the lock, and they run on Linux. The client may be on Windows.
+    import fcntl
+
+    with open(path, "a") as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Poll instead of blocking in a thread, so cancellation is clean
+                await asyncio.sleep(poll_interval)
+            else:
+                break
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def worker_started_before(nanny: Nanny, timestamp: float) -> bool:
+    """
+    Whether the nanny's worker process started before ``timestamp``.
+
+    Plugins are set up before the nanny starts its first worker, so there may be no process yet,
+    and nothing to restart. If there is one but we can't tell when it started, assume it did.
+    """
+    worker = nanny.process.process if nanny.process is not None else None
+    if worker is None or worker.pid is None:
+        return False
+    try:
+        return psutil.Process(worker.pid).create_time() < timestamp
+    except psutil.NoSuchProcess:
+        return False
+    except psutil.Error:
+        return True
 
 
 async def write_compressed_file(data: bytes, path: Path) -> None:
@@ -161,6 +1419,8 @@ async def write_compressed_file(data: bytes, path: Path) -> None:
 class PoetryDepManager(DepManagerBase):
     LOCKFILE_NAME: ClassVar[str] = "poetry.lock"
     TOOL_NAME: ClassVar[str] = "Poetry"
+    # Paths in here are hashes of the download URL
+    CACHE_DIRS: ClassVar[tuple[str, ...]] = (".cache/pypoetry/artifacts",)
 
     async def setup_tool(self, *, tool_path: Path, workdir: Path) -> None:
         "Make poetry use the global environment"
@@ -169,11 +1429,11 @@ class PoetryDepManager(DepManagerBase):
         await self.run(tool_path, "config", "virtualenvs.create", "false")
         print("Poetry configured to use global environment")
 
-    async def install(self, *, tool_path: Path, workdir: Path) -> bool:
+    async def install(self, *, tool_path: Path, workdir: Path) -> None:
         cwd = Path.cwd()
         try:
             os.chdir(workdir)
-            out, err = await self.run(
+            await self.run(
                 tool_path,
                 "install",
                 "--sync",
@@ -181,9 +1441,6 @@ class PoetryDepManager(DepManagerBase):
                 "--no-root",
                 "-n",
             )
-            # HACK we can do better than this text parsing to decide
-            # whether to restart or not
-            return b"Updating" in out or b"Removing" in out
         finally:
             os.chdir(cwd)
 
@@ -191,14 +1448,16 @@ class PoetryDepManager(DepManagerBase):
 class PdmDepManager(DepManagerBase):
     LOCKFILE_NAME: ClassVar[str] = "pdm.lock"
     TOOL_NAME: ClassVar[str] = "PDM"
+    # HTTP cache (downloaded files, keyed by URL hash) and wheels built from sdists
+    CACHE_DIRS: ClassVar[tuple[str, ...]] = (".cache/pdm/http", ".cache/pdm/wheels")
 
-    async def install(self, *, tool_path: Path, workdir: Path) -> bool:
+    async def install(self, *, tool_path: Path, workdir: Path) -> None:
         await self.run(
             tool_path,
             "info",
             cwd=workdir,
         )
-        out, err = await self.run(
+        await self.run(
             tool_path,
             "sync",
             "--prod",
@@ -207,6 +1466,45 @@ class PdmDepManager(DepManagerBase):
             "--no-isolation",
             cwd=workdir,
         )
-        # HACK we can do better than this text parsing to decide
-        # whether to restart or not
-        return b"nothing to do" not in out
+
+
+class PipDepManager(DepManagerBase):
+    """
+    Install a requirements file the client generated from the Poetry or PDM lockfile, with just pip.
+
+    The lockfile is already resolved, so there's no need to start up Poetry or PDM on every worker
+    to re-read it: one ``pip install --no-deps`` of the pinned versions does the same thing.
+    Unlike the tools, this doesn't uninstall packages that aren't in the lockfile.
+    """
+
+    LOCKFILE_NAME: ClassVar[str] = "requirements.txt"
+    TOOL_NAME: ClassVar[str] = "pip"
+    CACHE_DIRS: ClassVar[tuple[str, ...]] = (
+        ".cache/pip/http",
+        ".cache/pip/http-v2",
+        ".cache/pip/wheels",
+    )
+
+    def get_tool_path(self) -> Path:
+        "pip runs as a module of the Python we're installing into"
+        return Path(sys.executable)
+
+    def get_tool_version(self, tool_path: Path) -> str:
+        try:
+            return importlib.metadata.version("pip")
+        except importlib.metadata.PackageNotFoundError:
+            return "unknown"
+
+    async def install(self, *, tool_path: Path, workdir: Path) -> None:
+        await self.run(
+            tool_path,
+            "-m",
+            "pip",
+            "install",
+            "--no-deps",
+            "--no-input",
+            "--disable-pip-version-check",
+            "-r",
+            str(workdir / self.LOCKFILE_NAME),
+            cwd=workdir,
+        )
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import statistics
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Iterable, Iterator
+
+if TYPE_CHECKING:
+    from rich.table import Table
+
+
+class StartupTimings:
+    """
+    How long each phase of `get_client` took, in seconds.
+
+    Attached to the client returned by `get_client` as ``client.startup_timings``.
+    ``rich.print`` it for a table. Phases that run concurrently (like lockfile parsing and
+    senv creation) are timed independently, so they can add up to more than ``total``.
+    """
+
+    phases: dict[str, float]
+    "Client-side phases, in the order they started"
+    workers: dict[str, dict[str, Any]]
+    "Per-nanny install reports, by nanny address. See `DepManagerBase.setup`."
+    total: float | None
+    "Time from the start of `get_client` until it returned"
+
+    def __init__(self) -> None:
+        self.phases = {}
+        self.workers = {}
+        self.total = None
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        "Time the body of the ``with`` block as phase ``name``"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def finish(self) -> None:
+        self.total = time.perf_counter() - self._start
+
+    def add_worker_events(
+        self, events: Iterable[tuple[float, dict[str, Any]]], token: str
+    ) -> None:
+        "Record install reports from the plugin's scheduler events, for the plugin with ``token``"
+        for _, msg in events:
+            if msg.get("token") == token:
+                self.workers[msg["nanny"]] = msg
+
+    @property
+    def worker_installs(self) -> list[float]:
+        "Total install time on each worker"
+        return [w["durations"]["total"] for w in self.workers.values()]
+
+    @property
+    def worker_restarts(self) -> int:
+        return sum(bool(w["restarted"]) for w in self.workers.values())
+
+    def __repr__(self) -> str:
+        phases = ", ".join(f"{k}={v:.2f}s" for k, v in self.phases.items())
+        total = "?" if self.total is None else f"{self.total:.2f}s"
+        return f"<{type(self).__name__} total={total} {phases}>"
+
+    def __rich__(self) -> Table:
+        from rich.table import Table
+
+        table = Table(title="sneks startup", show_footer=True)
+        table.add_column("phase", footer="total")
+        table.add_column(
+            "seconds",
+            justify="right",
+            footer="" if self.total is None else f"{self.total:.2f}",
+        )
+        for name, duration in self.phases.items():
+            table.add_row(name, f"{duration:.2f}")
+
+        if installs := self.worker_installs:
+            table.add_row(
+                f"install on {len(installs)} worker(s) (min / median / max)",
+                f"{min(installs):.2f} / {statistics.median(installs):.2f} / {max(installs):.2f}",
+            )
+            table.add_row("workers restarted", str(self.worker_restarts))
+        return table
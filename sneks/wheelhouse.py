@@ -0,0 +1,171 @@
+"""
+Build a wheelhouse for the cluster's platform on the client, so workers don't each hit the package index.
+
+Enabled with the ``sneks.wheelhouse`` dask config key. Wheels are downloaded with
+``pip download`` for the cluster's Python version and CPU architecture, kept in
+``sneks.cache.cache_dir`` between runs, and uploaded once to the scheduler's
+`sneks.plugin.ArtifactStore`. Nannies fetch them from there and install with ``--no-index``.
+"""
+from __future__ import annotations
+
+import hashlib
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+from packaging.utils import InvalidWheelFilename, parse_wheel_filename
+from packaging.version import InvalidVersion, Version
+
+from sneks.cache import cache_dir
+from sneks.platforms import platform_tags, python_tag
+from sneks.plugin import WHEELHOUSE_NAMESPACE, upload_artifact
+
+if TYPE_CHECKING:
+    from distributed.client import Client
+
+
+class Wheelhouse(NamedTuple):
+    files: dict[str, Path]
+    "Local wheel files, by their path in the scheduler's `ArtifactStore`"
+    missing: list[str]
+    "Locked packages we couldn't get a wheel for (no wheel for the platform, or not from an index)"
+
+
+def wheelhouse_dir(arch: str) -> Path:
+    return cache_dir() / "wheelhouse" / f"cp{python_tag()}-{arch}"
+
+
+def _pip(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-m", "pip", *args, "--disable-pip-version-check", "-q"],
+        capture_output=True,
+    )
+
+
+def _download(requirements: list[str], dest: Path, arch: str) -> bool:
+    platforms = [arg for tag in platform_tags(arch) for arg in ("--platform", tag)]
+    proc = _pip(
+        "download",
+        "--no-deps",
+        "--only-binary=:all:",
+        "--implementation=cp",
+        f"--python-version={python_tag()}",
+        *platforms,
+        f"--dest={dest}",
+        *requirements,
+    )
+    return proc.returncode == 0
+
+
+def _is_pure(wheel: Path) -> bool:
+    _, _, _, tags = parse_wheel_filename(wheel.name)
+    return all(tag.platform == "any" and tag.abi == "none" for tag in tags)
+
+
+def _build_git(url: str, dest: Path) -> Path | None:
+    """
+    Build a wheel from a ``git+<url>@<commit>`` requirement, cached under ``dest``.
+
+    We can't cross-compile, so only pure-Python wheels are usable on the cluster.
+    """
+    out = dest / "git" / hashlib.sha256(url.encode()).hexdigest()[:16]
+    if not out.is_dir():
+        with tempfile.TemporaryDirectory(dir=dest) as tmp:
+            proc = _pip("wheel", "--no-deps", f"--wheel-dir={tmp}", url)
+            wheels = list(Path(tmp).glob("*.whl"))
+            if proc.returncode != 0 or len(wheels) != 1 or not _is_pure(wheels[0]):
+                return None
+            out.mkdir(parents=True)
+            shutil.move(wheels[0], out / wheels[0].name)
+    (wheel,) = out.glob("*.whl")
+    return wheel
+
+
+def _index(dest: Path) -> dict[tuple[str, Version | str], Path]:
+    "Wheels already in ``dest``, by normalized name and version"
+    wheels: dict[tuple[str, Version | str], Path] = {}
+    for path in sorted(dest.glob("*.whl")):
+        try:
+            name, version, _, _ = parse_wheel_filename(path.name)
+        except InvalidWheelFilename:
+            continue
+        wheels.setdefault((name, version), path)
+    return wheels
+
+
+def _key(name: str, version: str) -> tuple[str, Version | str]:
+    try:
+        # So ``1.0`` matches ``1.0.0``
+        return name, Version(version)
+    except InvalidVersion:
+        return name, version
+
+
+def build_wheelhouse(locked: dict[str, str], arch: str) -> Wheelhouse:
+    """
+    Get a wheel for every package in ``locked`` (as from `sneks.compat.get_backend`) for ``arch``.
+
+    Packages from an index are downloaded; packages from Git are built locally.
+    Wheels from previous runs are reused.
+    """
+    dest = wheelhouse_dir(arch)
+    dest.mkdir(parents=True, exist_ok=True)
+
+    files: dict[str, Path] = {}
+    missing: list[str] = []
+    git = {name: v for name, v in locked.items() if v.startswith("git+")}
+    released = {name: v for name, v in locked.items() if name not in git}
+
+    with ThreadPoolExecutor(4, thread_name_prefix="sneks-wheelhouse") as pool:
+        git_wheels = {
+            name: pool.submit(_build_git, f"{name} @ {v}", dest)
+            for name, v in git.items()
+        }
+
+        have = _index(dest)
+        todo = [name for name, v in released.items() if _key(name, v) not in have]
+        if todo:
+            if not _download([f"{n}=={released[n]}" for n in todo], dest, arch):
+                # Some have no wheel for the platform. Get the rest one at a time.
+                list(
+                    pool.map(
+                        lambda n: _download([f"{n}=={released[n]}"], dest, arch),
+                        todo,
+                    )
+                )
+            have = _index(dest)
+
+        for name, v in released.items():
+            if path := have.get(_key(name, v)):
+                files[path.name] = path
+            else:
+                missing.append(name)
+        for name, future in git_wheels.items():
+            if path := future.result():
+                files[path.relative_to(dest).as_posix()] = path
+            else:
+                missing.append(name)
+
+    return Wheelhouse(files, sorted(missing))
+
+
+async def upload_wheelhouse(client: Client, wheelhouse: Wheelhouse) -> int:
+    """
+    Upload wheels the scheduler doesn't already have. Returns the number of bytes uploaded.
+
+    Needs `sneks.plugin.DepManagerWatcher` registered on the scheduler.
+    """
+    manifest = await client.scheduler.sneks_artifacts(namespace=WHEELHOUSE_NAMESPACE)
+    if manifest is None:
+        raise RuntimeError("DepManagerWatcher is not registered on the scheduler")
+    uploaded = 0
+    for path, file in wheelhouse.files.items():
+        if path not in manifest:
+            uploaded += await upload_artifact(
+                client.scheduler, WHEELHOUSE_NAMESPACE, path, file
+            )
+    return uploaded
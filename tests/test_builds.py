@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+from sneks.builds import (
+    BUILD_SECONDS_ESTIMATE,
+    BuildReport,
+    SourceBuild,
+    predict_builds,
+    supported_tags,
+)
+from sneks.lockfile import Lockfile
+from sneks.platforms import python_tag
+
+cp = f"cp{python_tag()}"
+
+
+def files(*names: str) -> list[dict[str, str]]:
+    return [{"file": name, "hash": f"sha256:{i}"} for i, name in enumerate(names)]
+
+
+LOCKFILE = Lockfile.from_poetry(
+    {
+        "package": [
+            {
+                "name": "pure",
+                "version": "1.0",
+                "files": files("pure-1.0-py3-none-any.whl", "pure-1.0.tar.gz"),
+            },
+            {
+                "name": "abi3",
+                "version": "1.0",
+                "files": files("abi3-1.0-cp37-abi3-manylinux_2_17_x86_64.whl"),
+            },
+            {
+                "name": "intel-only",
+                "version": "1.0",
+                "files": files(
+                    f"intel_only-1.0-{cp}-{cp}-manylinux_2_17_x86_64.manylinux2014_x86_64.whl",
+                    f"intel_only-1.0-{cp}-{cp}-macosx_11_0_arm64.whl",
+                    "intel-only-1.0.tar.gz",
+                ),
+            },
+            {
+                "name": "old-wheels",
+                "version": "1.0",
+                "files": files(
+                    "old_wheels-1.0-cp27-cp27mu-manylinux1_x86_64.whl",
+                    "old-wheels-1.0.zip",
+                ),
+            },
+            {
+                "name": "no-sdist",
+                "version": "1.0",
+                "files": files("no_sdist-1.0-cp27-cp27mu-manylinux1_x86_64.whl"),
+            },
+            {"name": "no-files", "version": "1.0"},
+            {
+                "name": "from-git",
+                "version": "1.0",
+                "source": {
+                    "type": "git",
+                    "url": "https://example.com/from-git.git",
+                    "resolved_reference": "abc",
+                },
+            },
+            {
+                "name": "windows-app",
+                "version": "1.0",
+                "dependencies": {
+                    "pywin32": {"version": "*", "markers": 'sys_platform == "win32"'}
+                },
+                "files": files("windows_app-1.0-py3-none-any.whl"),
+            },
+            {
+                "name": "pywin32",
+                "version": "305",
+                "files": files(f"pywin32-305-{cp}-{cp}-win_amd64.whl"),
+            },
+        ]
+    }
+)
+
+
+def test_supported_tags():
+    tags = {str(t) for t in supported_tags("aarch64")}
+    assert f"{cp}-{cp}-manylinux_2_17_aarch64" in tags
+    assert f"{cp}-abi3-manylinux2014_aarch64" in tags
+    assert "py3-none-any" in tags
+    assert not any("x86_64" in t for t in tags)
+    assert f"{cp}-{cp}-manylinux_2_35_aarch64" in tags
+    assert f"{cp}-{cp}-manylinux_2_37_aarch64" not in tags
+
+
+# The project's direct dependencies: everything but pywin32
+ROOTS = {p.key: None for p in LOCKFILE if p.key != "pywin32"}
+
+
+def test_predict_builds():
+    x86 = predict_builds(LOCKFILE, ROOTS, "x86_64")
+    assert x86.builds == [
+        SourceBuild("no-sdist", "1.0", None),
+        SourceBuild("old-wheels", "1.0", "old-wheels-1.0.zip"),
+    ]
+    # Only needed on Windows, so skipped
+    assert "pywin32" not in {b.name for b in x86.builds}
+    assert x86.unknown == ["from-git", "no-files"]
+    assert x86.wheels == 4
+    assert x86.estimated_seconds == 2 * BUILD_SECONDS_ESTIMATE
+
+    arm = predict_builds(LOCKFILE, ROOTS, "aarch64")
+    assert [b.name for b in arm.builds] == [
+        "abi3",
+        "intel-only",
+        "no-sdist",
+        "old-wheels",
+    ]
+    assert arm.wheels == 2
+
+    # Only the packages asked about
+    assert predict_builds(LOCKFILE, {"pure": None}, "x86_64").wheels == 1
+
+
+def test_predict_builds_extra_dependency():
+    "A direct dependency that's also another package's extra dependency is still checked"
+    lockfile = Lockfile.from_poetry(
+        {
+            "package": [
+                {
+                    "name": "dask",
+                    "version": "1.0",
+                    "dependencies": {
+                        "numpy": {"version": "*", "markers": 'extra == "array"'}
+                    },
+                    "files": files("dask-1.0-py3-none-any.whl"),
+                },
+                {"name": "numpy", "version": "1.0", "files": files("numpy-1.0.tar.gz")},
+            ]
+        }
+    )
+    for roots in ({"numpy": None, "dask": None}, {"dask": None}):
+        report = predict_builds(lockfile, roots, "x86_64")
+        assert report.builds == [SourceBuild("numpy", "1.0", "numpy-1.0.tar.gz")]
+
+
+def test_report_json():
+    report = predict_builds(LOCKFILE, ROOTS, "aarch64")
+    assert BuildReport.from_json(report.to_json()) == report
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import os
+import time
+
+import pytest
+
+from sneks import cache
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("SNEKS_CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_cache_dir(tmp_cache_dir):
+    assert cache.cache_dir() == tmp_cache_dir
+
+
+def test_senv_roundtrip():
+    assert not cache.senv_is_cached("acct", "sneks-3-9-1", "img:3.9.1")
+    cache.mark_senv_created("acct", "sneks-3-9-1", "img:3.9.1")
+    assert cache.senv_is_cached("acct", "sneks-3-9-1", "img:3.9.1")
+
+    # Keyed by account, name and image
+    assert not cache.senv_is_cached(None, "sneks-3-9-1", "img:3.9.1")
+    assert not cache.senv_is_cached("other", "sneks-3-9-1", "img:3.9.1")
+    assert not cache.senv_is_cached("acct", "sneks-3-9-2", "img:3.9.1")
+    assert not cache.senv_is_cached("acct", "sneks-3-9-1", "img:3.9.2")
+
+
+def test_senv_ttl(monkeypatch):
+    cache.mark_senv_created(None, "name", "image")
+    assert cache.senv_is_cached(None, "name", "image", ttl=60)
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert not cache.senv_is_cached(None, "name", "image", ttl=60)
+
+
+def test_senv_invalidate():
+    cache.mark_senv_created(None, "a", "image")
+    cache.mark_senv_created(None, "b", "image")
+
+    cache.invalidate_senv(None, "a", "image")
+    assert not cache.senv_is_cached(None, "a", "image")
+    assert cache.senv_is_cached(None, "b", "image")
+
+    cache.clear_senv_cache()
+    assert not cache.senv_is_cached(None, "b", "image")
+    # Clearing twice is fine
+    cache.clear_senv_cache()
+
+
+def test_corrupt_cache_ignored(tmp_cache_dir):
+    (tmp_cache_dir / "senvs.json").write_text("{not json")
+    assert not cache.senv_is_cached(None, "a", "image")
+    cache.mark_senv_created(None, "a", "image")
+    assert cache.senv_is_cached(None, "a", "image")
+
+
+def test_parse_cache(monkeypatch):
+    key = cache.parse_cache_key(b"pyproject", "tool")
+    assert key != cache.parse_cache_key(b"pyproj", "ecttool")
+    assert cache.read_parsed(key) is None
+
+    cache.write_parsed(key, {"environ": {"PIP_PACKAGES": "dask==1"}})
+    assert cache.read_parsed(key) == {"environ": {"PIP_PACKAGES": "dask==1"}}
+
+    # Only the most recently used entries are kept
+    monkeypatch.setattr(cache, "PARSE_CACHE_ENTRIES", 2)
+    past = time.time() - 60
+    os.utime(cache._parse_cache_dir() / f"{key}.json", (past, past))
+    cache.write_parsed("b", {"i": 0})
+    cache.write_parsed("c", {"i": 1})
+    assert cache.read_parsed(key) is None
+    assert cache.read_parsed("b") == {"i": 0}
+
+    cache.clear_parse_cache()
+    assert cache.read_parsed("b") is None
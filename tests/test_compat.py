@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import gzip
+import shutil
+from pathlib import Path
+
+import dask.config
+import pytest
+import tomli
+
+from sneks.compat import get_backend, requirements_txt
+from sneks.timing import StartupTimings
+
+
+def test_requirements_txt():
+    locked = {"x86_64": {"toolz": "0.12.0", "dask": "2022.12.1"}}
+    hashes = {"toolz": ["sha256:aa", "sha256:bb"], "dask": ["sha256:cc"]}
+    assert requirements_txt(locked, hashes) == (
+        b"dask==2022.12.1 --hash=sha256:cc\n"
+        b"toolz==0.12.0 --hash=sha256:aa --hash=sha256:bb\n"
+    )
+
+    # Hash checking is all or nothing, so one package without hashes turns it off
+    locked["x86_64"]["yapf"] = "git+https://github.com/google/yapf.git@c607795"
+    assert requirements_txt(locked, hashes) == (
+        b"dask==2022.12.1\n"
+        b"toolz==0.12.0\n"
+        b"yapf @ git+https://github.com/google/yapf.git@c607795\n"
+    )
+
+
+def test_requirements_txt_archs():
+    locked = {
+        "aarch64": {"dask": "2022.12.1", "numpy": "1.24.0"},
+        "x86_64": {"dask": "2022.12.1", "numpy": "1.26.4", "intel-only": "1.0"},
+    }
+    assert requirements_txt(locked, {}) == (
+        b"dask==2022.12.1\n"
+        b'intel-only==1.0 ; platform_machine == "x86_64"\n'
+        b'numpy==1.24.0 ; platform_machine == "aarch64"\n'
+        b'numpy==1.26.4 ; platform_machine == "x86_64"\n'
+    )
+
+
+@pytest.fixture
+def project(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    "A copy of the Poetry test environment as the working directory, with an empty cache"
+    env = Path(__file__).parent / "env-for-parsing-poetry"
+    project = tmp_path / "project"
+    shutil.copytree(env, project)
+    monkeypatch.chdir(project)
+    monkeypatch.setenv("SNEKS_CACHE_DIR", str(tmp_path / "cache"))
+    return project
+
+
+def test_get_backend_cached(project: Path, monkeypatch: pytest.MonkeyPatch):
+    plugin, environ, _ = get_backend()
+    assert "dask==2022.5.2" in environ["PIP_PACKAGES"].split()
+
+    # Second time, nothing is parsed
+    with monkeypatch.context() as m:
+        m.setattr(tomli, "loads", None)
+        timings = StartupTimings()
+        cached, cached_environ, _ = get_backend(timings)
+    assert "parse lockfile" not in timings.phases
+    assert type(cached) is type(plugin)
+    assert cached_environ == environ
+    assert cached.digest == plugin.digest
+    assert cached.locked == plugin.locked
+    assert cached._payload == plugin._payload
+    # Still a new registration
+    assert cached.token != plugin.token
+
+    # Changing the lockfile (or pyproject) means parsing again
+    lockfile = project / "poetry.lock"
+    lockfile.write_bytes(lockfile.read_bytes() + b"\n")
+    timings = StartupTimings()
+    changed, _, _ = get_backend(timings)
+    assert "parse lockfile" in timings.phases
+    assert changed.digest != plugin.digest
+
+    # So does the installer
+    with dask.config.set({"sneks.installer": "pip"}):
+        pip, _, _ = get_backend()
+    assert type(pip).__name__ == "PipDepManager"
+
+    # Planning for the cluster's architectures leaves out what doesn't apply there
+    _, linux_environ, builds = get_backend(archs=["x86_64"])
+    assert "colorama==0.4.5" in environ["PIP_PACKAGES"].split()
+    assert "colorama==0.4.5" not in linux_environ["PIP_PACKAGES"].split()
+    # As do the packages the tool installs, for each architecture
+    assert set(plugin.locked) == {"x86_64"}
+    both, _, _ = get_backend(archs=["x86_64", "aarch64"])
+    assert set(both.locked) == {"aarch64", "x86_64"}
+    for locked in both.locked.values():
+        assert locked["dask"] == "2022.5.2"
+        assert "colorama" not in locked
+
+    # Along with which packages will build from source there, also cached
+    assert [b.arch for b in builds] == ["x86_64"]
+    assert get_backend(archs=["x86_64"])[2] == builds
+
+
+def test_get_backend_pip_pdm(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    env = Path(__file__).parent / "env-for-parsing-pdm"
+    project = tmp_path / "project"
+    shutil.copytree(env, project)
+    monkeypatch.chdir(project)
+    monkeypatch.setenv("SNEKS_CACHE_DIR", str(tmp_path / "cache"))
+
+    with dask.config.set({"sneks.installer": "pip"}):
+        # This lockfile doesn't say which packages are dev dependencies
+        with pytest.raises(ValueError, match="groups"):
+            get_backend()
+
+        # Record them, like `pdm lock --strategy inherit_metadata`
+        dev = {"flake8", "mccabe", "pycodestyle", "pyflakes"}
+        lines = []
+        for line in (project / "pdm.lock").read_text().splitlines():
+            lines.append(line)
+            if line.startswith("name = "):
+                name = line.split('"')[1].lower()
+                lines.append(f'groups = ["{"dev" if name in dev else "default"}"]')
+        (project / "pdm.lock").write_text("\n".join(lines) + "\n")
+
+        plugin, _, _ = get_backend(archs=["x86_64"])
+    assert type(plugin).__name__ == "PipDepManager"
+    requirements = plugin._payload["requirements.txt"]
+    pins = {
+        line.split("==")[0].split(" @ ")[0]
+        for line in gzip.decompress(requirements).decode().splitlines()
+    }
+    assert "dask" in pins
+    assert not {"flake8", "colorama"} & pins
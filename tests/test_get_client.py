@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+from unittest import mock
+
+import coiled
+import dask.config
+import pytest
+
+from sneks import cache
+from sneks.get_client import _cluster, _install, _preserve_data, _senv, _senv_spec
+from sneks.plugin import INSTALL_OUTPUT_TOPIC
+from sneks.timing import StartupTimings
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("SNEKS_CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def coiled_calls(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    "Fake Coiled: creating senvs is recorded, and clusters only start with a freshly-created senv"
+    calls: list[str] = []
+    fresh = set()
+
+    def create_software_environment(name: str, **kwargs) -> None:
+        calls.append(f"senv {name}")
+        fresh.add(name)
+
+    def Cluster(software: str, **kwargs) -> str:
+        calls.append(f"cluster {software}")
+        if software not in fresh:
+            raise ValueError(f"Software environment {software} not found")
+        return "cluster"
+
+    monkeypatch.setattr(
+        coiled, "create_software_environment", create_software_environment
+    )
+    monkeypatch.setattr(coiled, "Cluster", Cluster)
+    return calls
+
+
+def test_stale_senv_retried(coiled_calls: list[str]):
+    name, image = _senv_spec()
+    cache.mark_senv_created("acct", name, image)
+    senv = _senv("acct")
+    assert senv == (name, True)
+    assert not coiled_calls
+
+    assert _cluster(senv, account="acct") == "cluster"
+    assert coiled_calls == [f"cluster {name}", f"senv {name}", f"cluster {name}"]
+    assert cache.senv_is_cached("acct", name, image)
+
+
+def test_other_errors_not_retried(coiled_calls: list[str], monkeypatch):
+    name, image = _senv_spec()
+    cache.mark_senv_created("acct", name, image)
+
+    def Cluster(software: str, **kwargs):
+        coiled_calls.append(f"cluster {software}")
+        raise ValueError("Your account is over its vCPU quota")
+
+    monkeypatch.setattr(coiled, "Cluster", Cluster)
+    with pytest.raises(ValueError, match="quota"):
+        _cluster(_senv("acct"), account="acct")
+    # The real error, after one attempt; the senv is forgotten in case, but not re-created
+    assert coiled_calls == [f"cluster {name}"]
+    assert not cache.senv_is_cached("acct", name, image)
+
+
+def test_fresh_senv_not_retried(coiled_calls: list[str], monkeypatch):
+    senv = _senv(None)
+    assert senv[1] is False
+    monkeypatch.setattr(coiled, "Cluster", lambda **kwargs: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        _cluster(senv)
+    # Forgotten anyway, in case it was deleted since
+    assert not cache.senv_is_cached(None, *_senv_spec())
+    assert coiled_calls == [f"senv {senv[0]}"]
+
+
+def test_preserve_data_needs_rolling_restart():
+    assert _preserve_data(None) is False
+    with dask.config.set({"sneks.preserve-data": True}):
+        assert _preserve_data(0.25) is True
+        # Every worker would retire at once, leaving nowhere for the data to go
+        for fraction in (None, 1.0):
+            with pytest.raises(ValueError, match="sneks.rolling-restart"):
+                _preserve_data(fraction)
+
+
+def test_install_unsubscribes_on_failure():
+    client = mock.Mock()
+    client.run_on_scheduler = mock.AsyncMock(return_value=None)
+    client.register_scheduler_plugin = mock.AsyncMock()
+    client.register_worker_plugin = mock.AsyncMock()
+    client.wait_for_workers = mock.AsyncMock(side_effect=TimeoutError)
+    cluster = mock.Mock(_start_n_workers=2)
+    plugin = mock.Mock(digest="new", token="token", upload=mock.AsyncMock())
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(
+            _install(client, cluster, plugin, None, StartupTimings(), None, None)
+        )
+    client.subscribe_topic.assert_called_once()
+    client.unsubscribe_topic.assert_called_once_with(INSTALL_OUTPUT_TOPIC)
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ["coiled", "distributed", "dask", "rich", "tomli", "cloudpickle"]
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "import sneks",
+        "import sneks.constants",
+        "import sneks.parse_poetry, sneks.parse_pdm",
+        "import sneks.cache, sneks.timing",
+    ],
+)
+def test_import_is_lazy(statement: str):
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"{statement}; import sys; print(' '.join(m for m in {HEAVY!r} if m in sys.modules))",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert proc.stdout.strip() == ""
+
+
+def test_lazy_attributes():
+    import sneks
+    from sneks.get_client import async_get_client, get_client
+
+    assert sneks.get_client is get_client
+    assert sneks.async_get_client is async_get_client
+    assert callable(sneks.can_import)
+
+    with pytest.raises(AttributeError):
+        sneks.foo  # type: ignore
+
+
+def test_plugin_imports_fcntl_lazily():
+    # The client imports the plugin module, and may be on Windows, which has no `fcntl`
+    import sneks.plugin
+
+    assert "fcntl" not in vars(sneks.plugin)
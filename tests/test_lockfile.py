@@ -0,0 +1,409 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+import tomli
+
+from sneks.lockfile import Lockfile, applies, project_dependencies
+from sneks.parse_pdm import locked_versions_pdm
+from sneks.parse_poetry import current_versions_poetry, locked_versions_poetry
+from sneks.platforms import marker_environment
+
+tests = Path(__file__).parent
+
+
+@pytest.fixture(scope="module")
+def poetry() -> Lockfile:
+    with open(tests / "env-for-parsing-poetry" / "poetry.lock", "rb") as f:
+        return Lockfile.from_poetry(tomli.load(f))
+
+
+@pytest.fixture(scope="module")
+def pdm() -> Lockfile:
+    with open(tests / "env-for-parsing-pdm" / "pdm.lock", "rb") as f:
+        return Lockfile.from_pdm(tomli.load(f))
+
+
+def test_index_is_normalized(poetry: Lockfile, pdm: Lockfile):
+    for lockfile in (poetry, pdm):
+        assert "MarkupSafe" in lockfile
+        assert lockfile["MarkupSafe"] is lockfile["markupsafe"]
+        assert lockfile["markupsafe"].key == "markupsafe"
+        assert lockfile.get("not-a-package") is None
+        with pytest.raises(KeyError):
+            lockfile["not-a-package"]
+
+
+def test_packages(poetry: Lockfile, pdm: Lockfile):
+    assert poetry["flake8"].dev
+    assert poetry["mypy"].optional
+    assert not poetry["dask"].dev and not poetry["dask"].optional
+    assert poetry["hypothesis"].source == "directory"
+    assert pdm["sneks-sync"].source == "directory"
+    for lockfile in (poetry, pdm):
+        yapf = lockfile["yapf"]
+        assert yapf.source == "git"
+        assert (
+            yapf.pip_arg
+            == "git+https://github.com/google/yapf.git@c6077954245bc3add82dafd853a1c7305a6ebd20"
+        )
+        assert lockfile["dask"].pip_arg == "dask==2022.5.2"
+        assert (
+            dict(lockfile["attrs"].files)["attrs-22.1.0-py2.py3-none-any.whl"]
+            == "sha256:86efa402f67bf2df34f51a335487cf46b1ec130d02b8d39fd248abfd30da551c"
+        )
+
+
+def test_dependencies(poetry: Lockfile, pdm: Lockfile):
+    for lockfile in (poetry, pdm):
+        deps = {p.key for p in lockfile.dependencies("distributed")}
+        assert {"dask", "click", "jinja2", "tornado", "zict"} <= deps
+        # Edges point at the lockfile's own records
+        assert lockfile["Jinja2"].key in deps
+        assert {p.key for p in lockfile.dependencies("jinja2")} == {"markupsafe"}
+
+    black, tomli_ = poetry.index["black"], poetry.index["tomli"]
+    assert poetry.markers[black, tomli_] == 'python_version < "3.11"'
+    assert (black, poetry.index["click"]) not in poetry.markers
+
+
+def test_closure(poetry: Lockfile):
+    closure = [p.key for p in poetry.closure(["Distributed"])]
+    assert closure[0] == "distributed"
+    assert len(closure) == len(set(closure))
+    assert {"dask", "jinja2", "markupsafe", "pyyaml", "zict", "heapdict"} <= set(
+        closure
+    )
+    assert "flake8" not in closure
+    assert poetry.closure(["not-a-package"]) == []
+
+
+def test_pdm_merges_extras():
+    lockfile = Lockfile.from_pdm(
+        {
+            "package": [
+                {"name": "dask", "version": "1.0", "dependencies": ["toolz"]},
+                {
+                    "name": "dask",
+                    "version": "1.0",
+                    "extras": ["array"],
+                    "dependencies": [
+                        "dask==1.0",
+                        "numpy>=1.18; python_version >= '3.8'",
+                    ],
+                },
+                {"name": "numpy", "version": "1.24.0"},
+                {"name": "toolz", "version": "0.12.0"},
+            ]
+        }
+    )
+    assert len(lockfile) == 3
+    # The extra's entry depending on the package itself isn't an edge
+    assert [p.key for p in lockfile.dependencies("dask")] == ["toolz", "numpy"]
+    dask, numpy = lockfile.index["dask"], lockfile.index["numpy"]
+    assert lockfile.markers[dask, numpy] == "python_version >= '3.8'"
+
+
+def test_poetry_alternative_markers():
+    lockfile = Lockfile.from_poetry(
+        {
+            "package": [
+                {
+                    "name": "pandas",
+                    "version": "1.5.0",
+                    "dependencies": {
+                        "numpy": [
+                            {"version": ">=1.21", "markers": 'python_version < "3.11"'},
+                            {
+                                "version": ">=1.23",
+                                "markers": 'python_version >= "3.11"',
+                            },
+                        ],
+                        "pytz": [{"version": ">=2020"}, {"version": ">=2021"}],
+                    },
+                },
+                {"name": "numpy", "version": "1.24.0"},
+                {"name": "pytz", "version": "2022.7"},
+            ]
+        }
+    )
+    pandas, numpy = lockfile.index["pandas"], lockfile.index["numpy"]
+    assert (
+        lockfile.markers[pandas, numpy]
+        == '(python_version < "3.11") or (python_version >= "3.11")'
+    )
+    assert (pandas, lockfile.index["pytz"]) not in lockfile.markers
+
+
+def test_parsers_accept_model(poetry: Lockfile, pdm: Lockfile):
+    reqs, _ = current_versions_poetry({"Jinja2"}, set(), poetry, {})
+    # Names are normalized, and dependencies included
+    assert set(reqs) == {"jinja2==3.1.2", "markupsafe==2.1.1"}
+    assert locked_versions_poetry(poetry)["markupsafe"] == "2.1.1"
+    assert locked_versions_pdm(pdm)["markupsafe"] == "2.1.1"
+
+
+def test_large_lockfile():
+    n = 5000
+    lockfile = Lockfile.from_pdm(
+        {
+            "package": [
+                {
+                    "name": f"Pkg_{i}",
+                    "version": "1.0",
+                    "dependencies": [f"pkg-{j}>=1" for j in (2 * i + 1, 2 * i + 2)],
+                }
+                for i in range(n)
+            ]
+        }
+    )
+    assert len(lockfile) == n
+    assert len(lockfile.closure(["pkg-0"])) == n
+    assert [p.key for p in lockfile.dependencies("pkg.1")] == ["pkg-3", "pkg-4"]
+
+
+def test_closure_markers(poetry: Lockfile):
+    linux = marker_environment("x86_64")
+    everywhere = {p.key for p in poetry.closure(["distributed"])}
+    on_linux = {p.key for p in poetry.closure(["distributed"], linux)}
+    # click needs colorama only on Windows
+    assert "colorama" in everywhere
+    assert everywhere - on_linux == {"colorama"}
+
+
+def test_targets():
+    lockfile = Lockfile.from_pdm(
+        {
+            "package": [
+                {
+                    "name": "distributed",
+                    "version": "1.0",
+                    "dependencies": [
+                        "toolz",
+                        "intel-only; platform_machine == 'x86_64'",
+                        "arm-only; platform_machine == 'aarch64'",
+                        "old-python; python_version < '3.0'",
+                    ],
+                },
+                {"name": "toolz", "version": "1.0"},
+                {"name": "intel-only", "version": "1.0"},
+                {"name": "arm-only", "version": "1.0", "dependencies": ["arm-dep"]},
+                {"name": "arm-dep", "version": "1.0"},
+                {"name": "old-python", "version": "1.0"},
+                {"name": "windows-only", "version": "1.0", "marker": "os_name == 'nt'"},
+            ]
+        }
+    )
+    envs = [marker_environment("x86_64"), marker_environment("aarch64")]
+    targets = lockfile.targets(["distributed", "windows-only"], envs)
+    # Not even asking for a package installs it where its own marker rules it out
+    assert {pkg.key: machines for pkg, machines in targets.items()} == {
+        "distributed": None,
+        "toolz": None,
+        "intel-only": ("x86_64",),
+        "arm-only": ("aarch64",),
+        "arm-dep": ("aarch64",),
+    }
+    assert {p.key for p in lockfile.targets(["distributed"], envs[:1])} == {
+        "distributed",
+        "toolz",
+        "intel-only",
+    }
+    # Without environments, every dependency
+    assert len(lockfile.targets(["distributed"], [])) == 6
+
+    assert lockfile["arm-only"].pip_args(("aarch64",)) == [
+        "arm-only==1.0;platform_machine=='aarch64'"
+    ]
+    assert lockfile["toolz"].pip_args(None) == ["toolz==1.0"]
+
+
+def test_multiple_versions():
+    py = marker_environment("x86_64")["python_version"]
+    lockfile = Lockfile.from_poetry(
+        {
+            "package": [
+                {
+                    "name": "pandas",
+                    "version": "1.5.0",
+                    "dependencies": {"numpy": ">=1.20", "old-only": "*"},
+                },
+                {
+                    "name": "numpy",
+                    "version": "1.26.4",
+                    "python-versions": f">={py}",
+                    "dependencies": {"new-only": "*"},
+                },
+                {
+                    "name": "numpy",
+                    "version": "1.24.4",
+                    "python-versions": f"<{py}",
+                    "dependencies": {"old-only": "*"},
+                },
+                {"name": "new-only", "version": "1"},
+                {"name": "old-only", "version": "1", "python-versions": f"<{py}"},
+            ]
+        }
+    )
+    assert len(lockfile) == 5
+    # Highest version by default
+    assert lockfile["numpy"].version == "1.26.4"
+    assert [lockfile.packages[i].version for i in lockfile.versions["numpy"]] == [
+        "1.26.4",
+        "1.24.4",
+    ]
+
+    here = marker_environment("x86_64")
+    older = {**here, "python_version": "3.0", "python_full_version": "3.0.0"}
+    assert lockfile.get("numpy", here).version == "1.26.4"
+    assert lockfile.get("numpy", older).version == "1.24.4"
+    assert lockfile.get("old-only", here) is None
+
+    # One version per package, with that version's dependencies
+    assert [(p.key, p.version) for p in lockfile.closure(["pandas"], here)] == [
+        ("pandas", "1.5.0"),
+        ("numpy", "1.26.4"),
+        ("new-only", "1"),
+    ]
+    assert [(p.key, p.version) for p in lockfile.closure(["pandas"], older)] == [
+        ("pandas", "1.5.0"),
+        ("numpy", "1.24.4"),
+        ("old-only", "1"),
+    ]
+
+    reqs, _ = current_versions_poetry({"pandas"}, set(), lockfile, {}, [here])
+    assert reqs == ["pandas==1.5.0", "numpy==1.26.4", "new-only==1"]
+    assert locked_versions_poetry(lockfile, older)["numpy"] == "1.24.4"
+    assert "old-only" not in locked_versions_poetry(lockfile, here)
+
+
+@pytest.mark.parametrize(
+    "constraint, marker",
+    [
+        ("*", None),
+        ("<3.8", 'python_full_version < "3.8"'),
+        (
+            ">=3.7,<3.11",
+            'python_full_version >= "3.7" and python_full_version < "3.11"',
+        ),
+        (
+            "<3.8 || >=3.12",
+            '(python_full_version < "3.8") or (python_full_version >= "3.12")',
+        ),
+        ("3.8", 'python_full_version == "3.8.*"'),
+        ("^3.8", None),
+    ],
+)
+def test_poetry_python_marker(constraint: str, marker: str | None):
+    lockfile = Lockfile.from_poetry(
+        {
+            "package": [
+                {
+                    "name": "a",
+                    "version": "1",
+                    "dependencies": {"b": {"version": "*", "python": constraint}},
+                },
+                {"name": "b", "version": "1"},
+            ]
+        }
+    )
+    assert lockfile.markers.get((0, 1)) == marker
+
+
+def test_installed():
+    lockfile = Lockfile.from_poetry(
+        {
+            "package": [
+                {
+                    "name": "app",
+                    "version": "1",
+                    "dependencies": {
+                        "win": {"version": "*", "markers": 'sys_platform == "win32"'},
+                        "shared": "*",
+                    },
+                },
+                {"name": "win", "version": "1", "dependencies": {"win-dep": "*"}},
+                {"name": "win-dep", "version": "1", "dependencies": {"shared": "*"}},
+                {"name": "shared", "version": "1"},
+                {
+                    "name": "dask",
+                    "version": "1",
+                    "dependencies": {
+                        "numpy": {"version": "*", "markers": 'extra == "array"'}
+                    },
+                },
+                {"name": "numpy", "version": "1"},
+                {"name": "win-tool", "version": "1"},
+            ]
+        }
+    )
+    linux = marker_environment("x86_64")
+    windows = {**linux, "sys_platform": "win32"}
+    roots = {
+        "app": None,
+        # Depended on, but also a direct dependency
+        "shared": None,
+        "win-tool": 'sys_platform == "win32"',
+    }
+    assert [p.key for p in lockfile.installed(roots, linux)] == ["app", "shared"]
+    assert {p.key for p in lockfile.installed(roots, windows)} == {
+        "app",
+        "shared",
+        "win",
+        "win-dep",
+        "win-tool",
+    }
+    # Whoever asked for dask[array] installs numpy
+    assert [p.key for p in lockfile.installed({"dask": None}, linux)] == [
+        "dask",
+        "numpy",
+    ]
+
+
+@pytest.mark.parametrize(
+    "marker, applies_",
+    [
+        ('extra == "array"', True),
+        ('extra == "array" and sys_platform == "win32"', False),
+        ('extra == "array" or extra == "complete"', True),
+        ("extra == 'array' and python_version < '3.0'", False),
+        ('extra != "array"', True),
+    ],
+)
+def test_applies_extras(marker: str, applies_: bool):
+    assert applies(marker, marker_environment("x86_64")) is applies_
+
+
+def test_project_dependencies():
+    assert project_dependencies(
+        {
+            "tool": {
+                "poetry": {
+                    "dependencies": {
+                        "python": "^3.9",
+                        "Dask": {"version": "*", "extras": ["array"]},
+                        "mypy": {"version": "*", "optional": True},
+                        "pywin32": {
+                            "version": "*",
+                            "markers": 'sys_platform == "win32"',
+                        },
+                    },
+                    "group": {"dev": {"dependencies": {"black": "*"}}},
+                }
+            }
+        },
+        "poetry",
+    ) == {"dask": None, "pywin32": 'sys_platform == "win32"'}
+    assert project_dependencies(
+        {
+            "project": {
+                "dependencies": [
+                    "Dask[array]>=2022",
+                    "pywin32; sys_platform == 'win32'",
+                ],
+                "optional-dependencies": {"test": ["pytest"]},
+            }
+        },
+        "pdm",
+    ) == {"dask": None, "pywin32": "sys_platform == 'win32'"}
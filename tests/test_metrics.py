@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+from rich.console import Console
+
+from sneks.metrics import InstallMetrics, percentile
+
+
+def report(nanny: str, total: float, token: str = "t2", **kwargs) -> dict:
+    return {  # like `DepManagerBase.setup` sends
+        "token": token,
+        "nanny": nanny,
+        "durations": {"check": 0.01, "install": total - 0.01, "total": total},
+        "skipped": False,
+        "changes": {"added": {"toolz": "0.12.0"}, "removed": {}, "updated": {}},
+        "restarted": False,
+        "tool": "Poetry",
+        "tool_version": "1.2.2",
+        **kwargs,
+    }
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([3.0], 90) == 3
+
+
+def test_install_metrics():
+    events = [
+        (1.0, report("n1", 100, token="t1")),
+        (2.0, report("n1", 10, index_downloaded=2**20)),
+        (3.0, report("n2", 30, cache_fetched=2**20, restarted=True)),
+        (4.0, report("n3", 20, skipped=True, durations={"total": 0.5})),
+    ]
+    metrics = InstallMetrics.from_events(events)
+    # Latest registration by default
+    assert set(metrics.reports) == {"n1", "n2", "n3"}
+    assert InstallMetrics.from_events(events, token="t1").durations() == {"n1": 100}
+
+    assert metrics.slowest(2) == [("n2", 30), ("n1", 10)]
+    assert metrics.percentiles("install") == {
+        "min": 9.99,
+        "p50": 9.99,
+        "p90": 29.99,
+        "p99": 29.99,
+        "max": 29.99,
+    }
+    summary = metrics.summary()
+    assert summary["workers"] == 3
+    assert summary["installed"] == 2
+    assert summary["restarted"] == 1
+    assert summary["tools"] == {"Poetry 1.2.2": 3}
+    assert summary["bytes"]["index_downloaded"] == 2**20
+    assert summary["bytes"]["cache_fetched"] == 2**20
+    assert summary["changes"]["added"] == ["toolz"]
+    assert list(summary["durations"]) == ["check", "install", "total"]
+
+    console = Console(width=120, record=True)
+    console.print(metrics)
+    text = console.export_text()
+    assert "3 worker(s)" in text
+    assert "index_downloaded" in text
+    assert "workers=3" in repr(metrics)
+
+
+def test_no_events():
+    metrics = InstallMetrics.from_events([])
+    assert metrics.summary()["workers"] == 0
+    assert metrics.percentiles() == {}
+    Console().print(metrics)
@@ -7,10 +7,40 @@ import pytest
 import tomli
 from importlib_metadata import version
 
-from sneks.parse_pdm import current_versions_pdm
+from sneks.lockfile import project_dependencies
+from sneks.parse_pdm import (
+    current_versions_pdm,
+    locked_versions_pdm,
+    records_groups_pdm,
+)
+from sneks.platforms import marker_environment
 
 env = Path(__file__).parent / "env-for-parsing-pdm"
 
+# Everything `dask` and `distributed` depend on, transitively, in the lockfile,
+# except `psutil`, which is overridden
+DISTRIBUTED_DEPS = {
+    "click==8.1.3",
+    "cloudpickle==2.2.0",
+    "colorama==0.4.6",
+    "fsspec==2022.11.0",
+    "heapdict==1.0.1",
+    "jinja2==3.1.2",
+    "locket==1.0.0",
+    "markupsafe==2.1.1",
+    "msgpack==1.0.4",
+    "packaging==21.3",
+    "partd==1.3.0",
+    "pyparsing==3.0.9",
+    "pyyaml==6.0",
+    "sortedcontainers==2.4.0",
+    "tblib==1.7.0",
+    "toolz==0.12.0",
+    "tornado==6.2",
+    "urllib3==1.26.13",
+    "zict==2.2.0",
+}
+
 
 @pytest.fixture(scope="module")
 def pyproject() -> dict[str, Any]:
@@ -32,8 +62,9 @@ def test_all_required(pyproject, lockfile):
         "dask==2022.5.2",
         "distributed==2022.5.2",
         "git+https://github.com/google/yapf.git@c6077954245bc3add82dafd853a1c7305a6ebd20",
+        *DISTRIBUTED_DEPS,
     }
-    assert not overrides
+    assert overrides == ["psutil==4.4.2"]
 
 
 def test_optional_included(pyproject, lockfile):
@@ -44,27 +75,26 @@ def test_optional_included(pyproject, lockfile):
         "dask==2022.5.2",
         "distributed==2022.5.2",
         "git+https://github.com/google/yapf.git@c6077954245bc3add82dafd853a1c7305a6ebd20",
+        *DISTRIBUTED_DEPS,
     }
-    assert not overrides
+    assert overrides == ["psutil==4.4.2"]
 
 
 def test_missing_optional_ignored(pyproject, lockfile):
     reqs, overrides = current_versions_pdm(
         {"dask", "distributed"}, {"bokeh", "foo"}, lockfile, pyproject
     )
-    assert set(reqs) == {
-        "dask==2022.5.2",
-        "distributed==2022.5.2",
-        "bokeh==2.4.3",
-    }
-    assert not overrides
+    assert {"dask==2022.5.2", "distributed==2022.5.2", "bokeh==2.4.3"} <= set(reqs)
+    # Along with bokeh's dependencies
+    assert "pillow==9.3.0" in reqs
+    assert not any(r.startswith("foo") for r in reqs)
+    assert overrides == ["psutil==4.4.2"]
 
 
 def test_override(pyproject, lockfile):
-    reqs, overrides = current_versions_pdm(
-        {"distributed"}, {"psutil"}, lockfile, pyproject
-    )
-    assert set(reqs) == {"distributed==2022.5.2"}
+    reqs, overrides = current_versions_pdm({"distributed"}, set(), lockfile, pyproject)
+    assert set(reqs) == {"dask==2022.5.2", "distributed==2022.5.2", *DISTRIBUTED_DEPS}
+    # Even though it's a dependency of distributed, not listed explicitly
     assert set(overrides) == {"psutil==4.4.2"}
 
 
@@ -98,8 +128,45 @@ def test_optional_is_path_allowed(pyproject, lockfile):
     reqs, overrides = current_versions_pdm(
         {"distributed"}, {"sneks-sync"}, lockfile, pyproject
     )
-    assert set(reqs) == {
+    assert {
         "distributed==2022.5.2",
         f"sneks-sync=={version('sneks-sync')}",
-    }
+    } <= set(reqs)
     assert not overrides
+
+
+def test_locked_versions(lockfile):
+    versions = locked_versions_pdm(lockfile)
+    assert versions["dask"] == "2022.5.2"
+    assert versions["markupsafe"] == "2.1.1"
+    assert (
+        versions["yapf"]
+        == "git+https://github.com/google/yapf.git@c6077954245bc3add82dafd853a1c7305a6ebd20"
+    )
+
+
+def test_locked_versions_installed(pyproject, lockfile):
+    linux = marker_environment("x86_64")
+    roots = project_dependencies(pyproject, "pdm")
+    versions = locked_versions_pdm(lockfile, linux, roots)
+    assert versions["dask"] == "2022.5.2"
+    # Only on Windows
+    assert "colorama" in locked_versions_pdm(lockfile, linux)
+    assert "colorama" not in versions
+    # Only for dev dependencies
+    assert "flake8" not in versions
+
+
+def test_groups():
+    lockfile = {
+        "package": [
+            {"name": "dask", "version": "1.0", "groups": ["default", "dev"]},
+            {"name": "flake8", "version": "6.0", "groups": ["dev"]},
+        ]
+    }
+    assert records_groups_pdm(lockfile)
+    assert locked_versions_pdm(lockfile) == {"dask": "1.0"}
+
+    del lockfile["package"][1]["groups"]
+    assert not records_groups_pdm(lockfile)
+    assert locked_versions_pdm(lockfile) == {"dask": "1.0", "flake8": "6.0"}
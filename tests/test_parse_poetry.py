@@ -6,10 +6,40 @@ from typing import Any
 import pytest
 import tomli
 
-from sneks.parse_poetry import current_versions_poetry
+from sneks.lockfile import project_dependencies
+from sneks.parse_poetry import (
+    current_versions_poetry,
+    locked_hashes_poetry,
+    locked_versions_poetry,
+)
+from sneks.platforms import marker_environment
 
 env = Path(__file__).parent / "env-for-parsing-poetry"
 
+# Everything `dask` and `distributed` depend on, transitively, in the lockfile
+DISTRIBUTED_DEPS = {
+    "click==8.1.3",
+    "cloudpickle==2.2.0",
+    "colorama==0.4.5",
+    "fsspec==2022.8.2",
+    "heapdict==1.0.1",
+    "jinja2==3.1.2",
+    "locket==1.0.0",
+    "markupsafe==2.1.1",
+    "msgpack==1.0.4",
+    "packaging==21.3",
+    "partd==1.3.0",
+    "psutil==5.9.2",
+    "pyparsing==3.0.9",
+    "pyyaml==6.0",
+    "sortedcontainers==2.4.0",
+    "tblib==1.7.0",
+    "toolz==0.12.0",
+    "tornado==6.2",
+    "urllib3==1.22",
+    "zict==2.2.0",
+}
+
 
 @pytest.fixture(scope="module")
 def pyproject() -> dict[str, Any]:
@@ -31,6 +61,7 @@ def test_all_required(pyproject, lockfile):
         "dask==2022.5.2",
         "distributed==2022.5.2",
         "git+https://github.com/google/yapf.git@c6077954245bc3add82dafd853a1c7305a6ebd20",
+        *DISTRIBUTED_DEPS,
     }
     assert not overrides
 
@@ -43,6 +74,7 @@ def test_optional_included(pyproject, lockfile):
         "dask==2022.5.2",
         "distributed==2022.5.2",
         "git+https://github.com/google/yapf.git@c6077954245bc3add82dafd853a1c7305a6ebd20",
+        *DISTRIBUTED_DEPS,
     }
     assert not overrides
 
@@ -51,11 +83,10 @@ def test_missing_optional_ignored(pyproject, lockfile):
     reqs, overrides = current_versions_poetry(
         {"dask", "distributed"}, {"bokeh", "foo"}, lockfile, pyproject
     )
-    assert set(reqs) == {
-        "dask==2022.5.2",
-        "distributed==2022.5.2",
-        "bokeh==2.4.3",
-    }
+    assert {"dask==2022.5.2", "distributed==2022.5.2", "bokeh==2.4.3"} <= set(reqs)
+    # Along with bokeh's dependencies
+    assert "pillow==9.2.0" in reqs
+    assert not any(r.startswith("foo") for r in reqs)
     assert not overrides
 
 
@@ -96,3 +127,55 @@ def test_current_package_versions_uninstallable():
         NotImplementedError, match="'sneks-sync' is installed as a path dependency"
     ):
         current_versions_poetry(set(), set(), lockfile, pyproject)
+
+
+def test_locked_versions(lockfile):
+    versions = locked_versions_poetry(lockfile)
+    assert versions["dask"] == "2022.5.2"
+    assert versions["markupsafe"] == "2.1.1"
+    assert (
+        versions["yapf"]
+        == "git+https://github.com/google/yapf.git@c6077954245bc3add82dafd853a1c7305a6ebd20"
+    )
+    # Dev and optional dependencies aren't installed
+    assert "flake8" not in versions
+    assert "mypy" not in versions
+
+
+def test_locked_versions_installed(pyproject, lockfile):
+    linux = marker_environment("x86_64")
+    roots = project_dependencies(pyproject, "poetry")
+    versions = locked_versions_poetry(lockfile, linux, roots)
+    assert versions["dask"] == "2022.5.2"
+    # Only on Windows
+    assert "colorama" in locked_versions_poetry(lockfile, linux)
+    assert "colorama" not in versions
+    # Only for dev dependencies
+    assert "flake8" not in versions
+
+
+def test_locked_hashes(lockfile):
+    hashes = locked_hashes_poetry(lockfile)
+    assert hashes["attrs"] == [
+        "sha256:86efa402f67bf2df34f51a335487cf46b1ec130d02b8d39fd248abfd30da551c",
+        "sha256:29adc2665447e5191d0e7c568fde78b21f9672d344281d0c6e1ab085429b22b6",
+    ]
+    assert hashes["markupsafe"]
+    # Git dependencies have no files to hash
+    assert hashes["yapf"] == []
+
+
+def test_markers_for_target(pyproject, lockfile):
+    reqs, _ = current_versions_poetry(
+        {"dask", "distributed"},
+        set(),
+        lockfile,
+        pyproject,
+        [marker_environment("x86_64"), marker_environment("aarch64")],
+    )
+    # Only click's Windows dependency doesn't apply
+    assert set(reqs) == {
+        "dask==2022.5.2",
+        "distributed==2022.5.2",
+        *DISTRIBUTED_DEPS,
+    } - {"colorama==0.4.5"}
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import sys
+
+import pytest
+
+from sneks.platforms import (
+    cluster_arch,
+    cluster_archs,
+    instance_arch,
+    marker_environment,
+    platform_tags,
+)
+
+
+@pytest.mark.parametrize(
+    "vm_type, arch",
+    [
+        ("m6g.xlarge", "aarch64"),
+        ("c7gn.large", "aarch64"),
+        ("t4g.medium", "aarch64"),
+        ("r6gd.2xlarge", "aarch64"),
+        ("t2a-standard-4", "aarch64"),
+        ("m6i.xlarge", "x86_64"),
+        ("g5.xlarge", "x86_64"),
+        ("c5n.large", "x86_64"),
+        ("e2-standard-4", "x86_64"),
+        ("t2d-standard-4", "x86_64"),
+    ],
+)
+def test_instance_arch(vm_type: str, arch: str):
+    assert instance_arch(vm_type) == arch
+
+
+def test_cluster_arch():
+    assert cluster_arch({}) == "x86_64"
+    assert cluster_arch({"worker_vm_types": None}) == "x86_64"
+    assert cluster_arch({"worker_vm_types": ["m6g.large", "c6g.large"]}) == "aarch64"
+    assert cluster_arch({"worker_vm_types": "t2a-standard-8"}) == "aarch64"
+    with pytest.raises(ValueError, match="mix"):
+        cluster_arch({"worker_vm_types": ["m6g.large", "m6i.large"]})
+
+
+def test_cluster_archs():
+    assert cluster_archs({}) == ["x86_64"]
+    assert cluster_archs({"worker_vm_types": ["m6g.large", "m6i.large"]}) == [
+        "aarch64",
+        "x86_64",
+    ]
+    # The scheduler installs the boot-time packages too
+    assert cluster_archs(
+        {"worker_vm_types": ["m6g.large"], "scheduler_vm_types": ["m6g.large"]}
+    ) == ["aarch64"]
+    assert cluster_archs({"worker_vm_types": ["m6g.large"]}) == ["aarch64", "x86_64"]
+    assert cluster_archs({"scheduler_vm_types": "t2a-standard-4"}) == [
+        "aarch64",
+        "x86_64",
+    ]
+
+
+def test_marker_environment():
+    env = marker_environment("aarch64")
+    assert env["platform_machine"] == "aarch64"
+    assert env["sys_platform"] == "linux"
+    assert env["python_version"] == "{}.{}".format(*sys.version_info)
+
+
+def test_platform_tags():
+    assert "manylinux2014_aarch64" in platform_tags("aarch64")
+    assert "manylinux1_x86_64" in platform_tags("x86_64")
+    assert all(t.endswith("_aarch64") for t in platform_tags("aarch64"))
+    # Up to the images' glibc, and no newer
+    assert platform_tags("x86_64")[0] == "manylinux_2_36_x86_64"
+    assert "manylinux_2_34_x86_64" in platform_tags("x86_64")
@@ -1,18 +1,45 @@
 import asyncio
 import importlib.metadata
 import os
+import platform
+import shutil
 import subprocess
 import sys
 import time
 from pathlib import Path
+from types import SimpleNamespace
 from unittest import mock
 
 import cloudpickle
 import pytest
+import tomli
 from distributed.client import Client
-from distributed.protocol.pickle import dumps
+from distributed.core import rpc
+from distributed.protocol.pickle import dumps, loads
+from distributed.utils_test import gen_cluster, inc
 
-from sneks.plugin import PdmDepManager, PoetryDepManager
+import sneks.plugin
+from sneks.lockfile import project_dependencies
+from sneks.parse_pdm import locked_versions_pdm
+from sneks.parse_poetry import locked_versions_poetry
+from sneks.platforms import marker_environment
+from sneks.plugin import (
+    OUTPUT_TAIL_LINES,
+    ArtifactStore,
+    DepManagerWatcher,
+    OutputForwarder,
+    PdmDepManager,
+    PoetryDepManager,
+    diff_environments,
+    environment_digest,
+    host_lock,
+    installed_distributions,
+    pack_environment,
+    read_install_marker,
+    unpack_environment,
+    worker_started_before,
+    write_install_marker,
+)
 
 from .update_test_envs import PIP_OVERRIDES, update_test_envs
 
@@ -24,29 +51,41 @@ class TestPickle:
     def test_pickle_by_value(self, mock_cp_dumps: mock.Mock):
         obj = PoetryDepManager(b"hello", b"world")
         pickled = dumps(obj)
-        mock_cp_dumps.assert_called_once()
-        assert not hasattr(obj, "_the_first_pickle_is_the_deepest")
-
+        # Plain pickle is enough; no cloudpickle fallback
+        mock_cp_dumps.assert_not_called()
         assert dumps(obj) == pickled
-        assert not hasattr(obj, "_the_first_pickle_is_the_deepest")
 
         proc = subprocess.run(
             [
                 sys.executable,
                 "-c",
                 (
-                    "import cloudpickle; "
+                    "import pickle; "
                     "import sys; "
                     "sys.modules['sneks'] = None; "
-                    f"print(cloudpickle.loads({pickled!r})._compressed_lockfile)"
+                    "obj = pickle.loads(sys.stdin.buffer.read()); "
+                    "print(obj.digest, obj._payload, flush=True); "
+                    "sys.stdout.buffer.write(pickle.dumps(obj, protocol=5))"
                 ),
             ],
+            input=pickled,
             cwd="/",
             capture_output=True,
             check=True,
-            text=True,
         )
-        assert proc.stdout.strip() == repr(obj._compressed_lockfile)
+        first, repickled = proc.stdout.split(b"\n", 1)
+        # The lockfile itself stays on the client; nannies fetch it by digest
+        assert first.decode() == f"{obj.digest} None"
+        assert obj._payload is not None
+        assert b"world" not in pickled
+        # Can be pickled again on the cluster, to the same bytes
+        assert repickled == pickled
+
+    def test_unpickle_reuses_module(self):
+        a = loads(dumps(PoetryDepManager(b"a", b"b")))
+        b = loads(dumps(PdmDepManager(b"a", b"b")))
+        assert type(a).__module__ == type(b).__module__ != PoetryDepManager.__module__
+        assert isinstance(b, sys.modules[type(a).__module__].DepManagerBase)
 
     class Basic:
         def __init__(self, msg: str) -> None:
@@ -74,6 +113,324 @@ class TestPickle:
         assert "ModuleNotFoundError" in proc.stderr
 
 
+def test_digest():
+    a = PoetryDepManager(b"pyproject", b"lockfile")
+    assert a.digest == PoetryDepManager(b"pyproject", b"lockfile").digest
+    assert a.digest != PdmDepManager(b"pyproject", b"lockfile").digest
+    assert a.digest != PoetryDepManager(b"pyproject", b"lockfile2").digest
+    # Boundaries between the parts matter
+    assert environment_digest("Poetry", b"ab", b"c") != environment_digest(
+        "Poetry", b"a", b"bc"
+    )
+
+
+def test_worker_started_before():
+    now = time.time()
+    # Plugins are set up before the nanny starts a worker: nothing to restart
+    assert not worker_started_before(SimpleNamespace(process=None), now)
+    assert not worker_started_before(
+        SimpleNamespace(process=SimpleNamespace(process=None)), now
+    )
+
+    this = SimpleNamespace(
+        process=SimpleNamespace(process=SimpleNamespace(pid=os.getpid()))
+    )
+    assert worker_started_before(this, now)
+    assert not worker_started_before(this, 0)
+
+
+def test_install_marker(tmp_path: Path):
+    marker = tmp_path / "marker.json"
+    assert read_install_marker(marker) is None
+    write_install_marker(
+        marker, {"digest": "abc", "installed_at": 1.0, "restart": False}
+    )
+    assert read_install_marker(marker) == {
+        "digest": "abc",
+        "installed_at": 1.0,
+        "restart": False,
+    }
+    marker.write_text("garbage")
+    assert read_install_marker(marker) is None
+    # Old marker format
+    marker.write_text('{"digest": "abc"}')
+    assert read_install_marker(marker) is None
+
+
+def test_host_lock(tmp_path: Path):
+    lock = tmp_path / "lock"
+    order: list[str] = []
+
+    async def hold(name: str) -> None:
+        async with host_lock(lock, poll_interval=0.01):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.05)
+            order.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(hold("a"), hold("b"))
+
+    asyncio.run(main())
+    # Critical sections don't interleave
+    assert order in (
+        ["a start", "a end", "b start", "b end"],
+        ["b start", "b end", "a start", "a end"],
+    )
+
+
+def test_install_digest(tmp_path: Path):
+    # Fake tool installed in its own venv, like `senv/Dockerfile` does
+    venv = tmp_path / "poetry-venv"
+    (venv / "bin").mkdir(parents=True)
+    (venv / "lib" / "python3.9" / "site-packages" / "poetry-1.2.3.dist-info").mkdir(
+        parents=True
+    )
+    tool = venv / "bin" / "poetry"
+    tool.touch()
+    link = tmp_path / "poetry"
+    link.symlink_to(tool)
+
+    plugin = PoetryDepManager(b"pyproject", b"lockfile")
+    assert plugin.get_tool_version(link) == "1.2.3"
+    assert plugin.get_tool_version(tmp_path / "nowhere" / "bin" / "poetry") == (
+        "unknown"
+    )
+
+    digest = plugin.install_digest(link)
+    assert digest == PoetryDepManager(b"pyproject", b"lockfile").install_digest(link)
+    assert digest != PoetryDepManager(b"pyproject", b"other").install_digest(link)
+
+    (venv / "lib" / "python3.9" / "site-packages" / "poetry-1.2.3.dist-info").rename(
+        venv / "lib" / "python3.9" / "site-packages" / "poetry-1.3.0.dist-info"
+    )
+    assert plugin.install_digest(link) != digest
+
+
+def test_diff_environments():
+    before = {"a": "1", "b": "1", "c": "1"}
+    after = {"a": "1", "b": "2", "d": "1"}
+    diff = diff_environments(before, after)
+    assert diff.added == {"d": "1"}
+    assert diff.removed == {"c": "1"}
+    assert diff.updated == {"b": ("1", "2")}
+    assert diff.needs_restart
+    assert diff.needs_install
+    assert str(diff) == "+d==1, -c==1, b 1 -> 2"
+
+    # Only additions: no need to restart
+    diff = diff_environments(before, {**before, "d": "1"})
+    assert diff.needs_install
+    assert not diff.needs_restart
+
+    # Extra installed packages don't need installing
+    diff = diff_environments(before, {"a": "1"})
+    assert not diff.needs_install
+    assert str(diff_environments(before, before)) == "none"
+
+
+def test_installed_distributions():
+    dists = installed_distributions()
+    assert dists["distributed"] == importlib.metadata.version("distributed")
+    assert all(name == name.lower() and "_" not in name for name in dists)
+
+
+@pytest.mark.parametrize(
+    "tool, locked_versions",
+    [("poetry", locked_versions_poetry), ("pdm", locked_versions_pdm)],
+)
+def test_install_skipped(tool, locked_versions, monkeypatch: pytest.MonkeyPatch):
+    env = Path(__file__).parent / f"env-for-parsing-{tool}"
+    pyproject = tomli.loads((env / "pyproject.toml").read_text())
+    lockfile = tomli.loads(next(env.glob("*.lock")).read_text())
+    machine = platform.machine()
+    locked = locked_versions(
+        lockfile, marker_environment(machine), project_dependencies(pyproject, tool)
+    )
+    # Packages only for Windows or for development are never installed on the cluster
+    assert not {"colorama", "flake8"} & set(locked)
+
+    plugin = PoetryDepManager(b"pyproject", b"lockfile", {machine: locked})
+    install_locally = mock.AsyncMock(return_value="installed")
+    monkeypatch.setattr(plugin, "install_locally", install_locally)
+
+    def install(installed: dict[str, str], previous: dict | None = None):
+        monkeypatch.setattr(sneks.plugin, "installed_distributions", lambda: installed)
+        return asyncio.run(
+            plugin.install_environment(
+                None, Path("poetry"), lambda _: None, {}, previous
+            )
+        )
+
+    # Everything locked, plus whatever else the image has
+    assert not install({**locked, "preinstalled": "1.0"}).needs_install
+    install_locally.assert_not_called()
+
+    missing = {**locked}
+    del missing["dask"]
+    assert install(missing) == "installed"
+    install_locally.assert_called_once()
+
+    # A package the last install locked, but this lockfile doesn't, has to be removed
+    previous = {"digest": "old", "installed_at": 0, "restart": False}
+    extra = {**locked, "dropped": "1.0"}
+    assert install(extra, {**previous, "locked": [*locked, "dropped"]}) == "installed"
+    # Unless it's gone already
+    assert not install(
+        locked, {**previous, "locked": [*locked, "dropped"]}
+    ).needs_install
+    # If the last install didn't say what it locked, it may have been anything
+    assert install(extra, previous) == "installed"
+    assert install_locally.call_count == 3
+
+
+def test_payload_roundtrip(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    store = ArtifactStore(tmp_path / "store")
+
+    async def sneks_artifacts(namespace: str) -> dict[str, int]:
+        return store.manifest(namespace)
+
+    scheduler = SimpleNamespace(
+        sneks_artifacts=sneks_artifacts,
+        sneks_artifact_get=store.get,
+        sneks_artifact_put=store.put,
+    )
+    nanny = SimpleNamespace(scheduler=scheduler)
+    monkeypatch.setattr(sys, "prefix", str(tmp_path / "venv"))
+
+    plugin = PdmDepManager(b"pyproject", b"lockfile")
+    # As it arrives on the nanny
+    remote = cloudpickle.loads(dumps(plugin))
+    assert remote._payload is None
+
+    with pytest.raises(RuntimeError, match="not on the scheduler"):
+        asyncio.run(remote.fetch_payload(nanny))
+
+    asyncio.run(plugin.upload(scheduler))
+    payload = asyncio.run(remote.fetch_payload(nanny))
+    assert payload == plugin._payload
+
+    # Cached locally after the first fetch
+    scheduler.sneks_artifacts = None
+    assert asyncio.run(remote.fetch_payload(nanny)) == payload
+
+
+@gen_cluster(client=True)
+async def test_retire_data(c, s, a, b):
+    x = c.submit(inc, 1, key="x", workers=[a.address])
+    await x
+    assert "x" in a.data
+
+    plugin = PoetryDepManager(b"hello", b"world")
+    nanny = SimpleNamespace(scheduler=rpc(s.address), worker_address=a.address)
+    try:
+        await plugin.retire_data(nanny)
+    finally:
+        await nanny.scheduler.close_rpc()
+    # Data copied to the other worker, which the first won't get tasks anymore
+    assert "x" in b.data
+    assert a.address in s.workers
+    assert await c.submit(inc, x) == 3
+
+
+def _fake_dist(site: Path, name: str, version: str, module: str) -> None:
+    dist_info = site / f"{name}-{version}.dist-info"
+    dist_info.mkdir()
+    (dist_info / "METADATA").write_text(f"Name: {name}\nVersion: {version}\n")
+    (site / f"{module}.py").write_text(f"VERSION = {version!r}\n")
+    (dist_info / "RECORD").write_text(
+        f"{module}.py,,\n{dist_info.name}/METADATA,,\n{dist_info.name}/RECORD,,\n"
+    )
+
+
+def test_pack_environment(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    prefix = tmp_path / "venv"
+    site = prefix / "lib" / "site-packages"
+    site.mkdir(parents=True)
+    monkeypatch.setattr(sys, "prefix", str(prefix))
+    monkeypatch.setattr(sys, "path", [str(site)])
+
+    # What the first nanny started from
+    _fake_dist(site, "old", "1.0", "old")
+    _fake_dist(site, "changed", "1.0", "changed")
+    before = installed_distributions()
+    start = {p: p.read_bytes() for p in site.rglob("*") if p.is_file()}
+
+    # It installed this
+    remove_tree = [p for p in site.iterdir() if "old" in p.name or "changed" in p.name]
+    for p in remove_tree:
+        if p.is_dir():
+            shutil.rmtree(p)
+        else:
+            p.unlink()
+    _fake_dist(site, "changed", "2.0", "changed")
+    _fake_dist(site, "new", "1.0", "new")
+    changes = diff_environments(before, installed_distributions())
+    assert str(changes) == "+new==1.0, -old==1.0, changed 1.0 -> 2.0"
+    after = {p: p.read_bytes() for p in site.rglob("*") if p.is_file()}
+
+    archive = tmp_path / "env.tar.gz"
+    pack_environment(changes, archive)
+
+    # Another nanny, starting from the same environment, unpacks it
+    shutil.rmtree(site)
+    site.mkdir()
+    for p, data in start.items():
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_bytes(data)
+    assert installed_distributions() == before
+
+    unpack_environment(archive)
+    assert installed_distributions() == {"new": "1.0", "changed": "2.0"}
+    assert {p: p.read_bytes() for p in site.rglob("*") if p.is_file()} == after
+    assert not list(site.glob("old*"))
+
+
+def test_output_forwarder_flushes_when_quiet(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(sneks.plugin, "OUTPUT_FLUSH_INTERVAL", 0.05)
+    events: list[list[tuple[str, str]]] = []
+    nanny = SimpleNamespace(
+        address="tcp://nanny",
+        log_event=lambda topic, msg: events.append(msg["lines"]),
+    )
+
+    async def main():
+        output = OutputForwarder(nanny, "token")
+        output.add("stdout", "a")
+        output.add("stderr", "b")
+        assert not events
+        # The installer goes quiet; what it printed is still sent, in one batch
+        await asyncio.sleep(0.2)
+        assert events == [[("stdout", "a"), ("stderr", "b")]]
+
+        output.add("stdout", "c")
+        output.flush()
+        await asyncio.sleep(0.2)
+        assert events[1:] == [[("stdout", "c")]]
+
+    asyncio.run(main())
+
+
+def test_run_streams_output():
+    plugin = PoetryDepManager(b"hello", b"world")
+    lines: list[tuple[str, str]] = []
+    plugin._output = mock.Mock(add=lambda *line: lines.append(line))
+
+    script = "import sys; print('out'); print('err', file=sys.stderr)"
+    stdout, stderr = asyncio.run(plugin.run(sys.executable, "-c", script, tee=False))
+    assert (stdout, stderr) == (b"out\n", b"err\n")
+    assert sorted(lines) == [("stderr", "err"), ("stdout", "out")]
+    plugin._output.flush.assert_called()
+
+    # Only the tail of the output is kept
+    script = f"for i in range({OUTPUT_TAIL_LINES * 2}): print(i)\nraise SystemExit(3)"
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        asyncio.run(plugin.run(sys.executable, "-c", script, tee=False))
+    assert exc_info.value.returncode == 3
+    out = exc_info.value.stdout.decode().splitlines()
+    assert out == [str(i) for i in range(OUTPUT_TAIL_LINES, OUTPUT_TAIL_LINES * 2)]
+    assert len(lines) == 2 + OUTPUT_TAIL_LINES * 2
+
+
 # NOTE: see conftest.py for how we set env vars to inject into the docker-compose build process
 
 
@@ -125,8 +482,10 @@ def test_plugin(updated_test_envs, function_scoped_container_getter, plugin_type
         with open(root / plugin_type.LOCKFILE_NAME, "rb") as f:
             lockfile = f.read()
 
+        client.register_scheduler_plugin(DepManagerWatcher())
         pids = client.run(os.getpid)
         plugin = plugin_type(pyproject, lockfile)
+        client.sync(plugin.upload, client.scheduler)
         try:
             client.register_worker_plugin(plugin)
         except subprocess.CalledProcessError as e:
@@ -145,11 +504,25 @@ def test_plugin(updated_test_envs, function_scoped_container_getter, plugin_type
         # Workers were restarted
         assert client.run(os.getpid) != pids
 
+        # Downloads were shared with the scheduler (uploads happen in the background)
+        def manifest(dask_scheduler):
+            return dask_scheduler.plugins[DepManagerWatcher.name].store.manifest(
+                "tool-cache"
+            )
+
+        start = time.monotonic()
+        while not client.run_on_scheduler(manifest):
+            assert time.monotonic() - start < 30, "No artifacts uploaded"
+            time.sleep(0.5)
+
         # Registering with same deps doesn't cause restart
         pids = client.run(os.getpid)
+        plugin = plugin_type(pyproject, lockfile)
+        client.sync(plugin.upload, client.scheduler)
         try:
             client.register_worker_plugin(plugin)
         except subprocess.CalledProcessError as e:
             print("[stdout]", e.stdout.decode())
             print("[stderr]", e.stderr.decode())
             raise
+        assert client.run(os.getpid) == pids
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import time
+
+from rich.console import Console
+
+from sneks.timing import StartupTimings
+
+
+def test_phases():
+    timings = StartupTimings()
+    with timings.phase("a"):
+        time.sleep(0.01)
+    with timings.phase("b"):
+        pass
+    # Repeated phases accumulate
+    with timings.phase("a"):
+        time.sleep(0.01)
+    timings.finish()
+
+    assert list(timings.phases) == ["a", "b"]
+    assert timings.phases["a"] >= 0.02
+    assert timings.total is not None
+    assert timings.total >= timings.phases["a"] + timings.phases["b"]
+
+
+def test_phase_timed_on_error():
+    timings = StartupTimings()
+    try:
+        with timings.phase("boom"):
+            raise ValueError
+    except ValueError:
+        pass
+    assert "boom" in timings.phases
+
+
+def test_worker_events():
+    timings = StartupTimings()
+    events = [
+        (
+            0.0,
+            {
+                "token": "old",
+                "nanny": "tcp://a",
+                "durations": {"total": 100.0},
+                "restarted": True,
+            },
+        ),
+        (
+            1.0,
+            {
+                "token": "new",
+                "nanny": "tcp://a",
+                "durations": {"total": 1.0},
+                "restarted": False,
+            },
+        ),
+        (
+            2.0,
+            {
+                "token": "new",
+                "nanny": "tcp://b",
+                "durations": {"total": 3.0},
+                "restarted": True,
+            },
+        ),
+    ]
+    timings.add_worker_events(events, "new")
+    assert sorted(timings.worker_installs) == [1.0, 3.0]
+    assert timings.worker_restarts == 1
+
+    console = Console(record=True, width=120)
+    console.print(timings)
+    text = console.export_text()
+    assert "install on 2 worker(s)" in text
+    assert "workers restarted" in text
@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from sneks import plugin as plugin_module
+from sneks.plugin import (
+    ArtifactStore,
+    DepManagerWatcher,
+    PoetryDepManager,
+    SlotLimiter,
+    fetch_artifact,
+    upload_artifact,
+)
+
+
+class FakeScheduler:
+    "Just enough of a `Scheduler` for `DepManagerWatcher`"
+
+    def __init__(self) -> None:
+        self.workers: dict[str, SimpleNamespace] = {}
+        self.handlers: dict[str, object] = {}
+        self.nanny_plugins: dict[str, bytes] = {}
+        self.calls: list[tuple[str, bytes, str]] = []
+
+    def add(self, worker: str, nanny: str | None) -> None:
+        self.workers[worker] = SimpleNamespace(nanny=nanny)
+
+    def rpc(self, addr: str):
+        async def plugin_add(plugin: bytes, name: str) -> dict:
+            self.calls.append((addr, plugin, name))
+            return {"status": "OK"}
+
+        return SimpleNamespace(plugin_add=plugin_add)
+
+
+def scheduler_rpc(scheduler: FakeScheduler) -> SimpleNamespace:
+    "What a nanny's ``self.scheduler`` looks like: every handler, awaitable"
+
+    def wrap(handler):
+        async def call(**kwargs):
+            result = handler(**kwargs)
+            return await result if asyncio.iscoroutine(result) else result
+
+        return call
+
+    return SimpleNamespace(**{k: wrap(h) for k, h in scheduler.handlers.items()})
+
+
+async def settle(watcher: DepManagerWatcher) -> None:
+    while watcher._tasks:
+        await asyncio.gather(*watcher._tasks)
+
+
+def test_watcher_pushes_to_new_nannies():
+    async def main():
+        scheduler = FakeScheduler()
+        scheduler.add("tcp://w1", "tcp://n1")
+        watcher = DepManagerWatcher("DepManager")
+        await watcher.start(scheduler)  # type: ignore
+        await settle(watcher)
+        # Plugin not registered yet; nothing to push
+        assert not scheduler.calls
+
+        plugin = b"plugin-v1"
+        scheduler.nanny_plugins["DepManager"] = plugin
+        scheduler.add("tcp://w2", "tcp://n2")
+        scheduler.add("tcp://w3", None)  # no nanny
+        watcher.add_worker(scheduler, "tcp://w2")  # type: ignore
+        watcher.add_worker(scheduler, "tcp://w3")  # type: ignore
+        await settle(watcher)
+        assert scheduler.calls == [("tcp://n2", plugin, "DepManager")]
+
+        # Worker restarting under the same nanny doesn't get it again
+        watcher.add_worker(scheduler, "tcp://w2")  # type: ignore
+        await settle(watcher)
+        assert len(scheduler.calls) == 1
+
+        # But a new version of the plugin is pushed
+        plugin2 = b"plugin-v2"
+        scheduler.nanny_plugins["DepManager"] = plugin2
+        watcher.add_worker(scheduler, "tcp://w2")  # type: ignore
+        await settle(watcher)
+        assert scheduler.calls[-1] == ("tcp://n2", plugin2, "DepManager")
+
+        await watcher.close()
+
+    asyncio.run(main())
+
+
+def test_watcher_serves_artifacts():
+    async def main():
+        scheduler = FakeScheduler()
+        watcher = DepManagerWatcher("DepManager")
+        await watcher.start(scheduler)  # type: ignore
+        assert scheduler.handlers["sneks_artifacts"]("tool-cache") == {}
+        root = watcher.store.root
+        assert root.is_dir()
+        await watcher.close()
+        assert not root.exists()
+
+    asyncio.run(main())
+
+
+def test_artifact_roundtrip(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(plugin_module, "ARTIFACT_CHUNK_SIZE", 4)
+    store = ArtifactStore(tmp_path / "store")
+    rpc = SimpleNamespace(sneks_artifact_get=store.get, sneks_artifact_put=store.put)
+
+    async def main():
+        for data in [b"", b"abc", b"abcd", b"abcdefghij"]:
+            src = tmp_path / "src"
+            src.write_bytes(data)
+            size = await upload_artifact(rpc, "ns", "a/b.whl", src)
+            assert size == len(data)
+            assert store.manifest("ns") == {"a/b.whl": len(data)}
+
+            dest = tmp_path / "dest" / "b.whl"
+            await fetch_artifact(rpc, "ns", "a/b.whl", size, dest)
+            assert dest.read_bytes() == data
+            assert list(dest.parent.iterdir()) == [dest]
+
+        assert store.manifest("other") == {}
+        with pytest.raises(ValueError):
+            await store.put("ns", "../escape", b"x", upload_id="x")
+        with pytest.raises(ValueError):
+            await store.get("ns", "/etc/passwd")
+
+    asyncio.run(main())
+
+
+def test_slot_limiter():
+    async def main():
+        limiter = SlotLimiter(2)
+        order: list[str] = []
+
+        async def take(holder: str, timeout: float = 10) -> None:
+            await limiter.acquire(holder, timeout)
+            order.append(holder)
+
+        tasks = {h: asyncio.create_task(take(h)) for h in "abcd"}
+        await asyncio.sleep(0.01)
+        assert order == ["a", "b"]
+
+        # Waiters that give up don't take a slot
+        tasks["c"].cancel()
+        limiter.release("a")
+        await asyncio.sleep(0.01)
+        assert order == ["a", "b", "d"]
+        assert set(limiter.holders) == {"b", "d"}
+
+        # Re-acquiring a held slot doesn't wait
+        await take("b")
+        # Slots time out
+        limiter.release("b")
+        await limiter.acquire("e", 0.05)
+        assert set(limiter.holders) == {"d", "e"}
+        await asyncio.sleep(0.1)
+        assert set(limiter.holders) == {"d"}
+
+    asyncio.run(main())
+
+
+def test_watcher_rolling_restart():
+    async def main():
+        scheduler = FakeScheduler()
+        for i in range(4):
+            scheduler.add(f"tcp://w{i}", f"tcp://n{i}")
+        watcher = DepManagerWatcher("DepManager")
+        await watcher.start(scheduler)  # type: ignore
+        acquire = scheduler.handlers["sneks_acquire"]
+
+        restarted: list[str] = []
+
+        async def restart(i: int) -> None:
+            await acquire(
+                limiter="restart", holder=f"tcp://n{i}", timeout=10, fraction=0.5
+            )
+            restarted.append(f"tcp://n{i}")
+            del scheduler.workers[f"tcp://w{i}"]
+
+        tasks = [asyncio.create_task(restart(i)) for i in range(4)]
+        await asyncio.sleep(0.01)
+        # Half the workers at once
+        assert restarted == ["tcp://n0", "tcp://n1"]
+
+        # Next one goes once a restarted worker rejoins
+        scheduler.add("tcp://w0-new", "tcp://n0")
+        watcher.add_worker(scheduler, "tcp://w0-new")  # type: ignore
+        await asyncio.sleep(0.01)
+        assert restarted == ["tcp://n0", "tcp://n1", "tcp://n2"]
+
+        scheduler.add("tcp://w1-new", "tcp://n1")
+        watcher.add_worker(scheduler, "tcp://w1-new")  # type: ignore
+        await asyncio.gather(*tasks)
+        assert len(restarted) == 4
+
+        await settle(watcher)
+        await watcher.close()
+
+    asyncio.run(main())
+
+
+def test_watcher_claims():
+    async def main():
+        scheduler = FakeScheduler()
+        watcher = DepManagerWatcher("DepManager")
+        await watcher.start(scheduler)  # type: ignore
+        claim, unclaim = (
+            scheduler.handlers["sneks_claim"],
+            scheduler.handlers["sneks_unclaim"],
+        )
+
+        assert claim(key="env", holder="a") == "a"
+        assert claim(key="env", holder="b") == "a"
+        assert claim(key="other", holder="b") == "b"
+        # Only the holder can give it up
+        unclaim(key="env", holder="b")
+        assert claim(key="env", holder="c") == "a"
+        unclaim(key="env", holder="a")
+        assert claim(key="env", holder="c") == "c"
+
+        await watcher.close()
+
+    asyncio.run(main())
+
+
+def test_install_slot():
+    async def main():
+        scheduler = FakeScheduler()
+        watcher = DepManagerWatcher("DepManager")
+        await watcher.start(scheduler)  # type: ignore
+        plugin = PoetryDepManager(b"", b"")
+        plugin.max_concurrent_installs = 2
+
+        installing: list[str] = []
+        done = asyncio.Event()
+        peak = 0
+
+        async def install(i: int) -> None:
+            nonlocal peak
+            nanny = SimpleNamespace(
+                address=f"tcp://n{i}",
+                scheduler=scheduler_rpc(scheduler),
+            )
+            async with plugin.install_slot(nanny, lambda phase: None):  # type: ignore
+                installing.append(nanny.address)
+                peak = max(peak, len(watcher.limiters["install"].holders))
+                await done.wait()
+
+        tasks = [asyncio.create_task(install(i)) for i in range(5)]
+        await asyncio.sleep(0.01)
+        # Two at a time, first come first served
+        assert installing == ["tcp://n0", "tcp://n1"]
+        done.set()
+        await asyncio.gather(*tasks)
+        assert installing == [f"tcp://n{i}" for i in range(5)]
+        assert peak == 2
+        assert not watcher.limiters["install"].holders
+
+        # Unlimited by default: no scheduler needed
+        plugin.max_concurrent_installs = None
+        async with plugin.install_slot(SimpleNamespace(), lambda phase: None):  # type: ignore
+            pass
+
+        await watcher.close()
+
+    asyncio.run(main())
+
+
+def test_cache_seeding(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    async def main():
+        scheduler = FakeScheduler()
+        watcher = DepManagerWatcher("DepManager")
+        await watcher.start(scheduler)  # type: ignore
+        plugin = PoetryDepManager(b"", b"")
+        artifact = tmp_path / "artifact"
+        artifact.write_bytes(b"wheel")
+        monkeypatch.setattr(
+            PoetryDepManager, "cache_files", lambda self: {"cache/artifact": artifact}
+        )
+        uploads: list[str] = []
+        real_upload = plugin_module.upload_artifact
+
+        async def upload(scheduler, namespace, path, src):
+            uploads.append(path)
+            return await real_upload(scheduler, namespace, path, src)
+
+        monkeypatch.setattr(plugin_module, "upload_artifact", upload)
+
+        def nanny(name: str) -> SimpleNamespace:
+            return SimpleNamespace(
+                address=f"tcp://{name}", scheduler=scheduler_rpc(scheduler)
+            )
+
+        a, b = nanny("a"), nanny("b")
+        # The first nanny downloads; the next waits for it to share what it got
+        assert await plugin.wait_for_cache(a, "key")
+        waiting = asyncio.create_task(plugin.wait_for_cache(b, "key"))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+
+        await plugin.push_cache(a, seeded="key")
+        assert uploads == ["cache/artifact", ".sneks-seeded/key"]
+        assert await waiting is False
+        # The manifest is read again before uploading, so nothing is uploaded twice
+        await plugin.push_cache(b)
+        assert uploads == ["cache/artifact", ".sneks-seeded/key"]
+
+        # If the first nanny fails, a waiting one takes over
+        assert await plugin.wait_for_cache(a, "other")
+        waiting = asyncio.create_task(plugin.wait_for_cache(b, "other"))
+        scheduler.handlers["sneks_unclaim"](key="other", holder=a.address)
+        assert await waiting is True
+
+        await watcher.close()
+
+    asyncio.run(main())
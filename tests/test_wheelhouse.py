@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import pytest
+
+from sneks.wheelhouse import build_wheelhouse, wheelhouse_dir
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("SNEKS_CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_build_wheelhouse_reuses_wheels(monkeypatch):
+    dest = wheelhouse_dir("x86_64")
+    dest.mkdir(parents=True)
+    for name in [
+        "toolz-0.12.0-py3-none-any.whl",
+        "PyYAML-6.0-cp310-cp310-manylinux_2_17_x86_64.manylinux2014_x86_64.whl",
+        "toolz-0.11.0-py3-none-any.whl",
+    ]:
+        (dest / name).touch()
+
+    def download(requirements, dest, arch):
+        assert requirements == ["no-wheels==1.0"]
+        return False
+
+    monkeypatch.setattr("sneks.wheelhouse._download", download)
+
+    wheelhouse = build_wheelhouse(
+        {"toolz": "0.12", "pyyaml": "6.0", "no-wheels": "1.0"}, "x86_64"
+    )
+    assert set(wheelhouse.files) == {
+        "toolz-0.12.0-py3-none-any.whl",
+        "PyYAML-6.0-cp310-cp310-manylinux_2_17_x86_64.manylinux2014_x86_64.whl",
+    }
+    assert all(p.parent == dest for p in wheelhouse.files.values())
+    assert wheelhouse.missing == ["no-wheels"]